@@ -0,0 +1,272 @@
+"""Admission control for outbound LLM calls.
+
+Every provider call takes a slot from one process-wide pool (LLM_MAX_CONCURRENCY).
+Callers that find the pool full wait in a priority queue, interactive chat ahead of
+background work such as PDF summarization, and ADMISSION_RESERVED_INTERACTIVE slots
+are held back for interactive calls only. Each user also draws from a token bucket;
+calls that are rejected or cancelled before they run get their token back.
+A call that cannot start before its deadline, or that finds the queue full, raises
+AdmissionRejected carrying a retry_after hint the server turns into HTTP 429.
+
+Who is calling and at what priority comes from context(), set by the endpoints.
+"""
+import os
+import math
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager, asynccontextmanager
+
+import metrics
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "16"))
+ADMISSION_RESERVED_INTERACTIVE = int(os.environ.get("ADMISSION_RESERVED_INTERACTIVE", "2"))
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", "64"))
+# Longest a call may wait for a slot (and for its user's bucket) before it is rejected
+ADMISSION_MAX_WAIT = {
+    INTERACTIVE: float(os.environ.get("ADMISSION_CHAT_MAX_WAIT", "15")),
+    BACKGROUND: float(os.environ.get("ADMISSION_BACKGROUND_MAX_WAIT", "120")),
+}
+USER_RATE = float(os.environ.get("ADMISSION_USER_RATE", "1.0"))  # LLM calls per second, refilled
+USER_BURST = float(os.environ.get("ADMISSION_USER_BURST", "20"))
+MAX_BUCKETS = 4096
+
+_username = contextvars.ContextVar("admission_username", default=None)
+_priority = contextvars.ContextVar("admission_priority", default=INTERACTIVE)
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"LLM capacity exceeded ({reason}); retry in {math.ceil(retry_after)}s")
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+@contextmanager
+def context(username=None, priority=None):
+    """Attribute LLM calls made inside the block to username and/or run them at priority."""
+    tokens = []
+    if username is not None:
+        tokens.append((_username, _username.set(username)))
+    if priority is not None:
+        tokens.append((_priority, _priority.set(priority)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+class _Waiter:
+    __slots__ = ("granted", "cancelled", "event", "loop", "future")
+
+    def __init__(self, loop=None):
+        self.granted = False
+        self.cancelled = False
+        self.loop = loop
+        self.event = None if loop else threading.Event()
+        self.future = loop.create_future() if loop else None
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(None))
+
+class AdmissionController:
+    def __init__(self, capacity=LLM_MAX_CONCURRENCY, reserved=ADMISSION_RESERVED_INTERACTIVE,
+                 max_queue=ADMISSION_MAX_QUEUE, max_wait=None, rate=USER_RATE, burst=USER_BURST):
+        self.capacity = max(capacity, 1)
+        self.reserved = min(max(reserved, 0), self.capacity - 1)
+        self.max_queue = max_queue
+        self.max_wait = {**ADMISSION_MAX_WAIT, **(max_wait or {})}
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._active = 0
+        self._queued = 0
+        self._heap = []
+        self._seq = itertools.count()
+        self._buckets = {}
+        self._avg_seconds = 2.0
+        self._stats = {"admitted": 0, "rejected": 0, "waited_seconds": 0.0}
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, active=self._active, queued=self._queued, users=len(self._buckets))
+
+    # --- per-user token buckets ---
+
+    def _reserve_token(self, username, max_wait):
+        """Take one token for username; returns how long to wait for it to refill, or raises."""
+        if not username or self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(username, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+            if wait > max_wait:
+                self._stats["rejected"] += 1
+                raise AdmissionRejected("user rate limit", wait)
+            # Going negative reserves the next token, so concurrent callers queue behind each other
+            self._buckets[username] = (tokens - 1, now)
+            if len(self._buckets) > MAX_BUCKETS:
+                self._prune(now)
+        return wait
+
+    def _refund_token(self, username):
+        """Give back the token of a call that was rejected or cancelled before it ran."""
+        if not username or self.rate <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            entry = self._buckets.get(username)
+            if entry is not None:
+                tokens, last = entry
+                self._buckets[username] = (min(self.burst, tokens + (now - last) * self.rate + 1), now)
+
+    def _prune(self, now):
+        full = [u for u, (tokens, last) in self._buckets.items()
+                if tokens + (now - last) * self.rate >= self.burst]
+        for u in full:
+            del self._buckets[u]
+
+    # --- global slots ---
+
+    def _limit(self, priority):
+        return self.capacity if priority == INTERACTIVE else self.capacity - self.reserved
+
+    def _dispatch(self):
+        # Caller holds the lock. Grants slots to queued waiters in (priority, arrival) order.
+        while self._heap:
+            priority, _, waiter = self._heap[0]
+            if waiter.cancelled:
+                heapq.heappop(self._heap)
+                continue
+            if self._active >= self._limit(priority):
+                break
+            heapq.heappop(self._heap)
+            self._active += 1
+            self._queued -= 1
+            waiter.granted = True
+            waiter.wake()
+
+    def _enqueue(self, priority, waiter):
+        with self._lock:
+            self._queued += 1
+            heapq.heappush(self._heap, (priority, next(self._seq), waiter))
+            self._dispatch()
+            if not waiter.granted and self._queued > self.max_queue:
+                self._cancel(waiter)
+                raise AdmissionRejected("queue full", self._retry_after())
+
+    def _cancel(self, waiter):
+        # Caller holds the lock
+        waiter.cancelled = True
+        self._queued -= 1
+        self._stats["rejected"] += 1
+
+    def _abandon(self, waiter):
+        """The wait ended without an explicit grant: keep a late grant, otherwise reject."""
+        with self._lock:
+            if waiter.granted:
+                return
+            self._cancel(waiter)
+            retry_after = self._retry_after()
+        raise AdmissionRejected("timed out waiting for capacity", retry_after)
+
+    def _retry_after(self):
+        # Caller holds the lock. Rough time for the queue ahead to drain.
+        return self._avg_seconds * (self._queued + 1) / self.capacity
+
+    def _admitted(self, waited):
+        with self._lock:
+            self._stats["admitted"] += 1
+            self._stats["waited_seconds"] += waited
+
+    def release(self, held_seconds=None):
+        with self._lock:
+            self._active -= 1
+            if held_seconds is not None:
+                self._avg_seconds = 0.9 * self._avg_seconds + 0.1 * held_seconds
+            self._dispatch()
+
+    def acquire(self, username=None, priority=INTERACTIVE):
+        started = time.monotonic()
+        deadline = started + self.max_wait[priority]
+        wait = self._reserve_token(username, self.max_wait[priority])
+        try:
+            if wait:
+                time.sleep(wait)
+            waiter = _Waiter()
+            self._enqueue(priority, waiter)
+            if not waiter.granted and not waiter.event.wait(max(deadline - time.monotonic(), 0)):
+                self._abandon(waiter)
+        except BaseException:
+            self._refund_token(username)
+            raise
+        self._admitted(time.monotonic() - started)
+
+    async def aacquire(self, username=None, priority=INTERACTIVE):
+        started = time.monotonic()
+        deadline = started + self.max_wait[priority]
+        wait = self._reserve_token(username, self.max_wait[priority])
+        try:
+            if wait:
+                await asyncio.sleep(wait)
+            waiter = _Waiter(asyncio.get_running_loop())
+            self._enqueue(priority, waiter)
+            if not waiter.granted:
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter.future), max(deadline - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    self._abandon(waiter)
+                except asyncio.CancelledError:
+                    with self._lock:
+                        granted = waiter.granted
+                        if not granted:
+                            self._cancel(waiter)
+                    if granted:
+                        self.release()
+                    raise
+        except BaseException:
+            self._refund_token(username)
+            raise
+        self._admitted(time.monotonic() - started)
+
+    @contextmanager
+    def slot(self):
+        """Hold one LLM slot for the caller in the current context()."""
+        self.acquire(_username.get(), _priority.get())
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+    @asynccontextmanager
+    async def aslot(self):
+        await self.aacquire(_username.get(), _priority.get())
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+controller = AdmissionController()
+
+def _collect():
+    s = controller.stats()
+    return [
+        ("admission_active", "gauge", "LLM calls holding an admission slot", s["active"]),
+        ("admission_queued", "gauge", "LLM calls waiting for a slot", s["queued"]),
+        ("admission_admitted_total", "counter", "LLM calls admitted", s["admitted"]),
+        ("admission_rejected_total", "counter", "LLM calls rejected with 429", s["rejected"]),
+        ("admission_wait_seconds_total", "counter", "Time admitted calls spent waiting", s["waited_seconds"]),
+    ]
+
+metrics.register_collector(_collect)
@@ -0,0 +1,154 @@
+"""Async entry point: `uvicorn asgi:app --host 0.0.0.0 --port 5000`.
+
+Chat turns run on the event loop through the graph's async nodes (ainvoke/astream),
+so a turn waiting on the LLM holds no thread. Every other route is served by the
+Flask app through a WSGI adapter.
+"""
+import os
+import json
+import time
+import uuid
+import asyncio
+import traceback
+
+from asgiref.wsgi import WsgiToAsgi
+
+import server
+import admission
+import metrics
+from admission import AdmissionRejected
+from llm import get_async_graph, close_async_graph, memory
+from ingest import resume_pending
+from compaction import start_compaction_scheduler
+
+wsgi_app = WsgiToAsgi(server.app)
+
+async def read_json(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    return json.loads(body or b"{}")
+
+async def send_json(send, payload, status=200, headers=()):
+    body = json.dumps(payload).encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                            *headers]})
+    await send({"type": "http.response.body", "body": body})
+
+async def chat(scope, receive, send):
+    data = await read_json(receive)
+    username = data.get("username")
+
+    if not os.environ.get("GROQ_API_KEY"):
+        return await send_json(send, {
+            "response": "Error: GROQ_API_KEY is not set. Please add your Groq API key in the Secrets tab.",
+            "thread_id": data.get("thread_id") or str(uuid.uuid4()),
+            "flashcards": [], "mcqs": []
+        })
+
+    # The turn bookkeeping is short SQLite work; keep it off the loop all the same
+    thread_id, inputs, config = await asyncio.to_thread(server.start_chat_turn, data)
+
+    try:
+        graph = await get_async_graph()
+        with admission.context(username, admission.INTERACTIVE):
+            result = await graph.ainvoke(inputs, config=config)
+    except AdmissionRejected as e:
+        return await send_json(send, {"error": str(e), "retry_after": e.retry_after}, 429,
+                               [(b"retry-after", str(e.retry_after).encode())])
+    except Exception as e:
+        print(f"Error in chat: {e}")
+        traceback.print_exc()
+        return await send_json(send, {
+            "response": "Sorry, there was an error processing your request.",
+            "thread_id": thread_id,
+            "flashcards": [], "mcqs": []
+        })
+
+    await send_json(send, await asyncio.to_thread(server.finish_chat_turn, username, thread_id, result))
+
+async def chat_agent_stream(scope, receive, send):
+    data = await read_json(receive)
+    username = data.get("username")
+
+    await send({"type": "http.response.start", "status": 200, "headers": [
+        (b"content-type", b"text/event-stream"),
+        (b"cache-control", b"no-cache"),
+        (b"x-accel-buffering", b"no"),
+    ]})
+
+    async def emit(payload):
+        await send({"type": "http.response.body", "body": server.sse(payload).encode("utf-8"), "more_body": True})
+
+    if not os.environ.get("GROQ_API_KEY"):
+        await emit({'type': 'error', 'content': 'GROQ_API_KEY not set'})
+    else:
+        thread_id, inputs, config = await asyncio.to_thread(server.start_chat_turn, data)
+        await emit({'type': 'start', 'thread_id': thread_id})
+        try:
+            graph = await get_async_graph()
+            pending_tools = {}
+            with admission.context(username, admission.INTERACTIVE):
+                async for mode, chunk in graph.astream(inputs, config=config, stream_mode=["messages", "updates"]):
+                    for frame in server.stream_frames(mode, chunk, pending_tools):
+                        await emit(frame)
+
+            result = (await graph.aget_state(config)).values
+            response = await asyncio.to_thread(server.finish_chat_turn, username, thread_id, result)
+            await emit(dict(response, type='done'))
+        except AdmissionRejected as e:
+            await emit({'type': 'error', 'content': str(e), 'retry_after': e.retry_after, 'thread_id': thread_id})
+        except Exception as e:
+            print(f"Error in agent stream: {e}")
+            await emit({'type': 'error', 'content': str(e), 'thread_id': thread_id})
+
+    await send({"type": "http.response.body", "body": b""})
+
+ROUTES = {
+    ("POST", "/api/chat"): chat,
+    ("POST", "/api/chat/agent-stream"): chat_agent_stream,
+}
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            resume_pending()
+            start_compaction_scheduler(memory.conn, memory.lock)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await close_async_graph()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(scope, receive, send)
+    handler = ROUTES.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+    if handler is None:
+        return await wsgi_app(scope, receive, send)
+    
+    started = time.perf_counter()
+    headers = dict(scope.get("headers") or [])
+    trace_id = metrics.trace_id_for(headers.get(metrics.TRACE_HEADER.lower().encode(), b"").decode())
+    trace, token = metrics.start_trace(trace_id) if trace_id else (None, None)
+
+    async def traced_send(message):
+        if message["type"] == "http.response.start":
+            metrics.HTTP_SECONDS.observe(time.perf_counter() - started, endpoint=scope["path"],
+                                         method=scope["method"], status=message["status"])
+            if trace is not None:
+                message = dict(message, headers=[*message.get("headers", []),
+                                                 (metrics.TRACE_HEADER.lower().encode(), trace.id.encode())])
+        await send(message)
+
+    try:
+        await handler(scope, receive, traced_send)
+    finally:
+        if trace is not None:
+            metrics.detach_trace(token)
+            trace.dump()
@@ -0,0 +1,462 @@
+"""Offline benchmark for the chat server.
+
+The Groq model, edge_tts and the chart renderer are replaced by deterministic local
+fakes with configurable latency, so runs need no network or API key. Each scenario
+drives the Flask app (or summarize_pdf_tool directly) from a thread pool against a
+seeded database in a scratch directory, and the results are written as JSON:
+
+    python benchmark.py --out bench.json
+    python benchmark.py --scenarios chat,history --requests 200 --baseline bench.json
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ("chat", "chat_stream", "history", "upload", "summarize")
+WORDS = ("cell membrane protein energy function structure process system theory data model "
+         "analysis result method reaction force motion value equation concept example").split()
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    i = min(len(sorted_values) - 1, max(0, round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+def peak_rss_bytes():
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return {"self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale}
+
+def words(rng, n):
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+# --- fakes ---
+
+def make_fake_model(latency, tokens, token_delay):
+    """A chat model that answers after `latency` seconds with `tokens` words.
+
+    A user message containing [chart] or [speak] gets one tool call first, so the
+    tools and finalize paths are exercised too.
+    """
+    from langchain_core.language_models import BaseChatModel
+    from langchain_core.messages import AIMessage, AIMessageChunk
+    from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+    import admission
+    import metrics
+
+    class FakeChatModel(BaseChatModel):
+        model_name: str = "fake"
+
+        @property
+        def _llm_type(self):
+            return "fake"
+
+        def bind_tools(self, tools, **kwargs):
+            return self
+
+        def _reply(self, messages):
+            last_human = next((m for m in reversed(messages) if m.type == "human"), None)
+            prompt = last_human.content if last_human else ""
+            answered = messages and messages[-1].type == "tool"
+            usage = {"input_tokens": sum(len(str(m.content).split()) for m in messages),
+                     "output_tokens": tokens, "total_tokens": 0}
+            usage["total_tokens"] = usage["input_tokens"] + tokens
+            if not answered and "[chart]" in prompt:
+                call = {"name": "generate_chart", "args": {"chart_code": f"graph TD; A-->B{len(prompt)}"}, "id": "bench-chart"}
+                return AIMessage(content="", tool_calls=[call], usage_metadata=usage)
+            if not answered and "[speak]" in prompt:
+                call = {"name": "speak_response", "args": {"text": words(random.Random(prompt), 30)}, "id": "bench-speak"}
+                return AIMessage(content="", tool_calls=[call], usage_metadata=usage)
+            rng = random.Random(len(messages) * 7919 + len(prompt))
+            return AIMessage(content=words(rng, tokens), usage_metadata=usage)
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            with admission.controller.slot(), metrics.span("llm", self.model_name):
+                time.sleep(latency + tokens * token_delay)
+                return ChatResult(generations=[ChatGeneration(message=self._reply(messages))])
+
+        def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+            with admission.controller.slot(), metrics.span("llm", self.model_name):
+                time.sleep(latency)
+                reply = self._reply(messages)
+                if reply.tool_calls:
+                    yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=[
+                        {"name": c["name"], "args": json.dumps(c["args"]), "id": c["id"], "index": 0}
+                        for c in reply.tool_calls]))
+                    return
+                for word in reply.content.split(" "):
+                    if token_delay:
+                        time.sleep(token_delay)
+                    chunk = ChatGenerationChunk(message=AIMessageChunk(content=word + " "))
+                    if run_manager:
+                        run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                    yield chunk
+
+    return FakeChatModel()
+
+def make_fake_communicate(latency, chunks):
+    import asyncio
+
+    class FakeCommunicate:
+        def __init__(self, text, voice, *args, **kwargs):
+            self.text = text
+
+        async def stream(self):
+            for _ in range(chunks):
+                await asyncio.sleep(latency / max(chunks, 1))
+                yield {"type": "audio", "data": b"\xff\xf3" * 512}
+
+    return FakeCommunicate
+
+def install_fakes(args):
+    import admission
+    import llm
+    import server
+    import charts
+    import tts
+
+    model = make_fake_model(args.llm_latency, args.llm_tokens, args.token_delay)
+    fake_get_model = lambda model_name=None, temperature=None: model
+    llm.get_model = fake_get_model
+    server.get_model = fake_get_model
+    llm._bound_models.clear()
+
+    tts.edge_tts.Communicate = make_fake_communicate(args.tts_latency, 8)
+
+    png = b"\x89PNG\r\n\x1a\n" + b"\0" * 2048
+    def render(code):
+        time.sleep(args.chart_latency)
+        return png, "image/png"
+    async def arender(code):
+        import asyncio
+        await asyncio.sleep(args.chart_latency)
+        return png, "image/png"
+    charts.set_renderer(render, arender)
+
+    # A handful of seeded users would otherwise spend most of the run waiting on their buckets
+    admission.controller.rate = args.user_rate
+
+# --- fixtures ---
+
+def make_pdf(path, pages, rng):
+    import fitz
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(54, 54, 558, 738), f"Section {i + 1}\n" + words(rng, 350), fontsize=9)
+    doc.save(path)
+    doc.close()
+
+def seed_database(users, threads_per_user, messages_per_thread, rng):
+    from database import register_user, create_thread_entry, save_message
+    seeded = {}
+    for u in range(users):
+        username = f"bench{u}"
+        register_user(username, "bench")
+        seeded[username] = []
+        for t in range(threads_per_user):
+            thread_id = f"{username}-t{t}"
+            create_thread_entry(username, thread_id, words(rng, 6))
+            for m in range(messages_per_thread):
+                save_message(thread_id, "user" if m % 2 == 0 else "ai", words(rng, 40))
+            seeded[username].append(thread_id)
+    return seeded
+
+# --- scenarios ---
+
+def run_load(op, count, concurrency):
+    """Run op(i) count times on `concurrency` threads; op returns extra per-request fields or None."""
+    latencies, extras, errors = [], [], 0
+
+    def timed(i):
+        started = time.perf_counter()
+        try:
+            extra = op(i)
+            return time.perf_counter() - started, extra, None
+        except Exception as e:
+            return time.perf_counter() - started, None, e
+
+    wall_started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for seconds, extra, error in pool.map(timed, range(count)):
+            if error is not None:
+                errors += 1
+                print(f"benchmark request error: {error}")
+                continue
+            latencies.append(seconds)
+            if extra:
+                extras.append(extra)
+    wall = time.perf_counter() - wall_started
+
+    latencies.sort()
+    result = {
+        "requests": count,
+        "errors": errors,
+        "concurrency": concurrency,
+        "wall_seconds": round(wall, 4),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else None,
+        "latency_seconds": {
+            "mean": round(sum(latencies) / len(latencies), 5) if latencies else None,
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else None,
+        },
+    }
+    for key in {k for e in extras for k in e}:
+        values = sorted(e[key] for e in extras if key in e)
+        result[key] = {"p50": percentile(values, 50), "p99": percentile(values, 99)}
+    return result
+
+def chat_prompt(i, args):
+    if args.tool_ratio and i % round(1 / args.tool_ratio) == 0:
+        return "Draw this for me [chart]" if i % 2 == 0 else "Read this out [speak]"
+    return f"Explain topic number {i} in simple terms"
+
+def scenario_chat(app, args, seeded):
+    users = list(seeded)
+
+    def op(i):
+        client = app.test_client()
+        response = client.post("/api/chat", json={
+            "username": users[i % len(users)], "message": chat_prompt(i, args),
+            "enabled_tools": ["chart", "voice"]})
+        if response.status_code != 200 or "response" not in response.json:
+            raise RuntimeError(f"status {response.status_code}")
+    return run_load(op, args.requests, args.concurrency)
+
+def scenario_chat_stream(app, args, seeded):
+    users = list(seeded)
+
+    def op(i):
+        client = app.test_client()
+        started = time.perf_counter()
+        response = client.post("/api/chat/stream", json={
+            "username": users[i % len(users)], "message": chat_prompt(i, args)}, buffered=False)
+        first_byte = None
+        body = b""
+        for chunk in response.response:
+            if first_byte is None:
+                first_byte = time.perf_counter() - started
+            body += chunk
+        response.close()
+        if b'"done"' not in body:
+            raise RuntimeError("stream ended without a done frame")
+        return {"ttfb_seconds": first_byte}
+    return run_load(op, args.requests, args.concurrency)
+
+def scenario_history(app, args, seeded):
+    threads = [t for ts in seeded.values() for t in ts]
+
+    def op(i):
+        client = app.test_client()
+        thread_id = threads[i % len(threads)]
+        if i % 2:
+            response = client.post("/api/history", json={"thread_id": thread_id})
+        else:
+            response = client.post("/api/history", json={"thread_id": thread_id, "limit": 50})
+        if response.status_code != 200:
+            raise RuntimeError(f"status {response.status_code}")
+    return run_load(op, args.requests, args.concurrency)
+
+def scenario_upload(app, args, seeded, pdfs):
+    from database import get_file_statuses
+    users = list(seeded)
+    blobs = []
+    for path in pdfs:
+        with open(path, "rb") as f:
+            blobs.append((os.path.basename(path), f.read()))
+
+    def op(i):
+        client = app.test_client()
+        name, blob = blobs[i % len(blobs)]
+        response = client.post("/api/upload", content_type="multipart/form-data", data={
+            "file": (io.BytesIO(blob), name), "username": users[i % len(users)]})
+        if response.status_code != 200:
+            raise RuntimeError(f"status {response.status_code}")
+    count = min(args.requests, args.upload_requests)
+    result = run_load(op, count, args.concurrency)
+
+    # Uploads return before parsing; also time how long the background ingestion takes to drain
+    started = time.perf_counter()
+    deadline = started + 300
+    while True:
+        statuses = [f["status"] for u in users for f in get_file_statuses(u)]
+        unfinished = sum(1 for s in statuses if s in ("queued", "processing"))
+        if not unfinished or time.perf_counter() >= deadline:
+            break
+        time.sleep(0.05)
+    result["ingestion_drain_seconds"] = round(time.perf_counter() - started, 4)
+    result["ingestion_failed"] = statuses.count("failed")
+    result["ingestion_unfinished"] = unfinished
+    # Failed or stuck ingestions are failed uploads, not fast ones
+    result["errors"] += result["ingestion_failed"] + unfinished
+    return result
+
+def scenario_summarize(app, args, seeded, pdfs):
+    import llm
+    names = [os.path.basename(p) for p in pdfs]
+    prompts = ["Summarize the whole document", "What does section 3 say about energy?"]
+
+    def op(i):
+        result = llm.summarize_pdf_tool.invoke({"filename": names[i % len(names)], "prompt": prompts[i % 2]})
+        if result.startswith(("Error", "Could not")):
+            raise RuntimeError(result)
+    return run_load(op, min(args.requests, args.summarize_requests), args.concurrency)
+
+def span_summary():
+    import metrics
+    sums, counts = {}, {}
+    for name, labels, value in metrics.SPAN_SECONDS.samples():
+        key = "/".join(v for k, v in labels if k != "le")
+        if name.endswith("_sum"):
+            sums[key] = value
+        elif name.endswith("_count"):
+            counts[key] = value
+    return {k: {"count": counts[k], "mean_seconds": round(sums[k] / counts[k], 6)}
+            for k in sorted(counts) if counts[k]}
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nvs {baseline_path} ({baseline['meta'].get('git_revision')}):")
+    for name, current in results["scenarios"].items():
+        old = baseline.get("scenarios", {}).get(name)
+        if not old:
+            continue
+        for label, new_v, old_v in (
+            ("rps", current["throughput_rps"], old["throughput_rps"]),
+            ("p50", current["latency_seconds"]["p50"], old["latency_seconds"]["p50"]),
+            ("p99", current["latency_seconds"]["p99"], old["latency_seconds"]["p99"]),
+        ):
+            if new_v is None or not old_v:
+                continue
+            print(f"  {name:12s} {label:4s} {old_v:10.4f} -> {new_v:10.4f} ({(new_v - old_v) / old_v * 100:+.1f}%)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=100, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--upload-requests", type=int, default=20)
+    parser.add_argument("--summarize-requests", type=int, default=10)
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="seconds before a fake reply")
+    parser.add_argument("--llm-tokens", type=int, default=60, help="words per fake reply")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="extra seconds per streamed word")
+    parser.add_argument("--tts-latency", type=float, default=0.2)
+    parser.add_argument("--chart-latency", type=float, default=0.1)
+    parser.add_argument("--user-rate", type=float, default=0.0,
+                        help="per-user LLM calls/second for admission control (0 = no bucket)")
+    parser.add_argument("--tool-ratio", type=float, default=0.2, help="share of chat turns that call a tool")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--threads-per-user", type=int, default=5)
+    parser.add_argument("--messages-per-thread", type=int, default=60)
+    parser.add_argument("--pdfs", type=int, default=4)
+    parser.add_argument("--pdf-pages", type=int, default=40)
+    parser.add_argument("--llm-cache", action="store_true", help="leave the LLM response cache on")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--workdir", help="scratch directory (default: a fresh temp dir, removed afterwards)")
+    parser.add_argument("--serve", type=int, metavar="PORT",
+                        help="instead of running scenarios, serve the app on PORT with the fakes installed "
+                             "(a target for replay.py)")
+    parser.add_argument("--out", default="benchmark.json")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    args = parser.parse_args(argv)
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    out_path = os.path.abspath(args.out)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix="study-guide-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    if os.environ.get("TRAFFIC_CAPTURE"):
+        os.environ["TRAFFIC_CAPTURE"] = os.path.abspath(os.environ["TRAFFIC_CAPTURE"])
+
+    # The app keeps its databases, uploads and media relative to the working directory,
+    # so everything is set up before the first import touches them.
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    os.environ.setdefault("GROQ_API_KEY", "benchmark")
+    os.environ.setdefault("CHECKPOINT_COMPACT_INTERVAL", "0")
+    if not args.llm_cache:
+        os.environ["LLM_CACHE"] = "0"
+
+    try:
+        import server
+        install_fakes(args)
+        if args.serve:
+            print(f"serving with stub backends from {workdir}")
+            server.app.run(host="127.0.0.1", port=args.serve, threaded=True)
+            return
+
+        rng = random.Random(args.seed)
+        seeded = seed_database(args.users, args.threads_per_user, args.messages_per_thread, rng)
+        os.makedirs("uploads", exist_ok=True)
+        pdfs = []
+        for i in range(args.pdfs):
+            path = os.path.join("uploads", f"bench_doc{i}.pdf")
+            make_pdf(path, args.pdf_pages, rng)
+            pdfs.append(path)
+
+        results = {
+            "meta": {
+                "git_revision": git_revision(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "args": {k: v for k, v in vars(args).items() if k not in ("out", "baseline", "workdir")},
+            },
+            "scenarios": {},
+        }
+        runners = {
+            "chat": lambda: scenario_chat(server.app, args, seeded),
+            "chat_stream": lambda: scenario_chat_stream(server.app, args, seeded),
+            "history": lambda: scenario_history(server.app, args, seeded),
+            "upload": lambda: scenario_upload(server.app, args, seeded, pdfs),
+            "summarize": lambda: scenario_summarize(server.app, args, seeded, pdfs),
+        }
+        for name in scenarios:
+            print(f"running {name}...")
+            result = runners[name]()
+            result["peak_rss_bytes"] = peak_rss_bytes()
+            results["scenarios"][name] = result
+            lat = result["latency_seconds"]
+            print(f"  {result['throughput_rps']} req/s  p50 {lat['p50'] or 0:.4f}s  p99 {lat['p99'] or 0:.4f}s  "
+                  f"errors {result['errors']}")
+        results["spans"] = span_summary()
+    finally:
+        os.chdir(REPO_DIR)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(out_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"wrote {out_path}")
+    if baseline_path:
+        compare(results, baseline_path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""Opt-in traffic capture for server.py, replayed with replay.py.
+
+Set TRAFFIC_CAPTURE=/path/to/traffic.jsonl to append one JSON line per /api/ request:
+arrival time, endpoint, status, duration (streams are timed to their last byte),
+and the payload *shape*. String fields are reduced to their length, and usernames,
+thread ids, file paths and file ids are replaced by salted hashes that stay stable
+across a capture, so a session can be followed without recording who it was or
+what they wrote. A few enum-like fields (chat_mode, enabled_tools, ...) are kept verbatim.
+"""
+import os
+import hmac
+import json
+import time
+import queue
+import hashlib
+import threading
+
+from flask import request, g
+
+CAPTURE_PATH = os.environ.get("TRAFFIC_CAPTURE", "")
+# Keep the salt fixed across restarts to link sessions in one capture; random otherwise
+CAPTURE_SALT = os.environ.get("TRAFFIC_CAPTURE_SALT", "") or os.urandom(16).hex()
+CAPTURE_PREFIX = "/api/"
+MAX_LIST_ITEMS = 50
+
+# field -> prefix of its anonymized token
+ANON_FIELDS = {"username": "u", "thread_id": "t", "filepath": "f", "file_id": "fid"}
+VERBATIM_FIELDS = {"chat_mode", "enabled_tools", "voice_style", "type", "limit", "role", "mode"}
+# Never recorded, not even as a length
+SKIP_FIELDS = {"password"}
+
+_queue = queue.Queue(maxsize=10000)
+_writer = None
+_writer_lock = threading.Lock()
+
+def anonymize(kind: str, value) -> str:
+    if value is None or value == "":
+        return value
+    digest = hmac.new(CAPTURE_SALT.encode(), f"{kind}:{value}".encode(), hashlib.sha256).hexdigest()
+    return f"{ANON_FIELDS.get(kind, kind)}_{digest[:12]}"
+
+def shape(value, key=None):
+    """A content-free description of a request payload that replay.py can rebuild a payload from."""
+    if key in ANON_FIELDS:
+        return anonymize(key, value)
+    if key in VERBATIM_FIELDS:
+        return value
+    if isinstance(value, dict):
+        return {k: shape(v, k) for k, v in value.items() if k not in SKIP_FIELDS}
+    if isinstance(value, list):
+        return [shape(v) for v in value[:MAX_LIST_ITEMS]]
+    if isinstance(value, str):
+        return {"str": len(value)}
+    return value
+
+def _write_loop(path):
+    with open(path, "a", encoding="utf-8") as f:
+        while True:
+            record = _queue.get()
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            if _queue.empty():
+                f.flush()
+
+def _emit(record):
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_write_loop, args=(CAPTURE_PATH,), name="traffic-capture", daemon=True)
+            _writer.start()
+    try:
+        _queue.put_nowait(record)
+    except queue.Full:
+        print("Traffic capture queue full; dropping a record")
+
+def _request_shape():
+    if request.is_json:
+        return {"json": shape(request.get_json(silent=True) or {})}
+    body = {}
+    if request.form:
+        body["form"] = shape(request.form.to_dict())
+    if request.files:
+        files = {}
+        for name, storage in request.files.items():
+            stream = storage.stream
+            size = stream.seek(0, os.SEEK_END)
+            stream.seek(0)
+            files[name] = {"bytes": size, "ext": os.path.splitext(storage.filename or "")[1].lower()}
+        body["files"] = files
+    if request.args:
+        body["args"] = shape(request.args.to_dict())
+    return body
+
+def _response_ids(payload):
+    if isinstance(payload, dict):
+        return {k: anonymize(k, payload[k]) for k in ANON_FIELDS if payload.get(k) not in (None, "")}
+    return {}
+
+def _sniff_stream(record, iterable, sse):
+    """Pass a streamed body through, picking ids out of SSE frames and timing it to the end."""
+    ids = {}
+    try:
+        for chunk in iterable:
+            if sse and not ids.get("thread_id") and chunk:
+                text = chunk.decode("utf-8", "ignore") if isinstance(chunk, bytes) else chunk
+                for line in text.splitlines():
+                    if line.startswith("data: "):
+                        try:
+                            ids.update(_response_ids(json.loads(line[6:])))
+                        except ValueError:
+                            pass
+            yield chunk
+    finally:
+        if hasattr(iterable, "close"):
+            iterable.close()
+        record["duration"] = round(time.perf_counter() - record.pop("_started"), 6)
+        record["response"] = ids
+        _emit(record)
+
+def init_app(app):
+    """Register the capture hooks on app when TRAFFIC_CAPTURE is set."""
+    if not CAPTURE_PATH:
+        return
+
+    @app.before_request
+    def start_capture():
+        if request.path.startswith(CAPTURE_PREFIX):
+            g.capture_started = time.perf_counter()
+            g.capture_ts = time.time()
+            try:
+                g.capture_body = _request_shape()
+            except Exception as e:
+                print(f"Traffic capture error: {e}")
+                g.capture_body = {}
+
+    @app.after_request
+    def finish_capture(response):
+        started = g.pop("capture_started", None)
+        if started is None:
+            return response
+        record = {
+            "ts": round(g.pop("capture_ts"), 6),
+            "method": request.method,
+            # Paths with URL parameters (audio and chart digests) are kept as their rule only
+            "path": None if request.view_args else request.path,
+            "endpoint": request.url_rule.rule if request.url_rule else None,
+            "status": response.status_code,
+            "user": shape(_username_hint(), "username"),
+            "request": g.pop("capture_body", {}),
+        }
+        if response.is_streamed:
+            record["_started"] = started
+            record["streamed"] = True
+            response.response = _sniff_stream(record, response.response,
+                                              response.mimetype == "text/event-stream")
+            return response
+        record["duration"] = round(time.perf_counter() - started, 6)
+        if response.is_json:
+            record["response"] = _response_ids(response.get_json(silent=True))
+        _emit(record)
+        return response
+
+def _username_hint():
+    if request.is_json:
+        return (request.get_json(silent=True) or {}).get("username")
+    return request.form.get("username")
@@ -0,0 +1,100 @@
+import os
+import asyncio
+import base64
+import hashlib
+
+import httpx
+import requests
+
+from tts import MEDIA_DIR
+from metrics import span
+
+# Absolute, so the existence check and Flask's send_file (which resolves relative paths
+# against app.root_path) look at the same file
+CHART_DIR = os.path.abspath(os.path.join(MEDIA_DIR, "charts"))
+CHART_RENDERER_URL = os.environ.get("CHART_RENDERER_URL", "https://mermaid.ink/img/")
+CHART_RENDER_TIMEOUT = float(os.environ.get("CHART_RENDER_TIMEOUT", "15"))
+
+_session = requests.Session()
+
+def mermaid_ink_renderer(code: str):
+    """Render Mermaid source through a mermaid.ink-compatible HTTP service; returns (bytes, content_type)."""
+    encoded = base64.b64encode(code.encode("utf8")).decode("ascii")
+    url = CHART_RENDERER_URL + encoded + "?bgColor=!white"
+    response = _session.get(url, timeout=CHART_RENDER_TIMEOUT)
+    if response.status_code != 200:
+        raise RuntimeError(f"Failed to generate diagram (status {response.status_code})")
+    return response.content, response.headers.get('Content-Type', '')
+
+_async_client = None
+
+async def amermaid_ink_renderer(code: str):
+    """Async variant of mermaid_ink_renderer on a shared httpx.AsyncClient."""
+    global _async_client
+    if _async_client is None:
+        _async_client = httpx.AsyncClient(timeout=CHART_RENDER_TIMEOUT)
+    encoded = base64.b64encode(code.encode("utf8")).decode("ascii")
+    response = await _async_client.get(CHART_RENDERER_URL + encoded, params={"bgColor": "!white"})
+    if response.status_code != 200:
+        raise RuntimeError(f"Failed to generate diagram (status {response.status_code})")
+    return response.content, response.headers.get('Content-Type', '')
+
+_renderer = mermaid_ink_renderer
+_arenderer = amermaid_ink_renderer
+
+def set_renderer(renderer, arenderer=None):
+    """Swap the chart backend, e.g. for a local stand-in in tests. renderer(code) -> (bytes, content_type).
+
+    Without arenderer, async callers run the sync renderer in a worker thread.
+    """
+    global _renderer, _arenderer
+    _renderer = renderer
+    _arenderer = arenderer
+
+def normalize_mermaid(chart_code: str) -> str:
+    code = chart_code.replace("```mermaid", "").replace("```", "")
+    lines = [line.rstrip() for line in code.replace("\r\n", "\n").split("\n")]
+    return "\n".join(line for line in lines if line.strip())
+
+def chart_digest(code: str) -> str:
+    return hashlib.sha256(code.encode("utf-8")).hexdigest()[:32]
+
+def chart_path(digest: str) -> str:
+    return os.path.join(CHART_DIR, f"{digest}.png")
+
+def chart_url(digest: str) -> str:
+    return f"/api/chart/{digest}"
+
+def render_chart(chart_code: str) -> str:
+    """Return the digest of the rendered chart, calling the renderer only for unseen diagrams."""
+    code = normalize_mermaid(chart_code)
+    digest = chart_digest(code)
+    if os.path.exists(chart_path(digest)):
+        return digest
+    with span("chart", "render"):
+        rendered = _renderer(code)
+    _save_chart(digest, *rendered)
+    return digest
+
+async def arender_chart(chart_code: str) -> str:
+    code = normalize_mermaid(chart_code)
+    digest = chart_digest(code)
+    if os.path.exists(chart_path(digest)):
+        return digest
+    with span("chart", "render"):
+        if _arenderer is not None:
+            rendered = await _arenderer(code)
+        else:
+            rendered = await asyncio.to_thread(_renderer, code)
+    _save_chart(digest, *rendered)
+    return digest
+
+def _save_chart(digest: str, content: bytes, content_type: str):
+    path = chart_path(digest)
+    if 'image' not in content_type:
+        raise RuntimeError("Could not generate diagram image")
+    os.makedirs(CHART_DIR, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.part"
+    with open(tmp, "wb") as f:
+        f.write(content)
+    os.replace(tmp, path)
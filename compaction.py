@@ -0,0 +1,138 @@
+"""Checkpoint store compaction for checkpoints.sqlite.
+
+Run once from the command line:
+
+    python compaction.py --keep 5 --db path/to/checkpoints.sqlite --study-db path/to/study_guide.db
+
+or let server.py run it periodically (CHECKPOINT_COMPACT_INTERVAL seconds, 0 disables).
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from contextlib import nullcontext
+
+from database import DB_NAME, CHECKPOINT_DB_NAME, get_all_thread_ids
+
+CHECKPOINT_KEEP = int(os.environ.get("CHECKPOINT_KEEP", "3"))
+CHECKPOINT_COMPACT_INTERVAL = int(os.environ.get("CHECKPOINT_COMPACT_INTERVAL", str(6 * 3600)))
+VACUUM_PAGES = 2000
+
+def _db_bytes(conn):
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    return page_size * page_count
+
+def _has_tables(conn):
+    names = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    return {"checkpoints", "writes"} <= names
+
+def compact(conn, lock=None, keep=CHECKPOINT_KEEP, vacuum=True, study_db=None):
+    """Prune checkpoints of deleted threads, keep the newest `keep` per live thread, then vacuum.
+
+    `lock` should be the saver's lock when conn is shared with the running graph.
+    Live threads are read from `study_db` (default: database.DB_NAME).
+    Returns a report dict including reclaimed_bytes.
+    """
+    keep = max(keep, 1)
+    with lock or nullcontext():
+        if not _has_tables(conn):
+            return {"deleted_threads": 0, "deleted_checkpoints": 0, "deleted_writes": 0, "reclaimed_bytes": 0}
+        before = _db_bytes(conn)
+        
+        # Read the live threads only after the stored ones: a thread entry is created before its first
+        # checkpoint, so every thread seen here is already in `live`, even one checkpointed a moment ago
+        # by a saver that does not take `lock` (the async graph, or the server while the CLI runs)
+        stored = {r[0] for r in conn.execute("SELECT DISTINCT thread_id FROM checkpoints")}
+        live = get_all_thread_ids(study_db)
+        if live:
+            orphans = [(t,) for t in stored - live]
+        else:
+            # No threads at all almost always means the wrong study database, not that every user left
+            print("Checkpoint compaction: no live threads found, skipping orphan pruning")
+            orphans = []
+        cur = conn.cursor()
+        cur.executemany("DELETE FROM writes WHERE thread_id=?", orphans)
+        cur.executemany("DELETE FROM checkpoints WHERE thread_id=?", orphans)
+        
+        # checkpoint_id is a time-ordered uuid, so DESC order is newest first
+        deleted_checkpoints = cur.execute("""DELETE FROM checkpoints WHERE rowid IN (
+                                                 SELECT rowid FROM (
+                                                     SELECT rowid, ROW_NUMBER() OVER (
+                                                         PARTITION BY thread_id, checkpoint_ns
+                                                         ORDER BY checkpoint_id DESC) AS rn
+                                                     FROM checkpoints)
+                                                 WHERE rn > ?)""", (keep,)).rowcount
+        deleted_writes = cur.execute("""DELETE FROM writes WHERE NOT EXISTS (
+                                            SELECT 1 FROM checkpoints c
+                                            WHERE c.thread_id = writes.thread_id
+                                              AND c.checkpoint_ns = writes.checkpoint_ns
+                                              AND c.checkpoint_id = writes.checkpoint_id)""").rowcount
+        conn.commit()
+        
+        if vacuum:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                # Switching to incremental mode only takes effect after one full VACUUM
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.execute("VACUUM")
+            else:
+                while conn.execute("PRAGMA freelist_count").fetchone()[0] > 0:
+                    conn.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})")
+            conn.commit()
+        
+        after = _db_bytes(conn)
+    return {
+        "deleted_threads": len(orphans),
+        "deleted_checkpoints": deleted_checkpoints,
+        "deleted_writes": deleted_writes,
+        "reclaimed_bytes": before - after,
+    }
+
+def start_compaction_scheduler(conn, lock=None, interval=CHECKPOINT_COMPACT_INTERVAL, keep=CHECKPOINT_KEEP):
+    """Run compact() every `interval` seconds on a daemon thread."""
+    if interval <= 0:
+        return None
+    
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                report = compact(conn, lock, keep)
+                print(f"Checkpoint compaction: {json.dumps(report)}")
+            except Exception as e:
+                print(f"Checkpoint compaction error: {e}")
+    
+    thread = threading.Thread(target=loop, name="checkpoint-compaction", daemon=True)
+    thread.start()
+    return thread
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compact the LangGraph checkpoint store.")
+    parser.add_argument("--db", default=CHECKPOINT_DB_NAME, help="checkpoint database path")
+    parser.add_argument("--study-db", default=None,
+                        help=f"database holding the threads table (default: {DB_NAME} next to --db)")
+    parser.add_argument("--keep", type=int, default=CHECKPOINT_KEEP, help="checkpoints to keep per live thread")
+    parser.add_argument("--no-vacuum", action="store_true", help="skip reclaiming free pages")
+    args = parser.parse_args(argv)
+    
+    db = os.path.abspath(args.db)
+    study_db = os.path.abspath(args.study_db or os.path.join(os.path.dirname(db), DB_NAME))
+    if not os.path.exists(db):
+        print(f"No checkpoint database at {db}")
+        return 1
+    if not os.path.exists(study_db):
+        print(f"No study database at {study_db}")
+        return 1
+    conn = sqlite3.connect(db, timeout=30)
+    try:
+        report = compact(conn, keep=args.keep, vacuum=not args.no_vacuum, study_db=study_db)
+    finally:
+        conn.close()
+    print(json.dumps(report, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,88 +3,423 @@ import uuid
 import datetime
 import json
 import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import instrument_module
 
 DB_NAME = "study_guide.db"
+CHECKPOINT_DB_NAME = "checkpoints.sqlite"
+
+# One long-lived connection per thread instead of one per helper call.
+# WAL lets readers run alongside the single writer, and busy_timeout makes
+# writers wait for the lock instead of failing with "database is locked".
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "cache_size": -16000,  # negative = KiB, so ~16 MB of page cache per connection
+    "temp_store": "MEMORY",
+}
+
+_local = threading.local()
+
+def _open_conn(db_name):
+    # isolation_level=None leaves transaction control to transaction() below
+    conn = sqlite3.connect(db_name, check_same_thread=False, isolation_level=None, timeout=5)
+    for pragma, value in SQLITE_PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma}={value}")
+    return conn
 
 def get_conn():
-    return sqlite3.connect(DB_NAME, check_same_thread=False)
+    """Return this thread's connection to DB_NAME, opening it on first use."""
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "db_name", None) != DB_NAME:
+        if conn is not None:
+            conn.close()
+        conn = _open_conn(DB_NAME)
+        _local.conn = conn
+        _local.db_name = DB_NAME
+        _local.depth = 0
+    return conn
 
-def init_db():
+def close_conn():
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+@contextmanager
+def transaction(immediate=False):
+    """Run the enclosed statements in a single transaction on the thread's connection.
+
+    Nested uses join the outermost transaction, so helpers can call each other
+    and still commit (or roll back) once. Helpers that write pass immediate=True
+    to take the write lock up front: under WAL a deferred transaction that later
+    writes can fail with SQLITE_BUSY at once instead of waiting out busy_timeout.
+    """
     conn = get_conn()
-    c = conn.cursor()
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS users 
-                 (username TEXT PRIMARY KEY, 
-                  password TEXT,
-                  display_name TEXT,
-                  about TEXT,
-                  strengths TEXT,
-                  weaknesses TEXT,
-                  total_tokens INTEGER DEFAULT 0,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS user_notes
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  username TEXT,
-                  note_date TEXT,
-                  note_text TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (username) REFERENCES users(username))''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS threads 
-                 (id TEXT PRIMARY KEY, 
-                  username TEXT, 
-                  title TEXT, 
-                  chat_mode TEXT DEFAULT 'study',
-                  created_at TIMESTAMP)''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS messages
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  thread_id TEXT,
-                  role TEXT,
-                  content TEXT,
-                  message_type TEXT DEFAULT 'text',
-                  flashcards TEXT,
-                  audio_path TEXT,
-                  tokens_used INTEGER DEFAULT 0,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (thread_id) REFERENCES threads(id))''')
+    outer = _local.depth == 0
+    if outer:
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        _local.immediate = immediate
+    elif immediate and not _local.immediate:
+        # Joining a deferred transaction would silently lose the write lock taken up front
+        raise RuntimeError("write transaction nested in a read transaction; open the outer one with immediate=True")
+    _local.depth += 1
+    try:
+        yield conn
+    except BaseException:
+        _local.depth -= 1
+        if outer:
+            conn.rollback()
+        raise
+    _local.depth -= 1
+    if outer:
+        conn.commit()
+
+def init_db():
+    with transaction(immediate=True) as c:
+        c.execute('''CREATE TABLE IF NOT EXISTS users 
+                     (username TEXT PRIMARY KEY, 
+                      password TEXT,
+                      display_name TEXT,
+                      about TEXT,
+                      strengths TEXT,
+                      weaknesses TEXT,
+                      total_tokens INTEGER DEFAULT 0,
+                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        
+        c.execute('''CREATE TABLE IF NOT EXISTS user_notes
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      username TEXT,
+                      note_date TEXT,
+                      note_text TEXT,
+                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                      FOREIGN KEY (username) REFERENCES users(username))''')
+        
+        c.execute('''CREATE TABLE IF NOT EXISTS threads 
+                     (id TEXT PRIMARY KEY, 
+                      username TEXT, 
+                      title TEXT, 
+                      chat_mode TEXT DEFAULT 'study',
+                      created_at TIMESTAMP)''')
+        
+        c.execute('''CREATE TABLE IF NOT EXISTS messages
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      thread_id TEXT,
+                      role TEXT,
+                      content TEXT,
+                      message_type TEXT DEFAULT 'text',
+                      flashcards TEXT,
+                      audio_path TEXT,
+                      tokens_used INTEGER DEFAULT 0,
+                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                      FOREIGN KEY (thread_id) REFERENCES threads(id))''')
+        
+        c.execute('''CREATE TABLE IF NOT EXISTS uploaded_files
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      username TEXT,
+                      thread_id TEXT,
+                      filename TEXT,
+                      filepath TEXT,
+                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                      FOREIGN KEY (username) REFERENCES users(username),
+                      FOREIGN KEY (thread_id) REFERENCES threads(id))''')
     
-    c.execute('''CREATE TABLE IF NOT EXISTS uploaded_files
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  username TEXT,
-                  thread_id TEXT,
-                  filename TEXT,
-                  filepath TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (username) REFERENCES users(username),
-                  FOREIGN KEY (thread_id) REFERENCES threads(id))''')
+    migrate()
+
+# Ordered schema changes applied on top of the base tables from init_db().
+# Append new (version, description, statements) entries; never edit one that
+# has shipped, since existing databases record it as applied in schema_version.
+MIGRATIONS = [
+    (1, "indexes for thread, file and note lookups", [
+        "CREATE INDEX IF NOT EXISTS idx_messages_thread_created ON messages (thread_id, created_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_threads_user_created ON threads (username, created_at DESC, id, title, chat_mode)",
+        "CREATE INDEX IF NOT EXISTS idx_files_user_thread_created ON uploaded_files (username, thread_id, created_at DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_files_thread_created ON uploaded_files (thread_id, created_at DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_notes_user_date ON user_notes (username, note_date, id, note_text)",
+    ]),
+    (2, "per-page PDF text cache keyed by content hash", [
+        '''CREATE TABLE IF NOT EXISTS pdf_documents
+           (content_hash TEXT PRIMARY KEY,
+            page_count INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+        '''CREATE TABLE IF NOT EXISTS pdf_pages
+           (content_hash TEXT,
+            page_no INTEGER,
+            text TEXT,
+            PRIMARY KEY (content_hash, page_no)) WITHOUT ROWID''',
+    ]),
+    (3, "upload-time PDF ingestion status and text chunks", [
+        '''CREATE TABLE IF NOT EXISTS file_ingestion
+           (file_id INTEGER PRIMARY KEY,
+            status TEXT DEFAULT 'queued',
+            content_hash TEXT,
+            page_count INTEGER,
+            chunk_count INTEGER,
+            metadata TEXT,
+            error TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (file_id) REFERENCES uploaded_files(id))''',
+        "CREATE INDEX IF NOT EXISTS idx_ingestion_status ON file_ingestion (status)",
+        '''CREATE TABLE IF NOT EXISTS pdf_chunks
+           (content_hash TEXT,
+            chunk_no INTEGER,
+            page_start INTEGER,
+            page_end INTEGER,
+            text TEXT,
+            PRIMARY KEY (content_hash, chunk_no)) WITHOUT ROWID''',
+    ]),
+    (4, "persistent LLM response cache", [
+        '''CREATE TABLE IF NOT EXISTS llm_cache
+           (cache_key TEXT PRIMARY KEY,
+            response TEXT,
+            size INTEGER,
+            created_at REAL,
+            last_used REAL)''',
+        "CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache (last_used)",
+    ]),
+    (5, "lookup of messages sharing a cached audio clip", [
+        "CREATE INDEX IF NOT EXISTS idx_messages_audio_path ON messages (audio_path) WHERE audio_path IS NOT NULL",
+    ]),
+    (6, "keep rendered chart URLs with their messages", [
+        "ALTER TABLE messages ADD COLUMN chart_image TEXT",
+    ]),
+    (7, "keyset pagination of thread messages and thread lists", [
+        "CREATE INDEX IF NOT EXISTS idx_messages_thread_id ON messages (thread_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_threads_user_page ON threads (username, created_at DESC, id DESC, title, chat_mode)",
+    ]),
+    (8, "full-text search over messages, notes and PDF pages", [
+        # messages and notes are indexed as external-content tables kept in sync by triggers
+        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, content='messages', content_rowid='id')",
+        '''CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+               INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+               INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN
+               INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+               INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+           END''',
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(note_text, content='user_notes', content_rowid='id')",
+        '''CREATE TRIGGER IF NOT EXISTS notes_fts_ai AFTER INSERT ON user_notes BEGIN
+               INSERT INTO notes_fts (rowid, note_text) VALUES (new.id, new.note_text);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS notes_fts_ad AFTER DELETE ON user_notes BEGIN
+               INSERT INTO notes_fts (notes_fts, rowid, note_text) VALUES ('delete', old.id, old.note_text);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS notes_fts_au AFTER UPDATE OF note_text ON user_notes BEGIN
+               INSERT INTO notes_fts (notes_fts, rowid, note_text) VALUES ('delete', old.id, old.note_text);
+               INSERT INTO notes_fts (rowid, note_text) VALUES (new.id, new.note_text);
+           END''',
+        "INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')",
+        # pdf_pages has no rowid, so its index stores the text itself
+        "CREATE VIRTUAL TABLE IF NOT EXISTS pdf_pages_fts USING fts5(text, content_hash UNINDEXED, page_no UNINDEXED)",
+        '''CREATE TRIGGER IF NOT EXISTS pdf_pages_fts_ai AFTER INSERT ON pdf_pages BEGIN
+               INSERT INTO pdf_pages_fts (text, content_hash, page_no) VALUES (new.text, new.content_hash, new.page_no);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS pdf_pages_fts_ad AFTER DELETE ON pdf_pages BEGIN
+               DELETE FROM pdf_pages_fts WHERE content_hash = old.content_hash AND page_no = old.page_no;
+           END''',
+        "INSERT INTO pdf_pages_fts (text, content_hash, page_no) SELECT text, content_hash, page_no FROM pdf_pages",
+        "CREATE INDEX IF NOT EXISTS idx_ingestion_hash ON file_ingestion (content_hash)",
+    ]),
+    (9, "normalized flashcard and MCQ store with a review schedule", [
+        # due_at and last_reviewed_at are unix seconds; options holds the MCQ choices as JSON
+        '''CREATE TABLE IF NOT EXISTS cards
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            thread_id TEXT,
+            message_id INTEGER,
+            kind TEXT NOT NULL,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            hint TEXT,
+            options TEXT,
+            ease REAL NOT NULL DEFAULT 2.5,
+            interval_days REAL NOT NULL DEFAULT 0,
+            repetitions INTEGER NOT NULL DEFAULT 0,
+            lapses INTEGER NOT NULL DEFAULT 0,
+            due_at REAL NOT NULL,
+            last_reviewed_at REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+        "CREATE INDEX IF NOT EXISTS idx_cards_user_due ON cards (username, due_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_cards_thread ON cards (thread_id)",
+        # Backfill from the JSON blobs; old cards become due from when they were generated
+        '''INSERT INTO cards (username, thread_id, message_id, kind, question, answer, hint, options, due_at)
+           SELECT t.username, m.thread_id, m.id,
+                  CASE WHEN json_extract(j.value, '$.a') IS NULL THEN 'flashcard' ELSE 'mcq' END,
+                  COALESCE(json_extract(j.value, '$.question'), ''), COALESCE(json_extract(j.value, '$.answer'), ''),
+                  json_extract(j.value, '$.hint'),
+                  CASE WHEN json_extract(j.value, '$.a') IS NULL THEN NULL
+                       ELSE json_object('a', json_extract(j.value, '$.a'), 'b', json_extract(j.value, '$.b'),
+                                        'c', json_extract(j.value, '$.c'), 'd', json_extract(j.value, '$.d')) END,
+                  COALESCE(CAST(strftime('%s', m.created_at) AS REAL), CAST(strftime('%s', 'now') AS REAL))
+           FROM messages m JOIN threads t ON t.id = m.thread_id, json_each(m.flashcards) j
+           WHERE m.flashcards IS NOT NULL AND json_valid(m.flashcards) AND t.username IS NOT NULL
+           ORDER BY m.id''',
+    ]),
+    (10, "scope full-text indexes to their owner", [
+        # Each FTS row carries an owner token ('u' + hex of the username) in an indexed column, so a
+        # search intersects the user's doclist inside MATCH instead of ranking every user's rows
+        "DROP TRIGGER IF EXISTS messages_fts_ai",
+        "DROP TRIGGER IF EXISTS messages_fts_ad",
+        "DROP TRIGGER IF EXISTS messages_fts_au",
+        "DROP TRIGGER IF EXISTS notes_fts_ai",
+        "DROP TRIGGER IF EXISTS notes_fts_ad",
+        "DROP TRIGGER IF EXISTS notes_fts_au",
+        "DROP TRIGGER IF EXISTS pdf_pages_fts_ai",
+        "DROP TRIGGER IF EXISTS pdf_pages_fts_ad",
+        "DROP TABLE IF EXISTS messages_fts",
+        "DROP TABLE IF EXISTS notes_fts",
+        "DROP TABLE IF EXISTS pdf_pages_fts",
+        '''CREATE VIEW IF NOT EXISTS messages_search AS
+           SELECT m.id, m.content, 'u' || lower(hex(t.username)) AS owner
+           FROM messages m LEFT JOIN threads t ON t.id = m.thread_id''',
+        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, owner, content='messages_search', content_rowid='id')",
+        '''CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+               INSERT INTO messages_fts (rowid, content, owner)
+               VALUES (new.id, new.content, (SELECT 'u' || lower(hex(username)) FROM threads WHERE id = new.thread_id));
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+               INSERT INTO messages_fts (messages_fts, rowid, content, owner)
+               VALUES ('delete', old.id, old.content, (SELECT 'u' || lower(hex(username)) FROM threads WHERE id = old.thread_id));
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN
+               INSERT INTO messages_fts (messages_fts, rowid, content, owner)
+               VALUES ('delete', old.id, old.content, (SELECT 'u' || lower(hex(username)) FROM threads WHERE id = old.thread_id));
+               INSERT INTO messages_fts (rowid, content, owner)
+               VALUES (new.id, new.content, (SELECT 'u' || lower(hex(username)) FROM threads WHERE id = new.thread_id));
+           END''',
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+        '''CREATE VIEW IF NOT EXISTS notes_search AS
+           SELECT id, note_text, 'u' || lower(hex(username)) AS owner FROM user_notes''',
+        "CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(note_text, owner, content='notes_search', content_rowid='id')",
+        '''CREATE TRIGGER IF NOT EXISTS notes_fts_ai AFTER INSERT ON user_notes BEGIN
+               INSERT INTO notes_fts (rowid, note_text, owner) VALUES (new.id, new.note_text, 'u' || lower(hex(new.username)));
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS notes_fts_ad AFTER DELETE ON user_notes BEGIN
+               INSERT INTO notes_fts (notes_fts, rowid, note_text, owner)
+               VALUES ('delete', old.id, old.note_text, 'u' || lower(hex(old.username)));
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS notes_fts_au AFTER UPDATE OF note_text, username ON user_notes BEGIN
+               INSERT INTO notes_fts (notes_fts, rowid, note_text, owner)
+               VALUES ('delete', old.id, old.note_text, 'u' || lower(hex(old.username)));
+               INSERT INTO notes_fts (rowid, note_text, owner) VALUES (new.id, new.note_text, 'u' || lower(hex(new.username)));
+           END''',
+        "INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')",
+        # PDF pages are shared by content hash, so the index holds one copy per user with a ready upload of it;
+        # the hash is an indexed token too, so a document's rows can be found without a full scan
+        "CREATE VIRTUAL TABLE IF NOT EXISTS pdf_pages_fts USING fts5(text, owner, content_hash, page_no UNINDEXED)",
+        '''CREATE TRIGGER IF NOT EXISTS pdf_pages_fts_ai AFTER INSERT ON pdf_pages BEGIN
+               INSERT INTO pdf_pages_fts (text, owner, content_hash, page_no)
+               SELECT new.text, 'u' || lower(hex(u.username)), new.content_hash, new.page_no
+               FROM (SELECT DISTINCT f.username FROM file_ingestion i JOIN uploaded_files f ON f.id = i.file_id
+                     WHERE i.content_hash = new.content_hash AND i.status = 'ready' AND f.username IS NOT NULL) u;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS pdf_pages_fts_ad AFTER DELETE ON pdf_pages BEGIN
+               DELETE FROM pdf_pages_fts WHERE rowid IN
+                   (SELECT rowid FROM pdf_pages_fts WHERE pdf_pages_fts MATCH 'content_hash : "' || old.content_hash || '"'
+                    AND page_no = old.page_no);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS pdf_pages_fts_ready_ai AFTER INSERT ON file_ingestion
+           WHEN new.status = 'ready' AND new.content_hash IS NOT NULL
+                AND NOT EXISTS (SELECT 1 FROM file_ingestion i JOIN uploaded_files f ON f.id = i.file_id
+                                WHERE i.content_hash = new.content_hash AND i.status = 'ready' AND i.file_id != new.file_id
+                                AND f.username = (SELECT username FROM uploaded_files WHERE id = new.file_id))
+           BEGIN
+               INSERT INTO pdf_pages_fts (text, owner, content_hash, page_no)
+               SELECT p.text, 'u' || lower(hex(f.username)), p.content_hash, p.page_no
+               FROM pdf_pages p JOIN uploaded_files f ON f.id = new.file_id
+               WHERE p.content_hash = new.content_hash AND f.username IS NOT NULL;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS pdf_pages_fts_ready_au AFTER UPDATE OF status, content_hash ON file_ingestion
+           WHEN new.status = 'ready' AND new.content_hash IS NOT NULL
+                AND NOT (old.status = 'ready' AND old.content_hash IS new.content_hash)
+                AND NOT EXISTS (SELECT 1 FROM file_ingestion i JOIN uploaded_files f ON f.id = i.file_id
+                                WHERE i.content_hash = new.content_hash AND i.status = 'ready' AND i.file_id != new.file_id
+                                AND f.username = (SELECT username FROM uploaded_files WHERE id = new.file_id))
+           BEGIN
+               INSERT INTO pdf_pages_fts (text, owner, content_hash, page_no)
+               SELECT p.text, 'u' || lower(hex(f.username)), p.content_hash, p.page_no
+               FROM pdf_pages p JOIN uploaded_files f ON f.id = new.file_id
+               WHERE p.content_hash = new.content_hash AND f.username IS NOT NULL;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS pdf_pages_fts_unready_au AFTER UPDATE OF status, content_hash ON file_ingestion
+           WHEN old.status = 'ready' AND old.content_hash IS NOT NULL
+                AND NOT (new.status = 'ready' AND new.content_hash IS old.content_hash)
+                AND NOT EXISTS (SELECT 1 FROM file_ingestion i JOIN uploaded_files f ON f.id = i.file_id
+                                WHERE i.content_hash = old.content_hash AND i.status = 'ready' AND i.file_id != old.file_id
+                                AND f.username = (SELECT username FROM uploaded_files WHERE id = old.file_id))
+           BEGIN
+               DELETE FROM pdf_pages_fts WHERE rowid IN
+                   (SELECT rowid FROM pdf_pages_fts WHERE pdf_pages_fts MATCH
+                       'content_hash : "' || old.content_hash || '" AND owner : "u' ||
+                       (SELECT lower(hex(username)) FROM uploaded_files WHERE id = old.file_id) || '"');
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS pdf_pages_fts_ready_ad AFTER DELETE ON file_ingestion
+           WHEN old.status = 'ready' AND old.content_hash IS NOT NULL
+                AND NOT EXISTS (SELECT 1 FROM file_ingestion i JOIN uploaded_files f ON f.id = i.file_id
+                                WHERE i.content_hash = old.content_hash AND i.status = 'ready'
+                                AND f.username = (SELECT username FROM uploaded_files WHERE id = old.file_id))
+           BEGIN
+               DELETE FROM pdf_pages_fts WHERE rowid IN
+                   (SELECT rowid FROM pdf_pages_fts WHERE pdf_pages_fts MATCH
+                       'content_hash : "' || old.content_hash || '" AND owner : "u' ||
+                       (SELECT lower(hex(username)) FROM uploaded_files WHERE id = old.file_id) || '"');
+           END''',
+        '''INSERT INTO pdf_pages_fts (text, owner, content_hash, page_no)
+           SELECT p.text, 'u' || lower(hex(u.username)), p.content_hash, p.page_no
+           FROM (SELECT DISTINCT i.content_hash, f.username FROM file_ingestion i JOIN uploaded_files f ON f.id = i.file_id
+                 WHERE i.status = 'ready' AND i.content_hash IS NOT NULL AND f.username IS NOT NULL) u
+           JOIN pdf_pages p ON p.content_hash = u.content_hash''',
+    ]),
+]
+
+def get_schema_version():
+    with transaction() as conn:
+        return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+def migrate():
+    """Apply pending MIGRATIONS in order, one transaction per step."""
+    with transaction(immediate=True) as conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                        (version INTEGER PRIMARY KEY,
+                         description TEXT,
+                         applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
     
-    conn.commit()
-    conn.close()
+    for version, description, statements in MIGRATIONS:
+        with transaction(immediate=True) as conn:
+            applied = conn.execute("SELECT 1 FROM schema_version WHERE version=?", (version,)).fetchone()
+            if applied:
+                continue
+            for sql in statements:
+                conn.execute(sql)
+            conn.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)", (version, description))
+            print(f"Applied schema migration {version}: {description}")
 
 def register_user(username, password):
     try:
-        conn = get_conn()
-        conn.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password))
-        conn.commit()
+        with transaction(immediate=True) as conn:
+            conn.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password))
         return True
     except sqlite3.IntegrityError:
         return False
-    finally:
-        conn.close()
 
 def verify_user(username, password):
-    conn = get_conn()
-    res = conn.execute("SELECT * FROM users WHERE username=? AND password=?", (username, password)).fetchone()
-    conn.close()
+    with transaction() as conn:
+        res = conn.execute("SELECT * FROM users WHERE username=? AND password=?", (username, password)).fetchone()
     return res is not None
 
 def get_user_profile(username):
-    conn = get_conn()
-    res = conn.execute("""SELECT username, display_name, about, strengths, weaknesses, total_tokens 
-                          FROM users WHERE username=?""", (username,)).fetchone()
-    conn.close()
+    with transaction() as conn:
+        res = conn.execute("""SELECT username, display_name, about, strengths, weaknesses, total_tokens 
+                              FROM users WHERE username=?""", (username,)).fetchone()
     if res:
         return {
             "username": res[0],
@@ -97,93 +432,164 @@ def get_user_profile(username):
     return None
 
 def update_user_profile(username, display_name, about, strengths, weaknesses):
-    conn = get_conn()
-    conn.execute("""UPDATE users SET display_name=?, about=?, strengths=?, weaknesses=? 
-                    WHERE username=?""", (display_name, about, strengths, weaknesses, username))
-    conn.commit()
-    conn.close()
+    with transaction(immediate=True) as conn:
+        conn.execute("""UPDATE users SET display_name=?, about=?, strengths=?, weaknesses=? 
+                        WHERE username=?""", (display_name, about, strengths, weaknesses, username))
 
 def add_user_tokens(username, tokens):
-    conn = get_conn()
-    conn.execute("UPDATE users SET total_tokens = total_tokens + ? WHERE username=?", (tokens, username))
-    conn.commit()
-    conn.close()
+    with transaction(immediate=True) as conn:
+        conn.execute("UPDATE users SET total_tokens = total_tokens + ? WHERE username=?", (tokens, username))
 
 def get_user_notes(username):
-    conn = get_conn()
-    rows = conn.execute("""SELECT id, note_date, note_text FROM user_notes 
-                           WHERE username=? ORDER BY note_date ASC""", (username,)).fetchall()
-    conn.close()
+    with transaction() as conn:
+        rows = conn.execute("""SELECT id, note_date, note_text FROM user_notes 
+                               WHERE username=? ORDER BY note_date ASC""", (username,)).fetchall()
     return [{"id": r[0], "date": r[1], "text": r[2]} for r in rows]
 
 def add_user_note(username, note_date, note_text):
-    conn = get_conn()
-    conn.execute("INSERT INTO user_notes (username, note_date, note_text) VALUES (?, ?, ?)",
-                 (username, note_date, note_text))
-    conn.commit()
-    conn.close()
+    with transaction(immediate=True) as conn:
+        conn.execute("INSERT INTO user_notes (username, note_date, note_text) VALUES (?, ?, ?)",
+                     (username, note_date, note_text))
 
 def delete_user_note(note_id):
-    conn = get_conn()
-    conn.execute("DELETE FROM user_notes WHERE id=?", (note_id,))
-    conn.commit()
-    conn.close()
+    """Delete a note and return the username it belonged to (None if it did not exist)."""
+    with transaction(immediate=True) as conn:
+        row = conn.execute("SELECT username FROM user_notes WHERE id=?", (note_id,)).fetchone()
+        conn.execute("DELETE FROM user_notes WHERE id=?", (note_id,))
+    return row[0] if row else None
 
 def create_thread_entry(username, thread_id, first_message, chat_mode="study"):
-    conn = get_conn()
     title = (first_message[:30] + '...') if len(first_message) > 30 else first_message
-    conn.execute("INSERT OR IGNORE INTO threads VALUES (?, ?, ?, ?, ?)", 
-                 (thread_id, username, title, chat_mode, datetime.datetime.now()))
-    conn.commit()
-    conn.close()
+    with transaction(immediate=True) as conn:
+        conn.execute("INSERT OR IGNORE INTO threads VALUES (?, ?, ?, ?, ?)", 
+                     (thread_id, username, title, chat_mode, datetime.datetime.now()))
 
 def get_user_threads(username):
-    conn = get_conn()
-    threads = conn.execute("""SELECT id, title, chat_mode FROM threads 
-                              WHERE username=? ORDER BY created_at DESC""", (username,)).fetchall()
-    conn.close()
+    with transaction() as conn:
+        threads = conn.execute("""SELECT id, title, chat_mode FROM threads 
+                                  WHERE username=? ORDER BY created_at DESC""", (username,)).fetchall()
     return [{"id": t[0], "title": t[1], "mode": t[2] or "study"} for t in threads]
 
+def get_user_threads_page(username, cursor=None, limit=30):
+    """Newest-first page of a user's threads. cursor is the (created_at, id) of the last thread already shown.
+
+    Returns (threads, next_cursor); next_cursor is None on the last page.
+    """
+    with transaction() as conn:
+        if cursor:
+            rows = conn.execute("""SELECT id, title, chat_mode, created_at FROM threads 
+                                   WHERE username=? AND (created_at < ? OR (created_at = ? AND id < ?))
+                                   ORDER BY created_at DESC, id DESC LIMIT ?""",
+                                (username, cursor[0], cursor[0], cursor[1], limit + 1)).fetchall()
+        else:
+            rows = conn.execute("""SELECT id, title, chat_mode, created_at FROM threads 
+                                   WHERE username=? ORDER BY created_at DESC, id DESC LIMIT ?""",
+                                (username, limit + 1)).fetchall()
+    next_cursor = (rows[limit - 1][3], rows[limit - 1][0]) if len(rows) > limit else None
+    return [{"id": t[0], "title": t[1], "mode": t[2] or "study"} for t in rows[:limit]], next_cursor
+
+def get_all_thread_ids(db_name=None):
+    """Return every thread id, from db_name opened read-only when given, else from DB_NAME."""
+    if db_name is None:
+        with transaction() as conn:
+            rows = conn.execute("SELECT id FROM threads").fetchall()
+        return {r[0] for r in rows}
+    # Read-only so a wrong path fails instead of creating an empty database
+    conn = sqlite3.connect(f"file:{os.path.abspath(db_name)}?mode=ro", uri=True, timeout=5)
+    try:
+        return {r[0] for r in conn.execute("SELECT id FROM threads")}
+    finally:
+        conn.close()
+
 def update_thread_title(thread_id, new_title):
-    conn = get_conn()
-    conn.execute("UPDATE threads SET title=? WHERE id=?", (new_title, thread_id))
-    conn.commit()
-    conn.close()
+    with transaction(immediate=True) as conn:
+        conn.execute("UPDATE threads SET title=? WHERE id=?", (new_title, thread_id))
 
 def delete_thread_entry(thread_id):
-    conn = get_conn()
-    # Delete associated voice files
-    rows = conn.execute("SELECT audio_path FROM messages WHERE thread_id=?", (thread_id,)).fetchall()
-    for row in rows:
-        if row[0] and os.path.exists(row[0]):
-            os.remove(row[0])
-    
-    # Delete associated PDF files
-    rows = conn.execute("SELECT filepath FROM uploaded_files WHERE thread_id=?", (thread_id,)).fetchall()
-    for row in rows:
-        if row[0] and os.path.exists(row[0]):
-            os.remove(row[0])
-            
-    conn.execute("DELETE FROM uploaded_files WHERE thread_id=?", (thread_id,))
-    conn.execute("DELETE FROM messages WHERE thread_id=?", (thread_id,))
-    conn.execute("DELETE FROM threads WHERE id=?", (thread_id,))
-    conn.commit()
-    conn.close()
-
-def save_message(thread_id, role, content, message_type="text", flashcards=None, audio_path=None, tokens_used=0):
-    conn = get_conn()
+    with transaction(immediate=True) as conn:
+        # Delete associated voice files, unless another thread reuses the same cached clip
+        rows = conn.execute("""SELECT DISTINCT audio_path FROM messages m WHERE thread_id=? AND audio_path IS NOT NULL
+                               AND NOT EXISTS (SELECT 1 FROM messages o WHERE o.audio_path = m.audio_path
+                                               AND o.thread_id != m.thread_id)""", (thread_id,)).fetchall()
+        for row in rows:
+            if row[0] and os.path.exists(row[0]):
+                os.remove(row[0])
+        
+        # Delete associated PDF files
+        rows = conn.execute("SELECT filepath FROM uploaded_files WHERE thread_id=?", (thread_id,)).fetchall()
+        for row in rows:
+            if row[0] and os.path.exists(row[0]):
+                os.remove(row[0])
+                
+        conn.execute("""DELETE FROM file_ingestion WHERE file_id IN 
+                        (SELECT id FROM uploaded_files WHERE thread_id=?)""", (thread_id,))
+        conn.execute("DELETE FROM uploaded_files WHERE thread_id=?", (thread_id,))
+        conn.execute("DELETE FROM cards WHERE thread_id=?", (thread_id,))
+        conn.execute("DELETE FROM messages WHERE thread_id=?", (thread_id,))
+        conn.execute("DELETE FROM threads WHERE id=?", (thread_id,))
+
+def save_message(thread_id, role, content, message_type="text", flashcards=None, audio_path=None, tokens_used=0,
+                 chart_image=None):
     flashcards_json = json.dumps(flashcards) if flashcards else None
-    conn.execute("""INSERT INTO messages (thread_id, role, content, message_type, flashcards, audio_path, tokens_used)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)""",
-                 (thread_id, role, content, message_type, flashcards_json, audio_path, tokens_used))
-    conn.commit()
-    conn.close()
+    with transaction(immediate=True) as conn:
+        cur = conn.execute("""INSERT INTO messages (thread_id, role, content, message_type, flashcards, audio_path, tokens_used, chart_image)
+                              VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                           (thread_id, role, content, message_type, flashcards_json, audio_path, tokens_used, chart_image))
+        if flashcards:
+            _save_cards(conn, thread_id, cur.lastrowid, flashcards)
+
+def _save_cards(conn, thread_id, message_id, items):
+    """Copy generated flashcards and MCQs into cards, due for review straight away."""
+    row = conn.execute("SELECT username FROM threads WHERE id=?", (thread_id,)).fetchone()
+    if not row or not row[0]:
+        return
+    now = time.time()
+    rows = []
+    for item in items:
+        options = None
+        if "a" in item:
+            options = json.dumps({k: item.get(k) for k in ("a", "b", "c", "d")})
+        rows.append((row[0], thread_id, message_id, "mcq" if options else "flashcard", item.get("question") or "",
+                     item.get("answer") or "", item.get("hint"), options, now))
+    conn.executemany("""INSERT INTO cards (username, thread_id, message_id, kind, question, answer, hint, options, due_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+
+def _message_from_row(r):
+    msg = {"id": r[0], "role": r[1], "content": r[2], "type": r[3]}
+    if r[4]:
+        msg["flashcards"] = json.loads(r[4])
+    if r[5]:
+        msg["audio_path"] = r[5]
+    if r[6]:
+        msg["chart_image"] = r[6]
+    return msg
+
+def get_thread_messages_page(thread_id, before_id=None, after_id=None, limit=50):
+    """Return up to `limit` messages of a thread in chronological order, keyed on message id.
+
+    With before_id, the page ends just before that message (scrolling back); with
+    after_id it starts just after it; with neither it is the newest messages.
+    Returns (messages, has_more) where has_more means more exist in the paging direction.
+    """
+    cols = "id, role, content, message_type, flashcards, audio_path, chart_image"
+    with transaction() as conn:
+        if after_id is not None:
+            rows = conn.execute(f"""SELECT {cols} FROM messages WHERE thread_id=? AND id > ? 
+                                    ORDER BY id ASC LIMIT ?""", (thread_id, after_id, limit + 1)).fetchall()
+        else:
+            rows = conn.execute(f"""SELECT {cols} FROM messages WHERE thread_id=? AND id < ? 
+                                    ORDER BY id DESC LIMIT ?""",
+                                (thread_id, before_id if before_id is not None else 2**63 - 1, limit + 1)).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after_id is None:
+        rows.reverse()
+    return [_message_from_row(r) for r in rows], has_more
 
 def get_thread_messages(thread_id):
-    conn = get_conn()
-    rows = conn.execute("""SELECT role, content, message_type, flashcards, audio_path 
-                           FROM messages WHERE thread_id=? ORDER BY created_at ASC""", (thread_id,)).fetchall()
-    conn.close()
+    with transaction() as conn:
+        rows = conn.execute("""SELECT role, content, message_type, flashcards, audio_path, chart_image 
+                               FROM messages WHERE thread_id=? ORDER BY created_at ASC, id ASC""", (thread_id,)).fetchall()
     messages = []
     for r in rows:
         msg = {"role": r[0], "content": r[1], "type": r[2]}
@@ -191,54 +597,290 @@ def get_thread_messages(thread_id):
             msg["flashcards"] = json.loads(r[3])
         if r[4]:
             msg["audio_path"] = r[4]
+        if r[5]:
+            msg["chart_image"] = r[5]
         messages.append(msg)
     return messages
 
 def save_uploaded_file(username, filename, filepath, thread_id=None):
-    conn = get_conn()
-    conn.execute("INSERT INTO uploaded_files (username, thread_id, filename, filepath) VALUES (?, ?, ?, ?)",
-                 (username, thread_id, filename, filepath))
-    conn.commit()
-    conn.close()
+    with transaction(immediate=True) as conn:
+        cur = conn.execute("INSERT INTO uploaded_files (username, thread_id, filename, filepath) VALUES (?, ?, ?, ?)",
+                           (username, thread_id, filename, filepath))
+    return cur.lastrowid
+
+def link_pending_files(username, thread_id):
+    """Attach files uploaded before the thread existed to the new thread."""
+    with transaction(immediate=True) as conn:
+        conn.execute("UPDATE uploaded_files SET thread_id=? WHERE username=? AND thread_id IS NULL",
+                     (thread_id, username))
 
 def delete_uploaded_file_by_id(file_id):
-    conn = get_conn()
-    row = conn.execute("SELECT filepath FROM uploaded_files WHERE id=?", (file_id,)).fetchone()
-    if row and row[0]:
-        if os.path.exists(row[0]):
-            os.remove(row[0])
-    conn.execute("DELETE FROM uploaded_files WHERE id=?", (file_id,))
-    conn.commit()
-    conn.close()
+    """Delete an uploaded file and return the username it belonged to (None if it did not exist)."""
+    with transaction(immediate=True) as conn:
+        row = conn.execute("SELECT filepath, username FROM uploaded_files WHERE id=?", (file_id,)).fetchone()
+        if row and row[0]:
+            if os.path.exists(row[0]):
+                os.remove(row[0])
+        conn.execute("DELETE FROM file_ingestion WHERE file_id=?", (file_id,))
+        conn.execute("DELETE FROM uploaded_files WHERE id=?", (file_id,))
+    return row[1] if row else None
 
 def get_user_files(username, thread_id=None):
-    conn = get_conn()
-    if thread_id:
-        rows = conn.execute("""SELECT id, filename, filepath FROM uploaded_files 
-                               WHERE username=? AND thread_id=? ORDER BY created_at DESC""", (username, thread_id)).fetchall()
-    else:
-        # On new chat (thread_id=None), we only want files that aren't attached to any thread yet
-        rows = conn.execute("""SELECT id, filename, filepath FROM uploaded_files 
-                               WHERE username=? AND thread_id IS NULL ORDER BY created_at DESC""", (username,)).fetchall()
-    conn.close()
+    with transaction() as conn:
+        if thread_id:
+            rows = conn.execute("""SELECT id, filename, filepath FROM uploaded_files 
+                                   WHERE username=? AND thread_id=? ORDER BY created_at DESC""", (username, thread_id)).fetchall()
+        else:
+            # On new chat (thread_id=None), we only want files that aren't attached to any thread yet
+            rows = conn.execute("""SELECT id, filename, filepath FROM uploaded_files 
+                                   WHERE username=? AND thread_id IS NULL ORDER BY created_at DESC""", (username,)).fetchall()
     return [{"id": r[0], "filename": r[1], "filepath": r[2]} for r in rows]
 
 def delete_uploaded_file(file_id):
-    conn = get_conn()
-    row = conn.execute("SELECT filepath FROM uploaded_files WHERE id=?", (file_id,)).fetchone()
-    if row and row[0]:
-        import os
-        if os.path.exists(row[0]):
-            os.remove(row[0])
-    conn.execute("DELETE FROM uploaded_files WHERE id=?", (file_id,))
-    conn.commit()
-    conn.close()
+    delete_uploaded_file_by_id(file_id)
 
 def get_thread_files(thread_id):
-    conn = get_conn()
-    rows = conn.execute("""SELECT id, filename, filepath FROM uploaded_files 
-                           WHERE thread_id=? ORDER BY created_at DESC""", (thread_id,)).fetchall()
-    conn.close()
+    with transaction() as conn:
+        rows = conn.execute("""SELECT id, filename, filepath FROM uploaded_files 
+                               WHERE thread_id=? ORDER BY created_at DESC""", (thread_id,)).fetchall()
     return [{"id": r[0], "filename": r[1], "filepath": r[2]} for r in rows]
 
+def get_chat_context(username, thread_id, today, max_notes=5):
+    """Load everything the system prompt needs for a turn in a single read transaction."""
+    with transaction() as conn:
+        res = conn.execute("""SELECT username, display_name, about, strengths, weaknesses 
+                              FROM users WHERE username=?""", (username,)).fetchone()
+        notes = conn.execute("""SELECT id, note_date, note_text FROM user_notes 
+                                WHERE username=? AND note_date >= ? ORDER BY note_date ASC LIMIT ?""",
+                             (username, today, max_notes)).fetchall()
+        files = conn.execute("""SELECT id, filename, filepath FROM uploaded_files 
+                                WHERE thread_id=? ORDER BY created_at DESC""", (thread_id,)).fetchall() if thread_id else []
+    profile = {}
+    if res:
+        profile = {
+            "username": res[0],
+            "display_name": res[1] or res[0],
+            "about": res[2] or "",
+            "strengths": res[3] or "",
+            "weaknesses": res[4] or ""
+        }
+    return {
+        "user_profile": profile,
+        "user_notes": [{"id": r[0], "date": r[1], "text": r[2]} for r in notes],
+        "user_files": [{"id": r[0], "filename": r[1], "filepath": r[2]} for r in files],
+    }
+
+def fts_query(text):
+    """Turn free text into a safe FTS5 query: every word must match, the last one as a prefix."""
+    words = re.findall(r"\w+", text or "")
+    if not words:
+        return None
+    terms = [f'"{w}"' for w in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+def owner_token(username):
+    """The token FTS rows of a user are tagged with; matches 'u' || lower(hex(username)) in the triggers."""
+    return "u" + username.encode("utf-8").hex()
+
+def _relative_scores(rows, rank_col):
+    """bm25 scores are only comparable within one index; rescale each source so its best match is 1."""
+    best = rows[0][rank_col] if rows else 0
+    return [round(r[rank_col] / best, 4) if best else 1.0 for r in rows]
+
+def search_user_content(username, query, limit=20):
+    """Ranked full-text matches across a user's messages, notes and ingested PDFs.
+
+    Each result has a kind ('message', 'note' or 'pdf'), an anchor to open it
+    (thread/message id, note id, or file id and page) and a highlighted snippet.
+    Each source is ranked by its own bm25; score rescales that to (0, 1] per
+    source, with 1 for the source's best match, and results are merged on it.
+    """
+    terms = fts_query(query)
+    if not terms or not username:
+        return []
+    owner = f'owner : "{owner_token(username)}"'
+    with transaction() as conn:
+        messages = conn.execute("""SELECT m.id, m.thread_id, t.title, m.role,
+                                          snippet(messages_fts, 0, '[', ']', '...', 12), bm25(messages_fts, 1.0, 0.0)
+                                   FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+                                   JOIN threads t ON t.id = m.thread_id
+                                   WHERE messages_fts MATCH ?
+                                   ORDER BY bm25(messages_fts, 1.0, 0.0) LIMIT ?""",
+                                (f"{owner} AND content : ({terms})", limit)).fetchall()
+        notes = conn.execute("""SELECT n.id, n.note_date, snippet(notes_fts, 0, '[', ']', '...', 12),
+                                       bm25(notes_fts, 1.0, 0.0)
+                                FROM notes_fts JOIN user_notes n ON n.id = notes_fts.rowid
+                                WHERE notes_fts MATCH ?
+                                ORDER BY bm25(notes_fts, 1.0, 0.0) LIMIT ?""",
+                             (f"{owner} AND note_text : ({terms})", limit)).fetchall()
+        pdfs = conn.execute("""SELECT f.id, f.filename, f.thread_id, p.page_no, p.snip, p.rank
+                               FROM (SELECT content_hash, page_no, snippet(pdf_pages_fts, 0, '[', ']', '...', 12) AS snip,
+                                            bm25(pdf_pages_fts, 1.0, 0.0, 0.0) AS rank
+                                     FROM pdf_pages_fts WHERE pdf_pages_fts MATCH ?
+                                     ORDER BY rank LIMIT ?) p
+                               JOIN file_ingestion i ON i.content_hash = p.content_hash AND i.status = 'ready'
+                               JOIN uploaded_files f ON f.id = i.file_id AND f.username = ?
+                               GROUP BY p.content_hash, p.page_no
+                               ORDER BY p.rank""", (f"{owner} AND text : ({terms})", limit, username)).fetchall()
+    results = [{"kind": "message", "message_id": r[0], "thread_id": r[1], "thread_title": r[2], "role": r[3],
+                "snippet": r[4], "score": score} for r, score in zip(messages, _relative_scores(messages, 5))]
+    results += [{"kind": "note", "note_id": r[0], "date": r[1], "snippet": r[2], "score": score}
+                for r, score in zip(notes, _relative_scores(notes, 3))]
+    results += [{"kind": "pdf", "file_id": r[0], "filename": r[1], "thread_id": r[2], "page": r[3] + 1,
+                 "snippet": r[4], "score": score} for r, score in zip(pdfs, _relative_scores(pdfs, 5))]
+    # Stable sort keeps each source's own bm25 order among equal scores
+    results.sort(key=lambda r: -r["score"])
+    return results[:limit]
+
+def get_cached_pdf_pages(content_hash):
+    """Return the cached page texts for a PDF digest, or None if it was never extracted."""
+    with transaction() as conn:
+        doc = conn.execute("SELECT page_count FROM pdf_documents WHERE content_hash=?", (content_hash,)).fetchone()
+        if not doc:
+            return None
+        rows = conn.execute("""SELECT text FROM pdf_pages WHERE content_hash=? 
+                               ORDER BY page_no ASC""", (content_hash,)).fetchall()
+    return [r[0] for r in rows]
+
+def save_cached_pdf_pages(content_hash, pages):
+    with transaction(immediate=True) as conn:
+        conn.execute("INSERT OR REPLACE INTO pdf_documents (content_hash, page_count) VALUES (?, ?)",
+                     (content_hash, len(pages)))
+        # An explicit DELETE fires the pdf_pages_fts delete trigger; OR REPLACE would not
+        # (without recursive_triggers) and would leave the old pages in the index
+        conn.execute("DELETE FROM pdf_pages WHERE content_hash=?", (content_hash,))
+        conn.executemany("INSERT INTO pdf_pages (content_hash, page_no, text) VALUES (?, ?, ?)",
+                         [(content_hash, i, text) for i, text in enumerate(pages)])
+
+def set_ingestion_status(file_id, status, content_hash=None, page_count=None, chunk_count=None,
+                         metadata=None, error=None):
+    with transaction(immediate=True) as conn:
+        conn.execute("""INSERT INTO file_ingestion 
+                        (file_id, status, content_hash, page_count, chunk_count, metadata, error, updated_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                        ON CONFLICT(file_id) DO UPDATE SET
+                            status=excluded.status,
+                            content_hash=COALESCE(excluded.content_hash, content_hash),
+                            page_count=COALESCE(excluded.page_count, page_count),
+                            chunk_count=COALESCE(excluded.chunk_count, chunk_count),
+                            metadata=COALESCE(excluded.metadata, metadata),
+                            error=excluded.error,
+                            updated_at=CURRENT_TIMESTAMP""",
+                     (file_id, status, content_hash, page_count, chunk_count,
+                      json.dumps(metadata) if metadata is not None else None, error))
+
+def get_pending_ingestions():
+    with transaction() as conn:
+        rows = conn.execute("""SELECT f.id, f.filepath FROM file_ingestion i 
+                               JOIN uploaded_files f ON f.id = i.file_id
+                               WHERE i.status IN ('queued', 'processing')""").fetchall()
+    return [{"id": r[0], "filepath": r[1]} for r in rows]
+
+def get_file_statuses(username, thread_id=None):
+    with transaction() as conn:
+        rows = conn.execute("""SELECT f.id, f.filename, i.status, i.page_count, i.chunk_count, i.metadata, i.error
+                               FROM uploaded_files f LEFT JOIN file_ingestion i ON i.file_id = f.id
+                               WHERE f.username=? AND f.thread_id IS ? ORDER BY f.created_at DESC""",
+                            (username, thread_id)).fetchall()
+    return [{"id": r[0], "filename": r[1], "status": r[2] or "unknown", "page_count": r[3],
+             "chunk_count": r[4], "metadata": json.loads(r[5]) if r[5] else {}, "error": r[6]} for r in rows]
+
+def save_pdf_chunks(content_hash, chunks):
+    with transaction(immediate=True) as conn:
+        conn.execute("DELETE FROM pdf_chunks WHERE content_hash=?", (content_hash,))
+        conn.executemany("""INSERT INTO pdf_chunks (content_hash, chunk_no, page_start, page_end, text)
+                            VALUES (?, ?, ?, ?, ?)""",
+                         [(content_hash, i, c["page_start"], c["page_end"], c["text"]) for i, c in enumerate(chunks)])
+
+def get_pdf_chunks(content_hash):
+    with transaction() as conn:
+        rows = conn.execute("""SELECT chunk_no, page_start, page_end, text FROM pdf_chunks 
+                               WHERE content_hash=? ORDER BY chunk_no ASC""", (content_hash,)).fetchall()
+    return [{"chunk_no": r[0], "page_start": r[1], "page_end": r[2], "text": r[3]} for r in rows]
+
+# last_used only matters to evict_llm_cache, so hits are noted in memory and written in batches
+# instead of putting every lookup behind the write lock
+LLM_CACHE_TOUCH_BATCH = 64
+_cache_touches = {}
+_cache_touches_lock = threading.Lock()
+
+def get_llm_cache(cache_key, min_created_at):
+    with transaction() as conn:
+        row = conn.execute("SELECT response FROM llm_cache WHERE cache_key=? AND created_at >= ?",
+                           (cache_key, min_created_at)).fetchone()
+    if row:
+        with _cache_touches_lock:
+            _cache_touches[cache_key] = time.time()
+            full = len(_cache_touches) >= LLM_CACHE_TOUCH_BATCH
+        if full:
+            _flush_llm_cache_touches()
+    return row[0] if row else None
+
+def _flush_llm_cache_touches():
+    with _cache_touches_lock:
+        touches = [(used, key) for key, used in _cache_touches.items()]
+        _cache_touches.clear()
+    if touches:
+        with transaction(immediate=True) as conn:
+            conn.executemany("UPDATE llm_cache SET last_used=MAX(last_used, ?) WHERE cache_key=?", touches)
+
+def put_llm_cache(cache_key, response):
+    now = time.time()
+    with transaction(immediate=True) as conn:
+        conn.execute("""INSERT OR REPLACE INTO llm_cache (cache_key, response, size, created_at, last_used)
+                        VALUES (?, ?, ?, ?, ?)""", (cache_key, response, len(response), now, now))
+
+def evict_llm_cache(max_bytes, min_created_at):
+    """Drop expired entries, then least-recently-used ones until the cache fits in max_bytes."""
+    _flush_llm_cache_touches()
+    with transaction(immediate=True) as conn:
+        removed = conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (min_created_at,)).rowcount
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        if total > max_bytes:
+            rows = conn.execute("SELECT cache_key, size FROM llm_cache ORDER BY last_used ASC").fetchall()
+            stale = []
+            for key, size in rows:
+                if total <= max_bytes:
+                    break
+                stale.append((key,))
+                total -= size
+            conn.executemany("DELETE FROM llm_cache WHERE cache_key=?", stale)
+            removed += len(stale)
+    return removed
+
+CARD_COLUMNS = ("id, kind, question, answer, hint, options, ease, interval_days, repetitions, lapses, "
+                "due_at, last_reviewed_at, thread_id")
+
+def _card_from_row(r):
+    return {"id": r[0], "kind": r[1], "question": r[2], "answer": r[3], "hint": r[4],
+            "options": json.loads(r[5]) if r[5] else None, "ease": r[6], "interval_days": r[7],
+            "repetitions": r[8], "lapses": r[9], "due_at": r[10], "last_reviewed_at": r[11], "thread_id": r[12]}
+
+def get_review_queue(username, limit=20):
+    """Return a user's cards in due order from one range scan of idx_cards_user_due.
+
+    The caller splits off the ones due now; the first card that is not due yet
+    tells it when the next one will be.
+    """
+    with transaction() as conn:
+        rows = conn.execute(f"""SELECT {CARD_COLUMNS} FROM cards WHERE username=?
+                                ORDER BY due_at ASC, id ASC LIMIT ?""", (username, limit)).fetchall()
+    return [_card_from_row(r) for r in rows]
+
+def get_card(username, card_id):
+    with transaction() as conn:
+        row = conn.execute(f"SELECT {CARD_COLUMNS} FROM cards WHERE id=? AND username=?",
+                           (card_id, username)).fetchone()
+    return _card_from_row(row) if row else None
+
+def update_card_schedule(card_id, ease, interval_days, repetitions, lapses, due_at, reviewed_at):
+    with transaction(immediate=True) as conn:
+        conn.execute("""UPDATE cards SET ease=?, interval_days=?, repetitions=?, lapses=?, due_at=?, last_reviewed_at=?
+                        WHERE id=?""", (ease, interval_days, repetitions, lapses, due_at, reviewed_at, card_id))
+
+# Time every public helper; connection plumbing and schema setup are left out
+instrument_module(globals(), "db", skip=("get_conn", "close_conn", "transaction", "init_db", "migrate",
+                                         "get_schema_version", "fts_query", "owner_token"))
+
 init_db()
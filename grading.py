@@ -0,0 +1,157 @@
+"""Grading for /api/score-test.
+
+MCQ, true/false and short answers that match the key after normalization are
+graded locally, with no model call. Only free-text answers that do not match
+go to the model, in parallel batches with a structured-output schema.
+"""
+import os
+import re
+import contextvars
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.messages import HumanMessage
+from pydantic import BaseModel, Field
+
+from admission import AdmissionRejected
+from llm import get_model
+from llm_cache import cached
+
+GRADE_BATCH_SIZE = int(os.environ.get("GRADE_BATCH_SIZE", "8"))
+GRADE_CONCURRENCY = int(os.environ.get("GRADE_CONCURRENCY", "4"))
+# Answer types whose key is the only acceptable answer, so a mismatch is simply wrong
+EXACT_TYPES = {"mcq", "exact", "true_false", "boolean", "number"}
+MCQ_OPTION = re.compile(r"^\(?([a-d])\b[).:]?", re.IGNORECASE)
+ARTICLES = re.compile(r"\b(a|an|the)\b")
+# Punctuation to drop, keeping signs, decimal points, fractions and separators that lead into a digit
+PUNCTUATION = re.compile(r"[.,/-](?!\d)|[^\w\s.,/-]|_")
+NUMBER = re.compile(r"[-+]?(\d+\.?\d*|\.\d+)(/[-+]?(\d+\.?\d*|\.\d+))?")
+THOUSANDS = re.compile(r"[-+]?\d{1,3}(,\d{3})+(\.\d*)?")
+TRUE_WORDS = {"true", "t", "yes", "y"}
+FALSE_WORDS = {"false", "f", "no", "n"}
+
+class AnswerGrade(BaseModel):
+    index: int = Field(description="The number of the answer being graded, as given in the prompt")
+    correct: bool = Field(description="Whether the student answer is essentially correct")
+    credit: float = Field(description="Partial credit between 0 and 1")
+    comment: str = Field(description="One short sentence of feedback for the student")
+
+class GradeBatch(BaseModel):
+    grades: List[AnswerGrade] = Field(description="One grade per answer, in the order given")
+
+def normalize(text) -> str:
+    text = str(text or "").lower().strip()
+    text = PUNCTUATION.sub("", text)
+    # An answer that is only an article ("a", "the") keeps it rather than normalizing to ""
+    return " ".join(ARTICLES.sub(" ", text).split()) or " ".join(text.split())
+
+def _as_number(text):
+    """Parse "3.5", "-5", "1,000" or "1/2"; None for anything else."""
+    text = str(text or "").strip()
+    if THOUSANDS.fullmatch(text):
+        text = text.replace(",", "")
+    if not NUMBER.fullmatch(text):
+        return None
+    num, _, den = text.partition("/")
+    try:
+        return float(num) / float(den) if den else float(num)
+    except ZeroDivisionError:
+        return None
+
+def _mcq_option(text):
+    m = MCQ_OPTION.match(str(text or "").strip())
+    return m.group(1).lower() if m else None
+
+def _grade(correct, comment):
+    return {"correct": correct, "credit": 1.0 if correct else 0.0, "comment": comment, "graded_by": "local"}
+
+def _keyed(correct, key):
+    return _grade(correct, "Correct." if correct else f"The answer is {key}.")
+
+def grade_locally(answer: dict):
+    """Return a grade for answers that need no judgement, or None to send it to the model."""
+    kind = str(answer.get("type") or "text").lower()
+    user = answer.get("user_answer")
+    key = answer.get("correct_answer")
+    if not str(user or "").strip():
+        return _grade(False, "No answer given.")
+
+    if kind == "mcq":
+        chosen, expected = _mcq_option(user), _mcq_option(key)
+        if chosen and expected:
+            return _grade(True, "Correct.") if chosen == expected else \
+                _grade(False, f"The correct option was {expected.upper()}.")
+
+    un, kn = _as_number(user), _as_number(key)
+    if un is not None and kn is not None:
+        return _keyed(abs(un - kn) <= 1e-9 * max(1.0, abs(kn)), key)
+    u, k = normalize(user), normalize(key)
+    if u and u == k:
+        return _grade(True, "Correct.")
+    if u in TRUE_WORDS | FALSE_WORDS and k in TRUE_WORDS | FALSE_WORDS:
+        return _keyed((u in TRUE_WORDS) == (k in TRUE_WORDS), key)
+    if kind in EXACT_TYPES or not k:
+        return _keyed(False, key) if key else _grade(False, "Incorrect.")
+    return None
+
+def _batch_prompt(batch) -> str:
+    prompt = ("You are a fair test evaluator. Grade each student answer against the reference answer. "
+              "Accept answers that are correct in meaning even if worded differently, and give partial "
+              "credit for partly correct answers.\n")
+    for i, ans in batch:
+        prompt += (f"\nAnswer {i}:\n  Question: {ans.get('question', '')}\n"
+                   f"  Reference answer: {ans.get('correct_answer', '')}\n"
+                   f"  Student answer: {ans.get('user_answer', '')}\n")
+    return prompt
+
+def grade_batch(batch):
+    """Grade [(index, answer)] with one structured-output call; returns ({index: grade}, tokens)."""
+    model = cached(get_model(temperature=0)).with_structured_output(GradeBatch, include_raw=True)
+    out = model.invoke([HumanMessage(content=_batch_prompt(batch))])
+    raw, parsed = out.get("raw"), out.get("parsed")
+    tokens = (getattr(raw, "usage_metadata", None) or {}).get("total_tokens", 0)
+    grades = {}
+    if parsed is not None:
+        for g in parsed.grades:
+            grades[g.index] = {"correct": g.correct, "credit": min(max(g.credit, 0.0), 1.0),
+                               "comment": g.comment, "graded_by": "model"}
+    return grades, tokens
+
+def score_answers(answers: list) -> dict:
+    """Grade a submitted test; returns {"score", "feedback", "details", "tokens_used"}."""
+    details = [grade_locally(a) for a in answers]
+    pending = [(i, a) for i, a in enumerate(answers) if details[i] is None]
+    batches = [pending[i:i + GRADE_BATCH_SIZE] for i in range(0, len(pending), GRADE_BATCH_SIZE)]
+    tokens_used = 0
+
+    if batches:
+        # Batches run in copies of the caller's context so admission sees the same user
+        ctx = contextvars.copy_context()
+        with ThreadPoolExecutor(max_workers=min(GRADE_CONCURRENCY, len(batches))) as pool:
+            futures = [pool.submit(ctx.copy().run, grade_batch, b) for b in batches]
+            for batch, future in zip(batches, futures):
+                try:
+                    grades, tokens = future.result()
+                except AdmissionRejected:
+                    raise
+                except Exception as e:
+                    print(f"Grading batch error: {e}")
+                    grades, tokens = {}, 0
+                tokens_used += tokens
+                for i, _ in batch:
+                    details[i] = grades.get(i) or {"correct": False, "credit": 0.0, "graded_by": "model",
+                                                   "comment": "This answer could not be graded automatically."}
+
+    total = len(answers)
+    credit = sum(d["credit"] for d in details)
+    correct = sum(1 for d in details if d["correct"])
+    missed = [str(i + 1) for i, d in enumerate(details) if not d["correct"]]
+    feedback = f"You got {correct} of {total} correct."
+    if missed:
+        feedback += f" Review question{'s' if len(missed) > 1 else ''} {', '.join(missed)}."
+    return {
+        "score": round(100 * credit / total) if total else 0,
+        "feedback": feedback,
+        "details": details,
+        "tokens_used": tokens_used,
+    }
@@ -0,0 +1,69 @@
+import os
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz  # PyMuPDF
+
+from database import (set_ingestion_status, get_pending_ingestions, get_cached_pdf_pages,
+                      save_cached_pdf_pages, save_pdf_chunks, get_pdf_chunks)
+from pdf_text import chunk_pages, hash_file
+from retrieval import build_index
+from metrics import SPAN_SECONDS
+
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "2"))
+CHUNK_CHARS = int(os.environ.get("INGEST_CHUNK_CHARS", "2000"))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=INGEST_WORKERS)
+        return _executor
+
+def parse_pdf(filepath: str):
+    """Runs in a worker process: hash the file and pull out page text and document metadata."""
+    digest = hash_file(filepath)
+    with fitz.open(filepath) as doc:
+        pages = [page.get_text() or "" for page in doc]
+        meta = {k: v for k, v in (doc.metadata or {}).items() if v}
+    return digest, pages, meta
+
+def _store_result(file_id, future, queued_at):
+    try:
+        digest, pages, meta = future.result()
+        # Parsing happens in a worker process, so it is timed here from submission to result
+        SPAN_SECONDS.observe(time.monotonic() - queued_at, kind="pdf", name="ingest_parse")
+        if get_cached_pdf_pages(digest) is None:
+            save_cached_pdf_pages(digest, pages)
+        chunks = chunk_pages(pages, CHUNK_CHARS)
+        save_pdf_chunks(digest, chunks)
+        build_index(digest, get_pdf_chunks(digest))
+        set_ingestion_status(file_id, "ready", content_hash=digest, page_count=len(pages),
+                             chunk_count=len(chunks), metadata=meta)
+    except Exception as e:
+        print(f"PDF ingestion error for file {file_id}: {e}")
+        set_ingestion_status(file_id, "failed", error=str(e))
+
+def submit_ingestion(file_id, filepath):
+    """Queue an uploaded PDF for background parsing; returns immediately."""
+    set_ingestion_status(file_id, "processing")
+    queued_at = time.monotonic()
+    try:
+        future = _get_executor().submit(parse_pdf, filepath)
+    except Exception as e:
+        print(f"Could not queue PDF ingestion: {e}")
+        set_ingestion_status(file_id, "failed", error=str(e))
+        return
+    future.add_done_callback(lambda f: _store_result(file_id, f, queued_at))
+
+def resume_pending():
+    """Re-queue files whose ingestion was interrupted by a restart."""
+    for f in get_pending_ingestions():
+        if f["filepath"] and os.path.exists(f["filepath"]):
+            submit_ingestion(f["id"], f["filepath"])
+        else:
+            set_ingestion_status(f["id"], "failed", error="File missing")
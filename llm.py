@@ -1,14 +1,20 @@
 import os
 import sqlite3
 import asyncio
-import edge_tts
-from typing import TypedDict, List, Optional, Literal
+import threading
+import httpx
+from typing import TypedDict, List, Optional, Literal, Annotated
 from langchain_groq import ChatGroq
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, ToolMessage
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, ToolMessage, RemoveMessage
+from langchain_core.messages.utils import count_tokens_approximately
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableLambda
 from langchain_core.output_parsers import JsonOutputParser
 from langgraph.graph import START, END, StateGraph
+from langgraph.graph.message import add_messages, REMOVE_ALL_MESSAGES
 from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+import aiosqlite
 from pydantic import BaseModel, Field
 from langchain.tools import tool
 import requests
@@ -17,7 +23,17 @@ import time
 import json
 
 import datetime
-import fitz  # PyMuPDF
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from database import CHECKPOINT_DB_NAME
+from pdf_text import get_pdf_pages
+from retrieval import retrieve_chunks, is_question_prompt
+import admission
+import metrics
+from admission import AdmissionRejected, LLM_MAX_CONCURRENCY
+from llm_cache import cached, LLM_CACHE_ENABLED, LLM_CACHE_CHAT
+from charts import render_chart, arender_chart, chart_url
+from tts import get_audio, submit_audio, audio_path_for, TTS_STREAMING, TTS_TIMEOUT
 
 
 
@@ -31,7 +47,8 @@ VOICE_STYLES = {
 }
 
 class State(TypedDict):
-    messages: list
+    messages: Annotated[list, add_messages]
+    conversation_summary: str
     query: str
     username: str
     chat_mode: str
@@ -51,6 +68,7 @@ class State(TypedDict):
     flashcards: list
     mcqs: list
     screen_text_override: str
+    tool_latencies: list
 
 class FlashcardItem(BaseModel):
     question: str = Field(description="The question")
@@ -77,54 +95,140 @@ class VoiceResponse(BaseModel):
     screen_text: str = Field(description="Text to display on screen")
     audio_text: str = Field(description="Text to convert to speech")
 
-def get_model():
+LLM_MODEL = os.environ.get("LLM_MODEL", "openai/gpt-oss-120b")
+LLM_TEMPERATURE = float(os.environ.get("LLM_TEMPERATURE", "0.7"))
+
+_models = {}
+_bound_models = {}
+_models_lock = threading.Lock()
+_http_client = None
+
+def _get_http_client():
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=LLM_MAX_CONCURRENCY,
+                                max_keepalive_connections=LLM_MAX_CONCURRENCY,
+                                keepalive_expiry=60),
+            timeout=httpx.Timeout(120, connect=10),
+        )
+    return _http_client
+
+class AdmittedChatGroq(ChatGroq):
+    """ChatGroq whose provider calls each hold an admission slot (see admission.py).
+
+    Hooking the _generate/_stream layer covers invoke, stream, bound tools and chains alike.
+    """
+
+    def _generate(self, *args, **kwargs):
+        with admission.controller.slot(), metrics.span("llm", self.model_name):
+            result = super()._generate(*args, **kwargs)
+        self._record_usage(result.generations)
+        return result
+
+    async def _agenerate(self, *args, **kwargs):
+        async with admission.controller.aslot():
+            with metrics.span("llm", self.model_name):
+                result = await super()._agenerate(*args, **kwargs)
+        self._record_usage(result.generations)
+        return result
+
+    def _stream(self, *args, **kwargs):
+        with admission.controller.slot(), metrics.span("llm", self.model_name):
+            for chunk in super()._stream(*args, **kwargs):
+                self._record_usage([chunk])
+                yield chunk
+
+    async def _astream(self, *args, **kwargs):
+        async with admission.controller.aslot():
+            with metrics.span("llm", self.model_name):
+                async for chunk in super()._astream(*args, **kwargs):
+                    self._record_usage([chunk])
+                    yield chunk
+
+    def _record_usage(self, generations):
+        for generation in generations:
+            metrics.record_tokens(self.model_name, getattr(generation.message, "usage_metadata", None))
+
+def get_model(model: str = None, temperature: float = None):
+    """Return the shared client for (model, temperature), creating it on first use."""
     api_key = os.environ.get("GROQ_API_KEY", "")
     if not api_key:
         raise ValueError("GROQ_API_KEY not set")
-    return ChatGroq(model="openai/gpt-oss-120b", temperature=0.7, api_key=api_key)
+    key = (model or LLM_MODEL, LLM_TEMPERATURE if temperature is None else temperature, api_key)
+    with _models_lock:
+        client = _models.get(key)
+        if client is None:
+            client = AdmittedChatGroq(model=key[0], temperature=key[1], api_key=api_key,
+                              http_client=_get_http_client())
+            _models[key] = client
+    return client
+
+def get_bound_model(enabled_tools: list):
+    """Return the default model with the tool set for enabled_tools bound, memoized per combination."""
+    model = get_model()
+    tools = get_available_tools(enabled_tools)
+    key = (id(model), tuple(t.name for t in tools))
+    with _models_lock:
+        bound = _bound_models.get(key)
+        if bound is None:
+            bound = cached(model, tools, enabled=LLM_CACHE_ENABLED and LLM_CACHE_CHAT)
+            _bound_models[key] = bound
+    return bound
 
 
 
 def extract_pdf_content(filepath: str, max_pages: int = 5) -> str:
     try:
-        # Open the document
-        with fitz.open(filepath) as doc:
-            num_pages = len(doc)
-            text = ""
-            
-            # Determine how many pages to read
-            pages_to_read = min(num_pages, max_pages)
-            
-            for i in range(pages_to_read):
-                page_text = doc[i].get_text()
-                text += page_text if page_text else ""
-            
-            # If the PDF was longer than max_pages, apply your 1000 char cap
-            if num_pages > max_pages:
-                text = text[:1000]
-            
-            return text.strip()
+        pages = get_pdf_pages(filepath)
+        num_pages = len(pages)
+        
+        # Determine how many pages to read
+        text = "".join(pages[:max_pages])
+        
+        # If the PDF was longer than max_pages, apply your 1000 char cap
+        if num_pages > max_pages:
+            text = text[:1000]
+        
+        return text.strip()
             
     except Exception as e:
         print(f"PDF extraction error: {e}")
         return ""
         
 def get_system_prompt(state: State) -> str:
+    """Build the system prompt, ordered from least to most frequently changing.
+
+    Providers cache prompts by prefix, so the fixed instructions come first and the
+    date and rolling conversation summary come last.
+    """
     chat_mode = state.get("chat_mode", "study")
     enabled_tools = state.get("enabled_tools", [])
     user_profile = state.get("user_profile", {})
     user_notes = state.get("user_notes", [])
     user_files = state.get("user_files", [])
     
-    now = datetime.datetime.now()
-    current_datetime = now.strftime("%Y-%m-%d %H:%M:%S")
-    today = now.strftime("%Y-%m-%d")
+    today = datetime.date.today().strftime("%Y-%m-%d")
     
-    base = f"""You are a helpful study guide AI assistant. Current date and time: {current_datetime}.
+    base = f"""You are a helpful study guide AI assistant.
 You help students learn by answering questions clearly and educationally. Keep responses focused and helpful. Use examples when appropriate.force student to study not answer any other questions except study
 
 """
     
+    if chat_mode == "test":
+        base += "\n\nYou are in TEST MODE. Generate questions to test the student's knowledge. Be encouraging but accurate."
+    
+    if "voice" in enabled_tools:
+        base += "\n\nVOICE TOOL: Use speak_response tool when user wants audio/voice explanation."
+    if "flashcards" in enabled_tools:
+        base += "\n\nFLASHCARD TOOL: Create flashcards when asked or when it helps learning."
+    if "mcqs" in enabled_tools:
+        base += "\n\nMCQ TOOL: Generate multiple choice questions when asked."
+    if "pdf" in enabled_tools:
+        base += "\n\nPDF TOOL: Use summarize_pdf tool to query or summarize uploaded PDFs."
+    if "chart" in enabled_tools:
+        base += "\n\nCHART TOOL: Use generate_chart tool to create diagrams. The chart will be displayed as an image to the user."
+    
     if user_profile:
         name = user_profile.get("display_name") or user_profile.get("username", "Student")
         about = user_profile.get("about", "")
@@ -153,24 +257,18 @@ USER DETAILS:
             filepath = f.get("filepath", "")
             base += f"\n- {filename}"
             
-            if filepath and os.path.exists(filepath):
+            # Snapshots from user_context already carry the preview
+            content = f.get("preview")
+            if content is None and filepath and os.path.exists(filepath):
                 content = extract_pdf_content(filepath)
-                if content:
-                    base += f"\n  Content preview: {content[:500]}..."
+            if content:
+                base += f"\n  Content preview: {content[:500]}..."
     
-    if chat_mode == "test":
-        base += "\n\nYou are in TEST MODE. Generate questions to test the student's knowledge. Be encouraging but accurate."
+    base += f"\n\nCurrent date: {today}."
     
-    if "voice" in enabled_tools:
-        base += "\n\nVOICE TOOL: Use speak_response tool when user wants audio/voice explanation."
-    if "flashcards" in enabled_tools:
-        base += "\n\nFLASHCARD TOOL: Create flashcards when asked or when it helps learning."
-    if "mcqs" in enabled_tools:
-        base += "\n\nMCQ TOOL: Generate multiple choice questions when asked."
-    if "pdf" in enabled_tools:
-        base += "\n\nPDF TOOL: Use summarize_pdf tool to query or summarize uploaded PDFs."
-    if "chart" in enabled_tools:
-        base += "\n\nCHART TOOL: Use generate_chart tool to create diagrams. The chart will be displayed as an image to the user."
+    conversation_summary = state.get("conversation_summary", "")
+    if conversation_summary:
+        base += f"\n\nEARLIER IN THIS CONVERSATION (summary):\n{conversation_summary}"
     
     return base
 
@@ -180,26 +278,108 @@ def generate_chart(chart_code: str) -> str:
     Args:
         chart_code: Valid Mermaid.js syntax string for the diagram
     """
-    clean_code = chart_code.replace("```mermaid", "").replace("```", "").strip()
-    graphbytes = clean_code.encode("utf8")
-    base64_bytes = base64.b64encode(graphbytes)
-    base64_string = base64_bytes.decode("ascii")
-    
-    url = "https://mermaid.ink/img/" + base64_string + "?bgColor=!white"
-    response = requests.get(url)
-    
-    if response.status_code == 200:
-        content_type = response.headers.get('Content-Type', '')
-        if 'image' not in content_type:
-            return "Error: Could not generate diagram image"
-        
-        img_base64 = base64.b64encode(response.content).decode('utf-8')
-        return f"CHART_IMAGE:data:image/png;base64,{img_base64}"
-    else:
-        return f"Error: Failed to generate diagram (status {response.status_code})"
+    try:
+        digest = render_chart(chart_code)
+    except Exception as e:
+        return f"Error: {e}"
+    return f"CHART_IMAGE:{chart_url(digest)}"
+
+async def _agenerate_chart(chart_code: str) -> str:
+    try:
+        digest = await arender_chart(chart_code)
+    except Exception as e:
+        return f"Error: {e}"
+    return f"CHART_IMAGE:{chart_url(digest)}"
+
+generate_chart.coroutine = _agenerate_chart
+
+
+
+
+# "mapreduce" summarizes page chunks in parallel then merges; "refine" is the original serial loop
+PDF_SUMMARY_MODE = os.environ.get("PDF_SUMMARY_MODE", "mapreduce")
+PDF_SUMMARY_CONCURRENCY = int(os.environ.get("PDF_SUMMARY_CONCURRENCY", "4"))
+PDF_REDUCE_FANOUT = 4
 
+def refine_summary(model, pages: list, prompt: str) -> str:
+    """Summarize the first 10 pages, then fold in each following 5-page chunk one call at a time."""
+    total_pages = len(pages)
+    
+    # Step 1: Initial Summary (First 10 pages)
+    initial_text = "".join(pages[:10])
+    
+    # Truncate initial text to prevent overflow
+    initial_text = initial_text[:6000]
+    
+    initial_prompt = f"Based on the following PDF content (Pages 1-10), create an initial summary/answer for: {prompt}\n\nPDF CONTENT:\n{initial_text}"
+    
+    response = model.invoke([HumanMessage(content=initial_prompt)])
+    current_summary = response.content
+    
+    # Step 2: Iterative Refinement (Next 5-page chunks)
+    current_page = 10
+    while current_page < total_pages:
+        end_page = min(current_page + 5, total_pages)
+        next_chunk_text = "".join(pages[current_page:end_page])
+        
+        if next_chunk_text.strip():
+            # Refine current_summary with the new chunk
+            refine_prompt = (
+                f"USER ORIGINAL INTENT: {prompt}\n\n"
+                f"PREVIOUS SUMMARY: {current_summary}\n\n"
+                f"NEW CONTENT (Pages {current_page+1} to {end_page}):\n{next_chunk_text[:4000]}\n\n"
+                f"INSTRUCTIONS: Update the previous summary to include relevant info from the new content."
+            )
+            response = model.invoke([HumanMessage(content=refine_prompt)])
+            current_summary = response.content
+        
+        current_page += 5
+    
+    return current_summary
 
+def map_reduce_summary(model, pages: list, prompt: str, concurrency: int = None) -> str:
+    """Summarize 5-page chunks concurrently, then merge the partial summaries in parallel rounds.
 
+    Each round cuts the number of summaries by PDF_REDUCE_FANOUT, so the number of
+    sequential model calls grows with log(pages) instead of pages.
+    """
+    concurrency = concurrency or PDF_SUMMARY_CONCURRENCY
+    
+    def summarize_chunk(start):
+        end = min(start + 5, len(pages))
+        text = "".join(pages[start:end])
+        if not text.strip():
+            return ""
+        chunk_prompt = (
+            f"USER ORIGINAL INTENT: {prompt}\n\n"
+            f"CONTENT (Pages {start+1} to {end}):\n{text[:4000]}\n\n"
+            f"INSTRUCTIONS: Summarize the information in this content that is relevant to the user's intent."
+        )
+        return model.invoke([HumanMessage(content=chunk_prompt)]).content
+    
+    def merge(parts):
+        if len(parts) == 1:
+            return parts[0]
+        joined = "\n\n".join(f"PART {i+1}:\n{p}" for i, p in enumerate(parts))
+        merge_prompt = (
+            f"USER ORIGINAL INTENT: {prompt}\n\n"
+            f"PARTIAL SUMMARIES (in document order):\n{joined}\n\n"
+            f"INSTRUCTIONS: Combine these into one coherent summary/answer, keeping document order."
+        )
+        return model.invoke([HumanMessage(content=merge_prompt)]).content
+    
+    # Workers run in copies of the caller's context so admission sees the same user and priority
+    ctx = contextvars.copy_context()
+    in_ctx = lambda fn: lambda arg: ctx.copy().run(fn, arg)
+    
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        summaries = [s for s in pool.map(in_ctx(summarize_chunk), range(0, len(pages), 5)) if s]
+        if not summaries:
+            return "Could not extract text from PDF."
+        while len(summaries) > 1:
+            groups = [summaries[i:i + PDF_REDUCE_FANOUT] for i in range(0, len(summaries), PDF_REDUCE_FANOUT)]
+            summaries = list(pool.map(in_ctx(merge), groups))
+    return summaries[0]
 
 @tool
 def summarize_pdf_tool(filename: str, prompt: str) -> str:
@@ -218,63 +398,42 @@ def summarize_pdf_tool(filename: str, prompt: str) -> str:
         return f"Could not find PDF file: {filename}"
     
     try:
-        model = get_model()
+        model = cached(get_model())
+        
+        # Page text comes from the shared cache, so the PDF is only parsed once
+        pages = get_pdf_pages(filepath)
+        total_pages = len(pages)
         
-        # Use 'with' to ensure the document is handled properly
-        with fitz.open(filepath) as doc:
-            total_pages = len(doc)
+        # --- Scenario A: Short PDF (< 10 pages) ---
+        if total_pages < 10:
+            text = "".join(pages)
             
-            # --- Scenario A: Short PDF (< 10 pages) ---
-            if total_pages < 10:
-                text = ""
-                for page in doc:
-                    text += page.get_text() or ""
-                
-                if not text.strip():
-                    return "Could not extract text from PDF."
-                
-                full_prompt = f"Based on the following PDF content, {prompt}\n\nPDF CONTENT:\n{text[:8000]}"
-                response = model.invoke([HumanMessage(content=full_prompt)])
-                return response.content
-
-            # --- Scenario B: Long PDF (>= 10 pages) ---
-            else:
-                # Step 1: Initial Summary (First 10 pages)
-                initial_text = ""
-                for i in range(10):
-                    initial_text += doc[i].get_text() or ""
-                
-                # Truncate initial text to prevent overflow
-                initial_text = initial_text[:6000]
-                
-                initial_prompt = f"Based on the following PDF content (Pages 1-10), create an initial summary/answer for: {prompt}\n\nPDF CONTENT:\n{initial_text}"
-                
-                response = model.invoke([HumanMessage(content=initial_prompt)])
-                current_summary = response.content
-                
-                # Step 2: Iterative Refinement (Next 5-page chunks)
-                current_page = 10
-                while current_page < total_pages:
-                    next_chunk_text = ""
-                    end_page = min(current_page + 5, total_pages)
-                    
-                    for i in range(current_page, end_page):
-                        next_chunk_text += doc[i].get_text() or ""
-                    
-                    if next_chunk_text.strip():
-                        # Refine current_summary with the new chunk
-                        refine_prompt = (
-                            f"USER ORIGINAL INTENT: {prompt}\n\n"
-                            f"PREVIOUS SUMMARY: {current_summary}\n\n"
-                            f"NEW CONTENT (Pages {current_page+1} to {end_page}):\n{next_chunk_text[:4000]}\n\n"
-                            f"INSTRUCTIONS: Update the previous summary to include relevant info from the new content."
-                        )
-                        response = model.invoke([HumanMessage(content=refine_prompt)])
-                        current_summary = response.content
-                    
-                    current_page += 5
-                
-                return current_summary
+            if not text.strip():
+                return "Could not extract text from PDF."
+            
+            full_prompt = f"Based on the following PDF content, {prompt}\n\nPDF CONTENT:\n{text[:8000]}"
+            response = model.invoke([HumanMessage(content=full_prompt)])
+            return response.content
+
+        # --- Scenario B: Long PDF, narrow question -> answer from the best-matching chunks ---
+        hits = retrieve_chunks(filepath, prompt) if is_question_prompt(prompt) else []
+        if hits:
+            context = "\n\n".join(
+                f"[Pages {h['page_start']}-{h['page_end']}]\n{h['text']}" for h in hits
+            )
+            full_prompt = (
+                f"Answer using the following excerpts from a {total_pages}-page PDF: {prompt}\n\n"
+                f"PDF EXCERPTS:\n{context[:8000]}"
+            )
+            response = model.invoke([HumanMessage(content=full_prompt)])
+            return response.content
+
+        # --- Scenario C: Long PDF (>= 10 pages), whole-document request ---
+        # Many calls per request, so they queue behind interactive chat for LLM slots
+        with admission.context(priority=admission.BACKGROUND):
+            if PDF_SUMMARY_MODE == "refine":
+                return refine_summary(model, pages, prompt)
+            return map_reduce_summary(model, pages, prompt)
                 
     except Exception as e:
         # This will help you see the exact error in the logs
@@ -352,74 +511,163 @@ def should_continue(state: State):
     return "end"
 
 def call_model(state: State):
-    messages = state.get("messages", [])
-    enabled_tools = state.get("enabled_tools", [])
-    
-    model = get_model()
-    tools = get_available_tools(enabled_tools)
-    
-    if tools:
-        model_with_tools = model.bind_tools(tools)
-    else:
-        model_with_tools = model
-    
-    response = model_with_tools.invoke(messages)
-    
+    model_with_tools = get_bound_model(state.get("enabled_tools", []))
+    return _model_update(model_with_tools.invoke(state.get("messages", [])))
+
+async def acall_model(state: State):
+    model_with_tools = get_bound_model(state.get("enabled_tools", []))
+    return _model_update(await model_with_tools.ainvoke(state.get("messages", [])))
+
+def _model_update(response):
     tokens_used = 0
     if hasattr(response, 'usage_metadata') and response.usage_metadata:
         tokens_used = response.usage_metadata.get('total_tokens', 0)
     
     return {
-        "messages": messages + [response],
+        "messages": [response],
         "tokens_used": tokens_used
     }
 
-def call_tools(state: State):
-    messages = state.get("messages", [])
-    last_message = messages[-1]
+# Tool calls from one model turn run concurrently on this shared, bounded pool
+TOOL_WORKERS = int(os.environ.get("TOOL_WORKERS", "8"))
+TOOL_TIMEOUT = float(os.environ.get("TOOL_TIMEOUT", "60"))
+# Per-tool overrides of TOOL_TIMEOUT, in seconds
+TOOL_TIMEOUTS = {
+    "summarize_pdf_tool": float(os.environ.get("PDF_TOOL_TIMEOUT", "180")),
+    "generate_chart": 30,
+}
+_tool_executor = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool")
+
+def _run_tool(tool_name, tool_args):
+    started = time.monotonic()
+    try:
+        with metrics.span("tool", tool_name):
+            result = TOOL_MAP[tool_name].invoke(tool_args)
+        return result, None, time.monotonic() - started
+    except Exception as e:
+        return None, e, time.monotonic() - started
+
+def run_tool_calls(tool_calls: list) -> list:
+    """Run tool calls concurrently; return (tool_call, result, error, seconds) in the original order.
+
+    A call still queued when its timeout passes is cancelled. One that is already running
+    cannot be interrupted, so it is abandoned and reported as timed out.
+    """
+    submitted = []
+    for tool_call in tool_calls:
+        tool_name = tool_call.get("name", "")
+        if tool_name not in TOOL_MAP:
+            submitted.append((tool_call, None, None))
+            continue
+        timeout = TOOL_TIMEOUTS.get(tool_name, TOOL_TIMEOUT)
+        # copy_context keeps the graph's callbacks (streaming, tracing) attached inside the worker
+        ctx = contextvars.copy_context()
+        future = _tool_executor.submit(ctx.run, _run_tool, tool_name, tool_call.get("args", {}))
+        submitted.append((tool_call, future, time.monotonic() + timeout))
+    
+    outcomes = []
+    for tool_call, future, deadline in submitted:
+        if future is None:
+            outcomes.append((tool_call, None, None, 0.0))
+            continue
+        try:
+            result, error, seconds = future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FuturesTimeout:
+            future.cancel()
+            timeout = TOOL_TIMEOUTS.get(tool_call.get("name", ""), TOOL_TIMEOUT)
+            result, error, seconds = None, TimeoutError(f"timed out after {timeout:g}s"), timeout
+        outcomes.append((tool_call, result, error, seconds))
+    return outcomes
+
+async def _arun_tool(tool_name, tool_args):
+    started = time.monotonic()
+    try:
+        with metrics.span("tool", tool_name):
+            result = await TOOL_MAP[tool_name].ainvoke(tool_args)
+        return result, None, time.monotonic() - started
+    except Exception as e:
+        return None, e, time.monotonic() - started
+
+async def arun_tool_calls(tool_calls: list) -> list:
+    """Async counterpart of run_tool_calls: tools run as tasks and timed-out ones are cancelled.
+
+    Tools without a native coroutine still run in the loop's default executor.
+    """
+    async def run(tool_call):
+        tool_name = tool_call.get("name", "")
+        if tool_name not in TOOL_MAP:
+            return tool_call, None, None, 0.0
+        timeout = TOOL_TIMEOUTS.get(tool_name, TOOL_TIMEOUT)
+        try:
+            result, error, seconds = await asyncio.wait_for(_arun_tool(tool_name, tool_call.get("args", {})), timeout)
+        except asyncio.TimeoutError:
+            result, error, seconds = None, TimeoutError(f"timed out after {timeout:g}s"), timeout
+        return tool_call, result, error, seconds
     
+    return list(await asyncio.gather(*(run(tool_call) for tool_call in tool_calls)))
+
+def call_tools(state: State):
+    last_message = state.get("messages", [])[-1]
+    tool_calls = getattr(last_message, "tool_calls", None) or []
+    return _tools_update(state, run_tool_calls(tool_calls))
+
+async def acall_tools(state: State):
+    last_message = state.get("messages", [])[-1]
+    tool_calls = getattr(last_message, "tool_calls", None) or []
+    return _tools_update(state, await arun_tool_calls(tool_calls))
+
+def _tools_update(state: State, outcomes: list):
     tool_results = []
+    tool_latencies = list(state.get("tool_latencies") or [])
     chart_image = ""
     audio_text = ""
     flashcards = []
     mcqs = []
     screen_text_override = ""
     
-    if hasattr(last_message, 'tool_calls') and last_message.tool_calls:
-        for tool_call in last_message.tool_calls:
-            tool_name = tool_call.get("name", "")
-            tool_args = tool_call.get("args", {})
-            tool_id = tool_call.get("id", "")
+    for tool_call, result, error, seconds in outcomes:
+        tool_name = tool_call.get("name", "")
+        tool_id = tool_call.get("id", "")
+        
+        if tool_name not in TOOL_MAP:
+            tool_results.append(ToolMessage(content=f"Unknown tool: {tool_name}", tool_call_id=tool_id))
+            continue
+        
+        tool_latencies.append({
+            "name": tool_name,
+            "id": tool_id,
+            "seconds": round(seconds, 3),
+            "status": "timeout" if isinstance(error, TimeoutError) else ("error" if error else "ok")
+        })
+        
+        try:
+            if error:
+                raise error
             
-            if tool_name in TOOL_MAP:
-                try:
-                    result = TOOL_MAP[tool_name].invoke(tool_args)
-                    
-                    if result.startswith("CHART_IMAGE:"):
-                        chart_image = result.replace("CHART_IMAGE:", "")
-                        result = "Chart generated successfully and displayed to user."
-                    elif result.startswith("VOICE_OUTPUT:"):
-                        audio_text = result.replace("VOICE_OUTPUT:", "")
-                        result = "Audio response will be generated for the user."
-                    elif result.startswith("FLASHCARDS:"):
-                        data = json.loads(result.replace("FLASHCARDS:", ""))
-                        flashcards = data.get("flashcards", [])
-                        screen_text_override = data.get("screen_text", "")
-                        result = "Flashcards generated successfully."
-                    elif result.startswith("MCQS:"):
-                        data = json.loads(result.replace("MCQS:", ""))
-                        mcqs = data.get("mcqs", [])
-                        screen_text_override = data.get("screen_text", "")
-                        result = "MCQs generated successfully."
-                    
-                    tool_results.append(ToolMessage(content=result, tool_call_id=tool_id))
-                except Exception as e:
-                    tool_results.append(ToolMessage(content=f"Error: {str(e)}", tool_call_id=tool_id))
-            else:
-                tool_results.append(ToolMessage(content=f"Unknown tool: {tool_name}", tool_call_id=tool_id))
+            if result.startswith("CHART_IMAGE:"):
+                chart_image = result.replace("CHART_IMAGE:", "")
+                result = "Chart generated successfully and displayed to user."
+            elif result.startswith("VOICE_OUTPUT:"):
+                audio_text = result.replace("VOICE_OUTPUT:", "")
+                result = "Audio response will be generated for the user."
+            elif result.startswith("FLASHCARDS:"):
+                data = json.loads(result.replace("FLASHCARDS:", ""))
+                flashcards = data.get("flashcards", [])
+                screen_text_override = data.get("screen_text", "")
+                result = "Flashcards generated successfully."
+            elif result.startswith("MCQS:"):
+                data = json.loads(result.replace("MCQS:", ""))
+                mcqs = data.get("mcqs", [])
+                screen_text_override = data.get("screen_text", "")
+                result = "MCQs generated successfully."
+            
+            tool_results.append(ToolMessage(content=result, tool_call_id=tool_id))
+        except Exception as e:
+            tool_results.append(ToolMessage(content=f"Error: {str(e)}", tool_call_id=tool_id))
     
     return {
-        "messages": messages + tool_results,
+        "messages": tool_results,
+        "tool_latencies": tool_latencies,
         "chart_image": chart_image,
         "audio_text": audio_text,
         "flashcards": flashcards,
@@ -428,37 +676,156 @@ def call_tools(state: State):
     }
 
 
+# Older turns beyond this many (approximate) tokens are folded into conversation_summary
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "6000"))
+# "0" drops old turns outright instead of asking the model to summarize them
+CONTEXT_SUMMARY = os.environ.get("CONTEXT_SUMMARY", "1") == "1"
+SYSTEM_MESSAGE_ID = "system"
+
+def split_context(history: list):
+    """Split history into (dropped, kept) so kept fits in about half of CONTEXT_TOKEN_BUDGET.
+
+    Trimming to half leaves headroom so folding happens every few turns, not every turn.
+    The cut always lands on a HumanMessage so tool calls stay next to their results,
+    and never after the latest one, so the most recent exchange always stays verbatim.
+    """
+    if count_tokens_approximately(history) <= CONTEXT_TOKEN_BUDGET:
+        return [], history
+    last_human = next((i for i in range(len(history) - 1, -1, -1) if isinstance(history[i], HumanMessage)), None)
+    if last_human is None:
+        return [], history
+    
+    kept_tokens = 0
+    cut = len(history)
+    for i in range(len(history) - 1, -1, -1):
+        kept_tokens += count_tokens_approximately([history[i]])
+        if kept_tokens > CONTEXT_TOKEN_BUDGET // 2:
+            break
+        cut = i
+    while cut < len(history) and not isinstance(history[cut], HumanMessage):
+        cut += 1
+    # The latest exchange is always kept, even when it alone is over the budget
+    cut = min(cut, last_human)
+    return history[:cut], history[cut:]
+
+def _summary_prompt(summary: str, dropped: list):
+    if not CONTEXT_SUMMARY:
+        return None
+    
+    transcript = ""
+    for m in dropped:
+        if isinstance(m, HumanMessage):
+            transcript += f"\nSTUDENT: {m.content}"
+        elif isinstance(m, AIMessage) and m.content:
+            transcript += f"\nASSISTANT: {m.content}"
+    if not transcript.strip():
+        return None
+    
+    return (
+        f"PREVIOUS SUMMARY OF THIS STUDY SESSION:\n{summary or '(none)'}\n\n"
+        f"MORE CONVERSATION:{transcript[:12000]}\n\n"
+        f"INSTRUCTIONS: Update the summary so it covers both, in under 200 words. Keep topics studied, "
+        f"the student's difficulties and anything they asked to remember."
+    )
+
+def fold_into_summary(summary: str, dropped: list) -> str:
+    prompt = _summary_prompt(summary, dropped)
+    if not prompt:
+        return summary
+    try:
+        return cached(get_model()).invoke([HumanMessage(content=prompt)]).content
+    except Exception as e:
+        print(f"Conversation summary error: {e}")
+        return summary
+
+async def afold_into_summary(summary: str, dropped: list) -> str:
+    prompt = _summary_prompt(summary, dropped)
+    if not prompt:
+        return summary
+    try:
+        return (await cached(get_model()).ainvoke([HumanMessage(content=prompt)])).content
+    except Exception as e:
+        print(f"Conversation summary error: {e}")
+        return summary
+
 def format_input(state: State):
+    history = [m for m in state.get("messages") or [] if not isinstance(m, SystemMessage)]
+    dropped, history = split_context(history)
+    summary = state.get("conversation_summary", "")
+    if dropped:
+        summary = fold_into_summary(summary, dropped)
+    return _format_update(state, history, dropped, summary)
+
+async def aformat_input(state: State):
+    history = [m for m in state.get("messages") or [] if not isinstance(m, SystemMessage)]
+    dropped, history = split_context(history)
+    summary = state.get("conversation_summary", "")
+    if dropped:
+        summary = await afold_into_summary(summary, dropped)
+    return _format_update(state, history, dropped, summary)
+
+def _format_update(state: State, history: list, dropped: list, summary: str):
     messages = state.get("messages") or []
     query = state.get("query", "")
     
-    system_prompt = get_system_prompt(state)
+    system_prompt = get_system_prompt({**state, "conversation_summary": summary})
+    system = SystemMessage(content=system_prompt, id=SYSTEM_MESSAGE_ID)
     
-    if not messages:
-        messages = [SystemMessage(content=system_prompt)]
-    elif not isinstance(messages[0], SystemMessage):
-        messages = [SystemMessage(content=system_prompt)] + messages
+    # add_messages appends new messages, replaces ones with a matching id and deletes RemoveMessage ids
+    if any(m.id is None for m in messages) or (messages and messages[0].id != SYSTEM_MESSAGE_ID):
+        # Checkpoints written before the reducer existed have no ids: rewrite the list once
+        new_messages = [RemoveMessage(id=REMOVE_ALL_MESSAGES), system] + history
     else:
-        messages[0] = SystemMessage(content=system_prompt)
+        new_messages = [system] + [RemoveMessage(id=m.id) for m in dropped]
     
     if query:
-        messages.append(HumanMessage(content=query))
+        new_messages.append(HumanMessage(content=query))
     
     return {
-        "messages": messages,
+        "messages": new_messages,
+        "conversation_summary": summary,
         "screen_text": "",
         "audio_text": "",
         "audio_path": "",
         "flashcards": [],
         "mcqs": [],
         "screen_text_override": "",
+        "tool_latencies": [],
         "tokens_used": 0
     }
 
 def finalize_output(state: State):
-    messages = state.get("messages", [])
-    voice_style = state.get("voice_style", "female-english")
+    audio_path = ""
+    audio_text = state.get("audio_text", "")
+    if audio_text:
+        try:
+            voice = VOICE_STYLES.get(state.get("voice_style", "female-english"), "en-US-AriaNeural")
+            if TTS_STREAMING:
+                submit_audio(audio_text, voice)
+                audio_path = audio_path_for(audio_text, voice)
+            else:
+                audio_path = get_audio(audio_text, voice)
+        except Exception as e:
+            print(f"Audio generation error: {e}")
+    return _finalize_update(state, audio_path)
+
+async def afinalize_output(state: State):
+    audio_path = ""
     audio_text = state.get("audio_text", "")
+    if audio_text:
+        try:
+            voice = VOICE_STYLES.get(state.get("voice_style", "female-english"), "en-US-AriaNeural")
+            future = submit_audio(audio_text, voice)
+            if TTS_STREAMING:
+                audio_path = audio_path_for(audio_text, voice)
+            else:
+                audio_path = await asyncio.wait_for(asyncio.wrap_future(future), TTS_TIMEOUT)
+        except Exception as e:
+            print(f"Audio generation error: {e}")
+    return _finalize_update(state, audio_path)
+
+def _finalize_update(state: State, audio_path: str):
+    messages = state.get("messages", [])
     chart_image = state.get("chart_image", "")
     flashcards = state.get("flashcards", [])
     mcqs = state.get("mcqs", [])
@@ -471,21 +838,6 @@ def finalize_output(state: State):
                 screen_text = msg.content
                 break
     
-    audio_path = ""
-    if audio_text:
-        try:
-            voice = VOICE_STYLES.get(voice_style, "en-US-AriaNeural")
-            output_path = f"audio_{abs(hash(audio_text)) % 100000}.mp3"
-            
-            async def gen_audio():
-                communicate = edge_tts.Communicate(audio_text, voice)
-                await communicate.save(output_path)
-                return output_path
-            
-            audio_path = asyncio.run(gen_audio())
-        except Exception as e:
-            print(f"Audio generation error: {e}")
-    
     return {
         "screen_text": screen_text,
         "audio_path": audio_path,
@@ -496,10 +848,14 @@ def finalize_output(state: State):
 
 workflow = StateGraph(State)
 
-workflow.add_node("format", format_input)
-workflow.add_node("agent", call_model)
-workflow.add_node("tools", call_tools)
-workflow.add_node("finalize", finalize_output)
+# Each node has a sync and an async implementation so the same graph serves invoke() and ainvoke()
+def _node(name, func, afunc):
+    return RunnableLambda(metrics.timed("node", name)(func), afunc=metrics.timed("node", name)(afunc))
+
+workflow.add_node("format", _node("format", format_input, aformat_input))
+workflow.add_node("agent", _node("agent", call_model, acall_model))
+workflow.add_node("tools", _node("tools", call_tools, acall_tools))
+workflow.add_node("finalize", _node("finalize", finalize_output, afinalize_output))
 
 workflow.add_edge(START, "format")
 workflow.add_edge("format", "agent")
@@ -514,34 +870,60 @@ workflow.add_conditional_edges(
 workflow.add_edge("tools", "agent")
 workflow.add_edge("finalize", END)
 
-conn = sqlite3.connect("checkpoints.sqlite", check_same_thread=False)
+conn = sqlite3.connect(CHECKPOINT_DB_NAME, check_same_thread=False)
 memory = SqliteSaver(conn)
 graph = workflow.compile(checkpointer=memory)
 
+_async_graph = None
+_async_graph_lock = None
+
+async def get_async_graph():
+    """Return the graph compiled against an aiosqlite checkpointer, for ainvoke()/astream() callers.
+
+    Built lazily on the running loop; it shares the checkpoint file with the sync graph.
+    """
+    global _async_graph, _async_graph_lock
+    if _async_graph is None:
+        if _async_graph_lock is None:
+            _async_graph_lock = asyncio.Lock()
+        async with _async_graph_lock:
+            if _async_graph is None:
+                aconn = await aiosqlite.connect(CHECKPOINT_DB_NAME)
+                await aconn.execute("PRAGMA journal_mode=WAL")
+                await aconn.execute("PRAGMA busy_timeout=5000")
+                _async_graph = workflow.compile(checkpointer=AsyncSqliteSaver(aconn))
+    return _async_graph
+
+async def close_async_graph():
+    """Close the aiosqlite connection; its worker thread would otherwise keep the process alive."""
+    global _async_graph
+    if _async_graph is not None:
+        await _async_graph.checkpointer.conn.close()
+        _async_graph = None
+
 def summarize_pdf_full(filepath: str):
     """Summarize a PDF file and return summary with token count."""
     try:
-        with open(filepath, 'rb') as f:
-            reader = PyPDF2.PdfReader(f)
-            text = ""
-            for page in reader.pages:
-                text += page.extract_text() or ""
+        text = "".join(get_pdf_pages(filepath))
         
         if not text.strip():
             return "Could not extract text from PDF.", 0
         
         text = text[:8000]
         
-        model = get_model()
+        model = cached(get_model())
         prompt = f"Please provide a comprehensive summary of the following document:\n\n{text}"
         
-        response = model.invoke([HumanMessage(content=prompt)])
+        with admission.context(priority=admission.BACKGROUND):
+            response = model.invoke([HumanMessage(content=prompt)])
         
         tokens_used = 0
         if hasattr(response, 'usage_metadata') and response.usage_metadata:
             tokens_used = response.usage_metadata.get('total_tokens', 0)
         
         return response.content, tokens_used
+    except AdmissionRejected:
+        raise
     except Exception as e:
         print(f"PDF summarization error: {e}")
         return f"Error summarizing PDF: {str(e)}", 0
@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from langchain_core.messages import message_to_dict, messages_from_dict
+from langchain_core.output_parsers.openai_tools import JsonOutputKeyToolsParser, PydanticToolsParser
+from langchain_core.runnables import RunnableLambda
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from pydantic import BaseModel
+
+import metrics
+from database import get_llm_cache, put_llm_cache, evict_llm_cache
+
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE", "1") != "0"
+# Regular chat turns are sampled at temperature > 0, so they skip the cache unless asked
+LLM_CACHE_CHAT = os.environ.get("LLM_CACHE_CHAT", "0") == "1"
+LLM_CACHE_MEMORY_ENTRIES = int(os.environ.get("LLM_CACHE_MEMORY_ENTRIES", "256"))
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_BYTES = int(os.environ.get("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+EVICT_EVERY = 100
+
+_memory = OrderedDict()
+_lock = threading.Lock()
+_stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "puts": 0}
+
+def cache_stats():
+    with _lock:
+        return dict(_stats, memory_entries=len(_memory))
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+        return _stats[name]
+
+def _normalize(messages):
+    norm = []
+    for m in messages:
+        d = message_to_dict(m)["data"]
+        entry = {"type": m.type, "content": d.get("content")}
+        if d.get("tool_calls"):
+            entry["tool_calls"] = [{"name": c["name"], "args": c["args"]} for c in d["tool_calls"]]
+        if d.get("tool_call_id"):
+            entry["tool_call_id"] = d["tool_call_id"]
+        norm.append(entry)
+    return norm
+
+def cache_key(model, messages, tools=None, tool_choice=None) -> str:
+    payload = {
+        "model": getattr(model, "model_name", None) or getattr(model, "model", None),
+        "temperature": getattr(model, "temperature", None),
+        "messages": _normalize(messages),
+        "tools": [convert_to_openai_tool(t) for t in tools or []],
+    }
+    if tool_choice is not None:
+        payload["tool_choice"] = tool_choice
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def _lookup(key):
+    with _lock:
+        hit = _memory.get(key)
+        if hit is not None:
+            _memory.move_to_end(key)
+    if hit is not None:
+        _count("memory_hits")
+        return hit
+
+    hit = get_llm_cache(key, time.time() - LLM_CACHE_TTL)
+    if hit is not None:
+        _count("disk_hits")
+        _remember(key, hit)
+        return hit
+    _count("misses")
+    return None
+
+def _remember(key, serialized):
+    with _lock:
+        _memory[key] = serialized
+        _memory.move_to_end(key)
+        while len(_memory) > LLM_CACHE_MEMORY_ENTRIES:
+            _memory.popitem(last=False)
+
+def _store(key, response):
+    serialized = json.dumps(message_to_dict(response))
+    _remember(key, serialized)
+    put_llm_cache(key, serialized)
+    if _count("puts") % EVICT_EVERY == 0:
+        evict_llm_cache(LLM_CACHE_MAX_BYTES, time.time() - LLM_CACHE_TTL)
+
+class CachedModel:
+    """Wraps a chat model (optionally with tools bound) and serves repeated prompts from the cache.
+
+    Cache hits carry no usage_metadata, so they are not billed to the user again.
+    """
+
+    def __init__(self, model, tools=None, tool_choice=None):
+        self.model = model
+        self.tools = list(tools or [])
+        self.tool_choice = tool_choice
+        self.bound = model.bind_tools(self.tools, tool_choice=tool_choice) if self.tools else model
+
+    def invoke(self, messages, *args, **kwargs):
+        key, response = self._hit(messages)
+        if response is not None:
+            return response
+        response = self.bound.invoke(messages, *args, **kwargs)
+        self._save(key, response)
+        return response
+
+    async def ainvoke(self, messages, *args, **kwargs):
+        # Cache reads and writes are local SQLite calls; only the model call is awaited
+        key, response = self._hit(messages)
+        if response is not None:
+            return response
+        response = await self.bound.ainvoke(messages, *args, **kwargs)
+        self._save(key, response)
+        return response
+
+    def with_structured_output(self, schema, include_raw=False):
+        """Like the model's with_structured_output (function calling), with the tool call cached.
+
+        The raw AIMessage goes through the cache and is parsed after, so hits are parsed the same way.
+        """
+        name = convert_to_openai_tool(schema)["function"]["name"]
+        forced = CachedModel(self.model, [schema], tool_choice=name)
+        if isinstance(schema, type) and issubclass(schema, BaseModel):
+            parser = PydanticToolsParser(tools=[schema], first_tool_only=True)
+        else:
+            parser = JsonOutputKeyToolsParser(key_name=name, first_tool_only=True)
+
+        def parse(raw):
+            if not include_raw:
+                return parser.invoke(raw)
+            try:
+                return {"raw": raw, "parsed": parser.invoke(raw), "parsing_error": None}
+            except Exception as e:
+                return {"raw": raw, "parsed": None, "parsing_error": e}
+
+        async def aparse(messages):
+            return parse(await forced.ainvoke(messages))
+
+        return RunnableLambda(lambda messages: parse(forced.invoke(messages)), afunc=aparse)
+
+    def _hit(self, messages):
+        key = cache_key(self.model, messages, self.tools, self.tool_choice)
+        hit = _lookup(key)
+        if hit is None:
+            return key, None
+        response = messages_from_dict([json.loads(hit)])[0]
+        response.usage_metadata = None
+        return key, response
+
+    def _save(self, key, response):
+        try:
+            _store(key, response)
+        except Exception as e:
+            print(f"LLM cache write error: {e}")
+
+    def __getattr__(self, name):
+        return getattr(self.bound, name)
+
+def _collect():
+    s = cache_stats()
+    return [
+        ("llm_cache_memory_hits_total", "counter", "LLM responses served from the in-memory cache", s["memory_hits"]),
+        ("llm_cache_disk_hits_total", "counter", "LLM responses served from the SQLite cache", s["disk_hits"]),
+        ("llm_cache_misses_total", "counter", "LLM cache lookups that went to the provider", s["misses"]),
+        ("llm_cache_memory_entries", "gauge", "Entries in the in-memory LLM cache", s["memory_entries"]),
+    ]
+
+metrics.register_collector(_collect)
+
+def cached(model, tools=None, enabled=None):
+    """Return model (with tools bound) behind the response cache, or unwrapped if caching is off."""
+    enabled = LLM_CACHE_ENABLED if enabled is None else enabled
+    if not enabled:
+        return model.bind_tools(tools) if tools else model
+    return CachedModel(model, tools)
@@ -0,0 +1,272 @@
+"""In-process metrics in the Prometheus text format, served by server.py at /metrics.
+
+span(kind, name) times a block into the study_guide_span_seconds histogram and the
+in-flight gauge for its kind; timed() does the same for a whole function, sync or
+async. When a request carries TRACE_HEADER, the spans recorded while serving it
+are linked by parent id and printed as one JSON line when the request finishes.
+"""
+import os
+import json
+import time
+import uuid
+import bisect
+import inspect
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+
+PREFIX = "study_guide_"
+TRACE_HEADER = os.environ.get("TRACE_HEADER", "X-Trace-Id")
+# Also trace requests that did not send the header
+TRACE_ALL = os.environ.get("TRACE_ALL", "0") == "1"
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_lock = threading.Lock()
+_metrics = {}
+_collectors = []
+
+def _label_str(labels):
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+def _format_value(value):
+    # :g keeps only 6 significant digits, which makes large counters jump in steps
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = PREFIX + name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple((n, labels.get(n, "")) for n in self.labelnames)
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        return [(self.name, key, value) for key, value in self._values.items()]
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with _lock:
+            self._values[self._key(labels)] = value
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        out = []
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                out.append((self.name + "_bucket", key + (("le", f"{bound:g}"),), cumulative))
+            out.append((self.name + "_bucket", key + (("le", "+Inf"),), count))
+            out.append((self.name + "_sum", key, total))
+            out.append((self.name + "_count", key, count))
+        return out
+
+def _register(metric):
+    with _lock:
+        return _metrics.setdefault(metric.name, metric)
+
+def counter(name, help_text, labelnames=()):
+    return _register(Counter(name, help_text, labelnames))
+
+def gauge(name, help_text, labelnames=()):
+    return _register(Gauge(name, help_text, labelnames))
+
+def histogram(name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, help_text, labelnames, buckets))
+
+def register_collector(fn):
+    """fn() -> iterable of (name, type, help, value) read fresh on every scrape, e.g. queue depths."""
+    _collectors.append(fn)
+
+def render() -> str:
+    lines = []
+    with _lock:
+        for metric in _metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, key, value in metric.samples():
+                lines.append(f"{name}{_label_str(key)} {_format_value(value)}")
+    for collect in _collectors:
+        try:
+            for name, kind, help_text, value in collect():
+                lines.append(f"# HELP {PREFIX}{name} {help_text}")
+                lines.append(f"# TYPE {PREFIX}{name} {kind}")
+                lines.append(f"{PREFIX}{name} {_format_value(value)}")
+        except Exception as e:
+            print(f"Metrics collector error: {e}")
+    return "\n".join(lines) + "\n"
+
+SPAN_SECONDS = histogram("span_seconds", "Time spent in graph nodes, tools, model calls, SQLite helpers, PDF parsing and TTS",
+                         ("kind", "name"))
+SPAN_ERRORS = counter("span_errors_total", "Spans that ended with an exception", ("kind", "name"))
+INFLIGHT = gauge("inflight", "Spans currently running", ("kind",))
+LLM_TOKENS = counter("llm_tokens_total", "Tokens reported by the provider", ("model", "type"))
+HTTP_SECONDS = histogram("http_request_seconds", "Request handling time, up to the first byte for streams",
+                         ("endpoint", "method", "status"))
+
+# --- traces ---
+
+class Trace:
+    def __init__(self, trace_id):
+        self.id = trace_id
+        self.started = time.monotonic()
+        self.spans = []
+        self._ids = 0
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self._ids += 1
+            span["id"] = self._ids
+            self.spans.append(span)
+        return span
+
+    def dump(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s["start"])
+        print("trace " + json.dumps({"trace_id": self.id, "spans": spans}))
+
+_trace = contextvars.ContextVar("metrics_trace", default=None)
+_parent = contextvars.ContextVar("metrics_parent_span", default=None)
+
+def trace_id_for(header_value):
+    """The id to trace a request under: its header value, a fresh id under TRACE_ALL, else None."""
+    if header_value:
+        return header_value[:64]
+    return uuid.uuid4().hex if TRACE_ALL else None
+
+def start_trace(trace_id):
+    """Make trace current; returns (trace, token) for detach_trace()."""
+    trace = Trace(trace_id)
+    return trace, _trace.set(trace)
+
+def detach_trace(token):
+    _trace.reset(token)
+
+def current_trace_id():
+    trace = _trace.get()
+    return trace.id if trace else None
+
+def traced_iter(trace, iterable):
+    """Re-enter trace around each step of a streamed response and print it when the stream ends."""
+    try:
+        iterator = iter(iterable)
+        while True:
+            token = _trace.set(trace)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                _trace.reset(token)
+            yield item
+    finally:
+        if hasattr(iterable, "close"):
+            iterable.close()
+        trace.dump()
+
+# --- spans ---
+
+@contextmanager
+def span(kind, name):
+    trace = _trace.get()
+    record = None
+    token = None
+    if trace is not None:
+        record = trace.add({"kind": kind, "name": name, "parent": _parent.get(),
+                            "start": round(time.monotonic() - trace.started, 6)})
+        token = _parent.set(record["id"])
+    INFLIGHT.inc(kind=kind)
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = e
+        SPAN_ERRORS.inc(kind=kind, name=name)
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        INFLIGHT.dec(kind=kind)
+        SPAN_SECONDS.observe(seconds, kind=kind, name=name)
+        if record is not None:
+            record["seconds"] = round(seconds, 6)
+            if error is not None:
+                record["error"] = type(error).__name__
+            _parent.reset(token)
+
+def timed(kind, name=None):
+    """Decorator form of span(); works on plain functions and coroutine functions."""
+    def wrap(fn):
+        span_name = name or fn.__name__
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def awrapper(*args, **kwargs):
+                with span(kind, span_name):
+                    return await fn(*args, **kwargs)
+            return awrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(kind, span_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return wrap
+
+def instrument_module(namespace, kind, skip=()):
+    """Wrap every public function defined in a module's globals() with timed(kind)."""
+    module = namespace["__name__"]
+    for attr, value in list(namespace.items()):
+        if (inspect.isfunction(value) and value.__module__ == module
+                and not attr.startswith("_") and attr not in skip):
+            namespace[attr] = timed(kind)(value)
+
+def record_tokens(model, usage):
+    if not usage:
+        return
+    LLM_TOKENS.inc(usage.get("input_tokens", 0), model=model, type="input")
+    LLM_TOKENS.inc(usage.get("output_tokens", 0), model=model, type="output")
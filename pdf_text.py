@@ -0,0 +1,69 @@
+import os
+import hashlib
+import functools
+import fitz  # PyMuPDF
+
+from database import get_cached_pdf_pages, save_cached_pdf_pages
+from metrics import timed
+
+PDF_DIGEST_MEMO_SIZE = int(os.environ.get("PDF_DIGEST_MEMO_SIZE", "1024"))
+
+def hash_file(filepath: str) -> str:
+    h = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+# Keyed on (filepath, size, mtime_ns), so unchanged files are not re-hashed every turn
+@functools.lru_cache(maxsize=PDF_DIGEST_MEMO_SIZE)
+def _memo_digest(filepath: str, size: int, mtime_ns: int) -> str:
+    return hash_file(filepath)
+
+def file_digest(filepath: str) -> str:
+    st = os.stat(filepath)
+    return _memo_digest(os.path.abspath(filepath), st.st_size, st.st_mtime_ns)
+
+@timed("pdf", "extract_pages")
+def extract_pages(filepath: str) -> list:
+    """Parse every page with fitz, bypassing the cache."""
+    with fitz.open(filepath) as doc:
+        return [page.get_text() or "" for page in doc]
+
+def get_pdf_pages(filepath: str) -> list:
+    """Return the text of every page, parsing the PDF only the first time its content is seen."""
+    digest = file_digest(filepath)
+    pages = get_cached_pdf_pages(digest)
+    if pages is None:
+        pages = extract_pages(filepath)
+        save_cached_pdf_pages(digest, pages)
+    return pages
+
+def chunk_pages(pages: list, chunk_chars: int = 2000) -> list:
+    """Group page texts into chunks of roughly chunk_chars, remembering which pages (1-based) they span.
+
+    Short pages are packed together; a page longer than chunk_chars is split into several chunks.
+    """
+    chunks = []
+    buf, start, last = "", None, None
+    
+    def flush():
+        if buf:
+            chunks.append({"page_start": start, "page_end": last, "text": buf})
+    
+    for page_no, text in enumerate(pages, start=1):
+        text = text.strip()
+        if not text:
+            continue
+        if buf and len(buf) + len(text) > chunk_chars:
+            flush()
+            buf, start = "", None
+        while len(text) > chunk_chars:
+            chunks.append({"page_start": page_no, "page_end": page_no, "text": text[:chunk_chars]})
+            text = text[chunk_chars:]
+        if start is None:
+            start = page_no
+        buf = f"{buf}\n{text}" if buf else text
+        last = page_no
+    flush()
+    return chunks
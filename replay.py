@@ -0,0 +1,264 @@
+"""Replay a traffic capture (see capture.py) against a running server.
+
+Requests are sent at their captured offsets divided by --speed, with at most
+--concurrency in flight. Payloads are rebuilt from the recorded shapes with
+synthetic text and PDFs of the same size. Anonymized users get replay accounts,
+and captured thread ids, file paths and file ids are mapped onto the ones the
+target server hands out, so a follow-up turn waits for the request that
+created its thread. To run against the stub backends:
+
+    python benchmark.py --serve 5000
+    python replay.py traffic.jsonl --target http://127.0.0.1:5000 --speed 4 --concurrency 32
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmark import make_pdf, percentile, words
+
+ANON_RE = re.compile(r"^(u|t|f|fid)_[0-9a-f]{12}$")
+REPLAY_PASSWORD = "replay"
+# Synthetic pages from benchmark.make_pdf come out at roughly this size
+PDF_BYTES_PER_PAGE = 2500
+ID_FIELDS = ("thread_id", "filepath", "file_id")
+
+class Replayer:
+    def __init__(self, target, records, speed=1.0, concurrency=16, max_gap=None, timeout=300, seed=1234):
+        self.target = target.rstrip("/")
+        self.records = records
+        self.speed = speed
+        self.concurrency = concurrency
+        self.max_gap = max_gap
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self._local = threading.local()
+        self._ids = {}
+        self._ready = defaultdict(threading.Event)
+        self._lock = threading.Lock()
+        self._pdfs = {}
+        self._pdf_dir = tempfile.mkdtemp(prefix="replay-pdfs-")
+        # Anonymized ids some captured response produced; requests using them wait for that response
+        self._produced = {v for r in records for v in (r.get("response") or {}).values()}
+        self.results = []
+
+    def session(self):
+        s = getattr(self._local, "session", None)
+        if s is None:
+            s = self._local.session = requests.Session()
+        return s
+
+    # --- id mapping ---
+
+    def _learn(self, anon_ids, payload):
+        if not isinstance(payload, dict):
+            return
+        for field in ID_FIELDS:
+            anon = anon_ids.get(field)
+            if anon and payload.get(field) not in (None, ""):
+                with self._lock:
+                    self._ids[anon] = payload[field]
+                self._ready[anon].set()
+
+    def _resolve(self, token):
+        kind = token.split("_", 1)[0]
+        if kind == "u":
+            return f"replay_{token}"
+        if token in self._produced:
+            self._ready[token].wait(self.timeout)
+        with self._lock:
+            # Unknown ids were created before the capture started; let the server make new ones
+            return self._ids.get(token)
+
+    def build(self, value):
+        if isinstance(value, dict):
+            if set(value) == {"str"}:
+                return words(self.rng, max(value["str"] // 6, 1))[:value["str"]]
+            return {k: self.build(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.build(v) for v in value]
+        if isinstance(value, str) and ANON_RE.match(value):
+            return self._resolve(value)
+        return value
+
+    def _pdf(self, size):
+        pages = max(1, round(size / PDF_BYTES_PER_PAGE))
+        with self._lock:
+            path = self._pdfs.get(pages)
+            if path is None:
+                path = os.path.join(self._pdf_dir, f"replay_{pages}p.pdf")
+                make_pdf(path, pages, random.Random(pages))
+                self._pdfs[pages] = path
+        return path
+
+    # --- sending ---
+
+    def register_users(self):
+        users = {r["user"] for r in self.records if r.get("user")}
+        for anon in users:
+            self.session().post(f"{self.target}/api/register",
+                                json={"username": f"replay_{anon}", "password": REPLAY_PASSWORD}, timeout=30)
+        return len(users)
+
+    def send(self, record, scheduled):
+        body = record.get("request") or {}
+        kwargs = {"timeout": self.timeout}
+        if "json" in body:
+            payload = self.build(body["json"])
+            if record["path"] in ("/api/register", "/api/login"):
+                payload["password"] = REPLAY_PASSWORD
+            kwargs["json"] = payload
+        if "form" in body:
+            kwargs["data"] = self.build(body["form"])
+        if "args" in body:
+            kwargs["params"] = self.build(body["args"])
+        files = {}
+        for name, meta in (body.get("files") or {}).items():
+            files[name] = open(self._pdf(meta.get("bytes", 0)), "rb")
+        if files:
+            kwargs["files"] = {n: (f"replay{(body['files'][n].get('ext') or '.pdf')}", f) for n, f in files.items()}
+
+        started = time.perf_counter()
+        lag = started - scheduled
+        status, error = None, None
+        anon_ids = record.get("response") or {}
+        try:
+            streamed = record.get("streamed")
+            response = self.session().request(record["method"], self.target + record["path"],
+                                              stream=bool(streamed), **kwargs)
+            status = response.status_code
+            if streamed:
+                for line in response.iter_lines(decode_unicode=True):
+                    if line and line.startswith("data: "):
+                        try:
+                            self._learn(anon_ids, json.loads(line[6:]))
+                        except ValueError:
+                            pass
+            elif "json" in response.headers.get("Content-Type", ""):
+                self._learn(anon_ids, response.json())
+            else:
+                response.content
+        except Exception as e:
+            error = str(e)
+        finally:
+            for f in files.values():
+                f.close()
+            # Never leave a dependent request waiting on a response that did not come
+            for anon in anon_ids.values():
+                self._ready[anon].set()
+        seconds = time.perf_counter() - started
+        return {"endpoint": record.get("endpoint") or record["path"], "status": status, "error": error,
+                "seconds": seconds, "lag": lag, "captured_seconds": record.get("duration")}
+
+    def run(self):
+        records = [r for r in self.records if r.get("path")]
+        if not records:
+            return []
+        offsets, previous, offset = [], records[0]["ts"], 0.0
+        for r in records:
+            gap = r["ts"] - previous
+            if self.max_gap is not None:
+                gap = min(gap, self.max_gap)
+            offset += gap
+            previous = r["ts"]
+            offsets.append(offset / self.speed)
+
+        start = time.perf_counter()
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for record, at in zip(records, offsets):
+                delay = start + at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                futures.append(pool.submit(self.send, record, start + at))
+            self.results = [f.result() for f in futures]
+        self.wall_seconds = time.perf_counter() - start
+        return self.results
+
+def summarize(results, wall_seconds):
+    by_endpoint = defaultdict(list)
+    for r in results:
+        by_endpoint[r["endpoint"]].append(r)
+
+    def stats(rows):
+        seconds = sorted(r["seconds"] for r in rows if not r["error"])
+        lags = sorted(r["lag"] for r in rows)
+        captured = sorted(r["captured_seconds"] for r in rows if r["captured_seconds"] is not None)
+        statuses = defaultdict(int)
+        for r in rows:
+            statuses[str(r["status"] or "error")] += 1
+        return {
+            "requests": len(rows),
+            "errors": sum(1 for r in rows if r["error"] or (r["status"] or 0) >= 500),
+            "status": dict(statuses),
+            "latency_seconds": {"p50": percentile(seconds, 50), "p90": percentile(seconds, 90),
+                                "p99": percentile(seconds, 99)},
+            "captured_latency_seconds": {"p50": percentile(captured, 50), "p99": percentile(captured, 99)},
+            "schedule_lag_seconds": {"p50": percentile(lags, 50), "p99": percentile(lags, 99)},
+        }
+
+    return {
+        "wall_seconds": round(wall_seconds, 4),
+        "throughput_rps": round(len(results) / wall_seconds, 2) if wall_seconds else None,
+        "overall": stats(results),
+        "endpoints": {name: stats(rows) for name, rows in sorted(by_endpoint.items())},
+    }
+
+def load_capture(path, limit=None):
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    records.sort(key=lambda r: r["ts"])
+    return records[:limit] if limit else records
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a traffic capture against a running server.")
+    parser.add_argument("capture", help="JSONL file written with TRAFFIC_CAPTURE")
+    parser.add_argument("--target", default="http://127.0.0.1:5000")
+    parser.add_argument("--speed", type=float, default=1.0, help="time compression, e.g. 10 replays 10x faster")
+    parser.add_argument("--concurrency", type=int, default=16, help="maximum requests in flight")
+    parser.add_argument("--max-gap", type=float, help="cap idle gaps between requests at this many seconds")
+    parser.add_argument("--limit", type=int, help="replay only the first N requests")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--out", help="write the summary as JSON")
+    args = parser.parse_args(argv)
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+
+    records = load_capture(args.capture, args.limit)
+    replayer = Replayer(args.target, records, args.speed, args.concurrency, args.max_gap, args.timeout)
+    print(f"registering {replayer.register_users()} replay users")
+    skipped = sum(1 for r in records if not r.get("path"))
+    print(f"replaying {len(records) - skipped} requests ({skipped} with URL parameters skipped) "
+          f"at {args.speed:g}x, concurrency {args.concurrency}")
+    replayer.run()
+
+    summary = summarize(replayer.results, getattr(replayer, "wall_seconds", 0.0))
+    summary["meta"] = {"capture": os.path.abspath(args.capture), "target": args.target, "speed": args.speed,
+                       "concurrency": args.concurrency, "max_gap": args.max_gap, "skipped": skipped}
+    for name, s in summary["endpoints"].items():
+        lat = s["latency_seconds"]
+        print(f"  {name:28s} n={s['requests']:<5d} err={s['errors']:<4d} "
+              f"p50={lat['p50'] or 0:.4f}s p99={lat['p99'] or 0:.4f}s "
+              f"lag p99={s['schedule_lag_seconds']['p99'] or 0:.3f}s")
+    print(f"  {summary['throughput_rps']} req/s over {summary['wall_seconds']}s")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"wrote {args.out}")
+    return 0 if summary["overall"]["errors"] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy import sparse
+
+from database import get_pdf_chunks, save_pdf_chunks
+from pdf_text import file_digest, get_pdf_pages, chunk_pages
+
+INDEX_DIR = os.environ.get("RETRIEVAL_INDEX_DIR", "indexes")
+TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", "6"))
+BM25_K1 = 1.5
+BM25_B = 0.75
+MAX_LOADED_INDEXES = 32
+
+STOPWORDS = frozenset("""a an and are as at be by can do does for from has have how i in is it its
+me my of on or so that the their them there these this to was we what when where which who why
+will with you your about into than then explain tell give please""".split())
+
+# Prompts that ask about the document as a whole still go through the full summarize path
+WHOLE_DOCUMENT_WORDS = ("summar", "overview", "outline", "entire", "whole", "every chapter", "all chapters")
+
+_loaded = OrderedDict()
+_loaded_lock = threading.Lock()
+
+def tokenize(text: str) -> list:
+    return [t for t in re.findall(r"[a-z0-9]+", text.lower()) if t not in STOPWORDS and len(t) > 1]
+
+def is_question_prompt(prompt: str) -> bool:
+    p = prompt.lower()
+    return not any(w in p for w in WHOLE_DOCUMENT_WORDS)
+
+class BM25Index:
+    """Okapi BM25 over one document's chunks, stored as a chunks x terms sparse count matrix."""
+
+    def __init__(self, vocab: dict, tf, doc_len):
+        self.vocab = vocab
+        self.tf = tf.tocsc()
+        self.doc_len = doc_len
+        n_docs = tf.shape[0]
+        df = np.diff(self.tf.indptr)
+        self.idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+        self.avgdl = doc_len.mean() if n_docs else 0.0
+
+    @classmethod
+    def build(cls, texts: list):
+        vocab = {}
+        rows, cols, vals = [], [], []
+        doc_len = np.zeros(len(texts), dtype=np.float32)
+        for i, text in enumerate(texts):
+            counts = {}
+            for tok in tokenize(text):
+                j = vocab.setdefault(tok, len(vocab))
+                counts[j] = counts.get(j, 0) + 1
+            rows.extend([i] * len(counts))
+            cols.extend(counts.keys())
+            vals.extend(counts.values())
+            doc_len[i] = sum(counts.values())
+        tf = sparse.csr_matrix((np.array(vals, dtype=np.float32), (rows, cols)),
+                               shape=(len(texts), len(vocab)))
+        return cls(vocab, tf, doc_len)
+
+    def save(self, path: str):
+        terms = np.array(sorted(self.vocab, key=self.vocab.get))
+        csr = self.tf.tocsr()
+        np.savez_compressed(path, terms=terms, data=csr.data, indices=csr.indices,
+                            indptr=csr.indptr, shape=np.array(csr.shape), doc_len=self.doc_len)
+
+    @classmethod
+    def load(cls, path: str):
+        z = np.load(path, allow_pickle=False)
+        vocab = {t: i for i, t in enumerate(z["terms"].tolist())}
+        tf = sparse.csr_matrix((z["data"], z["indices"], z["indptr"]), shape=tuple(z["shape"]))
+        return cls(vocab, tf, z["doc_len"])
+
+    def scores(self, query: str):
+        ids = sorted({self.vocab[t] for t in tokenize(query) if t in self.vocab})
+        if not ids or self.tf.shape[0] == 0:
+            return np.zeros(self.tf.shape[0], dtype=np.float32)
+        sub = self.tf[:, ids].tocoo()
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_len[sub.row] / max(self.avgdl, 1e-9))
+        weights = self.idf[np.array(ids)[sub.col]] * sub.data * (BM25_K1 + 1) / (sub.data + norm)
+        return np.bincount(sub.row, weights=weights, minlength=self.tf.shape[0])
+
+    def top_k(self, query: str, k: int):
+        s = self.scores(query)
+        hits = np.nonzero(s > 0)[0]
+        if len(hits) == 0:
+            return []
+        order = hits[np.argsort(-s[hits], kind="stable")][:k]
+        return [(int(i), float(s[i])) for i in order]
+
+def _index_path(content_hash: str) -> str:
+    return os.path.join(INDEX_DIR, f"{content_hash}.npz")
+
+def ensure_chunks(filepath: str, content_hash: str) -> list:
+    chunks = get_pdf_chunks(content_hash)
+    if not chunks:
+        chunks = chunk_pages(get_pdf_pages(filepath))
+        save_pdf_chunks(content_hash, chunks)
+        chunks = get_pdf_chunks(content_hash)
+    return chunks
+
+def build_index(content_hash: str, chunks: list) -> BM25Index:
+    """Build and persist the index for a document; called at ingestion time and on first query."""
+    index = BM25Index.build([c["text"] for c in chunks])
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    tmp = _index_path(content_hash) + ".tmp.npz"
+    index.save(tmp)
+    os.replace(tmp, _index_path(content_hash))
+    with _loaded_lock:
+        _loaded[content_hash] = index
+        while len(_loaded) > MAX_LOADED_INDEXES:
+            _loaded.popitem(last=False)
+    return index
+
+def get_index(content_hash: str, chunks: list) -> BM25Index:
+    with _loaded_lock:
+        index = _loaded.get(content_hash)
+        if index is not None:
+            _loaded.move_to_end(content_hash)
+            return index
+    path = _index_path(content_hash)
+    if os.path.exists(path):
+        try:
+            index = BM25Index.load(path)
+            if index.tf.shape[0] == len(chunks):
+                with _loaded_lock:
+                    _loaded[content_hash] = index
+                    while len(_loaded) > MAX_LOADED_INDEXES:
+                        _loaded.popitem(last=False)
+                return index
+        except Exception as e:
+            print(f"Retrieval index load error: {e}")
+    return build_index(content_hash, chunks)
+
+def retrieve_chunks(filepath: str, query: str, k: int = TOP_K) -> list:
+    """Return the k chunks of a PDF most relevant to query, best first, each with a 'score'."""
+    content_hash = file_digest(filepath)
+    chunks = ensure_chunks(filepath, content_hash)
+    if not chunks:
+        return []
+    index = get_index(content_hash, chunks)
+    return [dict(chunks[i], score=score) for i, score in index.top_k(query, k)]
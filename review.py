@@ -0,0 +1,77 @@
+"""Spaced-repetition review of generated flashcards and MCQs, scheduled with SM-2.
+
+Each answer is graded 0-5 ("quality"). A grade below 3 is a lapse that restarts
+the card at a one-day interval; otherwise the interval grows 1 day, 6 days, then
+by the card's ease factor, which itself drifts with how hard the answers were.
+"""
+import os
+import time
+
+from database import get_review_queue, get_card, update_card_schedule
+from grading import grade_locally
+
+REVIEW_BATCH_SIZE = int(os.environ.get("REVIEW_BATCH_SIZE", "20"))
+MIN_EASE = 1.3
+DAY = 86400
+# Quality given to a locally graded answer
+CORRECT_QUALITY = 4
+WRONG_QUALITY = 1
+
+def sm2(ease, interval_days, repetitions, lapses, quality):
+    """Return the next (ease, interval_days, repetitions, lapses) after an answer of the given quality."""
+    if quality < 3:
+        repetitions, interval_days, lapses = 0, 1, lapses + 1
+    else:
+        repetitions += 1
+        if repetitions == 1:
+            interval_days = 1
+        elif repetitions == 2:
+            interval_days = 6
+        else:
+            interval_days = round(interval_days * ease, 2)
+    ease = max(MIN_EASE, ease + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+    return round(ease, 4), interval_days, repetitions, lapses
+
+def next_cards(username, limit=REVIEW_BATCH_SIZE, now=None):
+    """Return {"cards", "has_more", "next_due_at"} with up to `limit` cards due now."""
+    now = time.time() if now is None else now
+    queue = get_review_queue(username, limit + 1)
+    due = [c for c in queue if c["due_at"] <= now]
+    upcoming = queue[len(due):]
+    return {
+        "cards": due[:limit],
+        "has_more": len(due) > limit,
+        "next_due_at": upcoming[0]["due_at"] if upcoming else None,
+    }
+
+def answer_quality(card, user_answer):
+    """Grade a typed answer locally; None when it needs a self-rated quality instead."""
+    grade = grade_locally({"type": "mcq" if card["kind"] == "mcq" else "text",
+                           "correct_answer": card["answer"], "user_answer": user_answer})
+    if grade is None:
+        return None
+    return CORRECT_QUALITY if grade["correct"] else WRONG_QUALITY
+
+def answer_card(username, card_id, quality=None, user_answer=None, now=None):
+    """Record one review and reschedule the card.
+
+    Returns the updated card, None if the user has no such card, or raises
+    ValueError when the answer cannot be graded without a quality.
+    """
+    card = get_card(username, card_id)
+    if card is None:
+        return None
+    if quality is None and user_answer is not None:
+        quality = answer_quality(card, user_answer)
+    if quality is None:
+        raise ValueError("quality (0-5) is required for this answer")
+    quality = max(0, min(5, int(quality)))
+
+    now = time.time() if now is None else now
+    ease, interval_days, repetitions, lapses = sm2(card["ease"], card["interval_days"], card["repetitions"],
+                                                   card["lapses"], quality)
+    due_at = now + interval_days * DAY
+    update_card_schedule(card_id, ease, interval_days, repetitions, lapses, due_at, now)
+    card.update(ease=ease, interval_days=interval_days, repetitions=repetitions, lapses=lapses,
+                due_at=due_at, last_reviewed_at=now, quality=quality)
+    return card
@@ -1,20 +1,70 @@
-from flask import Flask, render_template, request, jsonify, send_file, Response
+from flask import Flask, render_template, request, jsonify, send_file, Response, g
 from werkzeug.utils import secure_filename
-from llm import graph, summarize_pdf_full, get_model
+from llm import graph, memory, summarize_pdf_full, get_model
+from compaction import start_compaction_scheduler
+from user_context import get_context, invalidate as invalidate_context
+from charts import chart_path
+from tts import AUDIO_DIR, is_pending, stream_audio, synthesis_error
 from database import (register_user, verify_user, create_thread_entry, 
                       get_user_threads, update_thread_title, delete_thread_entry,
                       save_message, get_thread_messages, get_user_profile,
                       update_user_profile, add_user_tokens, get_user_notes,
                       add_user_note, delete_user_note, save_uploaded_file, get_user_files,
-                      delete_uploaded_file_by_id, get_thread_files)
+                      delete_uploaded_file_by_id, get_thread_files, link_pending_files,
+                      get_file_statuses, get_thread_messages_page, get_user_threads_page,
+                      search_user_content)
+from ingest import submit_ingestion, resume_pending
+from grading import score_answers
+from review import REVIEW_BATCH_SIZE, next_cards, answer_card
+import admission
+import metrics
+import capture
+from admission import AdmissionRejected
 import uuid
 import os
 import json
+import time
+import base64
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 UPLOAD_FOLDER = 'uploads'
+MAX_PAGE_SIZE = 200
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+capture.init_app(app)
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    trace_id = metrics.trace_id_for(request.headers.get(metrics.TRACE_HEADER))
+    if trace_id:
+        g.trace, g.trace_token = metrics.start_trace(trace_id)
+
+@app.after_request
+def finish_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.HTTP_SECONDS.observe(time.perf_counter() - g.request_started, endpoint=endpoint,
+                                 method=request.method, status=response.status_code)
+    trace = g.pop("trace", None)
+    if trace is not None:
+        metrics.detach_trace(g.pop("trace_token"))
+        response.headers[metrics.TRACE_HEADER] = trace.id
+        if response.is_streamed:
+            # Streams produce most of their spans after this hook; print the trace when they end
+            response.response = metrics.traced_iter(trace, response.response)
+        else:
+            trace.dump()
+    return response
+
+@app.route('/metrics')
+def serve_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.errorhandler(AdmissionRejected)
+def too_busy(e):
+    response = jsonify({"error": str(e), "retry_after": e.retry_after})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 429
 
 @app.route('/')
 def home():
@@ -53,6 +103,7 @@ def update_profile():
         data.get('strengths', ''),
         data.get('weaknesses', '')
     )
+    invalidate_context(data['username'])
     return jsonify({"status": "updated"})
 
 @app.route('/api/notes', methods=['POST'])
@@ -65,12 +116,13 @@ def get_notes():
 def add_note():
     data = request.json
     add_user_note(data['username'], data['date'], data['text'])
+    invalidate_context(data['username'])
     return jsonify({"status": "added"})
 
 @app.route('/api/notes/delete', methods=['POST'])
 def delete_note():
     note_id = request.json.get("note_id")
-    delete_user_note(note_id)
+    invalidate_context(delete_user_note(note_id))
     return jsonify({"status": "deleted"})
 
 @app.route('/api/upload', methods=['POST'])
@@ -89,8 +141,12 @@ def upload_file():
         filename = secure_filename(file.filename)
         filepath = os.path.join(UPLOAD_FOLDER, f"{username}_{uuid.uuid4().hex[:8]}_{filename}")
         file.save(filepath)
-        save_uploaded_file(username, filename, filepath, thread_id)
-        return jsonify({"status": "uploaded", "filename": filename, "filepath": filepath})
+        file_id = save_uploaded_file(username, filename, filepath, thread_id)
+        invalidate_context(username)
+        # Parse in the background so the first chat turn doesn't pay for it
+        submit_ingestion(file_id, filepath)
+        return jsonify({"status": "uploaded", "file_id": file_id, "filename": filename,
+                        "filepath": filepath, "ingestion": "processing"})
     
     return jsonify({"error": "Only PDF files allowed"}), 400
 
@@ -98,10 +154,16 @@ def upload_file():
 def delete_file():
     file_id = request.json.get("file_id")
     if file_id:
-        delete_uploaded_file_by_id(file_id)
+        invalidate_context(delete_uploaded_file_by_id(file_id))
         return jsonify({"status": "deleted"})
     return jsonify({"error": "No file_id provided"}), 400
 
+@app.route('/api/files/status', methods=['POST'])
+def get_file_status():
+    username = request.json.get("username")
+    thread_id = request.json.get("thread_id")
+    return jsonify(get_file_statuses(username, thread_id))
+
 @app.route('/api/files/thread', methods=['POST'])
 def get_thread_files_api():
     thread_id = request.json.get("thread_id")
@@ -120,50 +182,12 @@ def score_test():
         return jsonify({"score": 0, "feedback": "No answers provided"})
     
     try:
-        model = get_model()
-        
-        prompt = """You are a test evaluator. Score the following student answers and provide feedback.
-
-ANSWERS TO EVALUATE:
-"""
-        for i, ans in enumerate(answers):
-            prompt += f"\n{i+1}. Question: {ans.get('question', '')}"
-            prompt += f"\n   Correct Answer: {ans.get('correct_answer', '')}"
-            prompt += f"\n   Student Answer: {ans.get('user_answer', '')}"
-            prompt += f"\n   Type: {ans.get('type', 'text')}\n"
-        
-        prompt += """
-
-Evaluate each answer and provide:
-1. A score out of 100 (be fair but accurate)
-2. Brief feedback for each answer
-3. Overall feedback
-
-Respond in this exact JSON format:
-{"score": <number>, "feedback": "<overall feedback>", "details": [{"correct": true/false, "comment": "<brief comment>"}]}"""
-
-        from langchain_core.messages import HumanMessage
-        response = model.invoke([HumanMessage(content=prompt)])
-        
-        tokens_used = 0
-        if hasattr(response, 'usage_metadata') and response.usage_metadata:
-            tokens_used = response.usage_metadata.get('total_tokens', 0)
-        
-        add_user_tokens(username, tokens_used)
-        
-        try:
-            content = response.content
-            start = content.find('{')
-            end = content.rfind('}') + 1
-            if start >= 0 and end > start:
-                result = json.loads(content[start:end])
-                result['tokens_used'] = tokens_used
-                return jsonify(result)
-        except:
-            pass
-        
-        return jsonify({"score": 50, "feedback": response.content, "tokens_used": tokens_used})
-        
+        with admission.context(username, admission.INTERACTIVE):
+            result = score_answers(answers)
+        add_user_tokens(username, result["tokens_used"])
+        return jsonify(result)
+    except AdmissionRejected as e:
+        return too_busy(e)
     except Exception as e:
         print(f"Scoring error: {e}")
         return jsonify({"score": 0, "feedback": f"Error scoring: {str(e)}"}), 500
@@ -193,11 +217,7 @@ def chat_stream():
         thread_id = str(uuid.uuid4())
         create_thread_entry(username, thread_id, msg, chat_mode)
         # Link any pending uploaded files to this new thread
-        from database import get_conn
-        conn = get_conn()
-        conn.execute("UPDATE uploaded_files SET thread_id=? WHERE username=? AND thread_id IS NULL", (thread_id, username))
-        conn.commit()
-        conn.close()
+        link_pending_files(username, thread_id)
     
     save_message(thread_id, "user", msg)
     
@@ -223,10 +243,11 @@ You help students learn by answering questions clearly and educationally."""
             ]
             
             full_response = ""
-            for chunk in model.stream(messages):
-                if hasattr(chunk, 'content') and chunk.content:
-                    full_response += chunk.content
-                    yield f"data: {json.dumps({'type': 'chunk', 'content': chunk.content})}\n\n"
+            with admission.context(username, admission.INTERACTIVE):
+                for chunk in model.stream(messages):
+                    if hasattr(chunk, 'content') and chunk.content:
+                        full_response += chunk.content
+                        yield f"data: {json.dumps({'type': 'chunk', 'content': chunk.content})}\n\n"
             
             tokens_used = len(full_response.split()) * 2
             add_user_tokens(username, tokens_used)
@@ -234,6 +255,8 @@ You help students learn by answering questions clearly and educationally."""
             
             yield f"data: {json.dumps({'type': 'done', 'thread_id': thread_id, 'tokens_used': tokens_used})}\n\n"
             
+        except AdmissionRejected as e:
+            yield sse({'type': 'error', 'content': str(e), 'retry_after': e.retry_after})
         except Exception as e:
             yield f"data: {json.dumps({'type': 'error', 'content': str(e)})}\n\n"
     
@@ -253,77 +276,57 @@ def summarize_pdf():
         return jsonify({"error": "File not found"}), 404
     
     try:
-        summary, tokens = summarize_pdf_full(filepath)
+        with admission.context(username):
+            summary, tokens = summarize_pdf_full(filepath)
         add_user_tokens(username, tokens)
         return jsonify({"summary": summary, "tokens_used": tokens})
+    except AdmissionRejected as e:
+        return too_busy(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/chat', methods=['POST'])
-def chat():
-    data = request.json
+def start_chat_turn(data):
+    """Create the thread if needed, save the user's message and build the graph input for this turn."""
     username = data.get("username")
     msg = data.get("message")
     thread_id = data.get("thread_id")
     chat_mode = data.get("chat_mode", "study")
-    enabled_tools = data.get("enabled_tools", [])
-    voice_style = data.get("voice_style", "female-english")
-    
-    if not os.environ.get("GROQ_API_KEY"):
-        return jsonify({
-            "response": "Error: GROQ_API_KEY is not set. Please add your Groq API key in the Secrets tab.",
-            "thread_id": thread_id or str(uuid.uuid4()),
-            "flashcards": [], "mcqs": []
-        })
     
     if not thread_id:
         thread_id = str(uuid.uuid4())
         create_thread_entry(username, thread_id, msg, chat_mode)
         # Link any pending uploaded files to this new thread
-        from database import get_conn
-        conn = get_conn()
-        conn.execute("UPDATE uploaded_files SET thread_id=? WHERE username=? AND thread_id IS NULL", (thread_id, username))
-        conn.commit()
-        conn.close()
+        link_pending_files(username, thread_id)
+        invalidate_context(username)
     
     save_message(thread_id, "user", msg)
     
     config = {"configurable": {"thread_id": thread_id}}
     
-    user_profile = get_user_profile(username) or {}
-    user_notes = get_user_notes(username) or []
-    user_files = get_thread_files(thread_id) if thread_id else []
+    context = get_context(username, thread_id)
     
-    try:
-        result = graph.invoke({
-            "query": msg, 
-            "username": username,
-            "chat_mode": chat_mode,
-            "enabled_tools": enabled_tools,
-            "voice_style": voice_style,
-            "user_profile": user_profile,
-            "user_notes": user_notes,
-            "user_files": user_files
-        }, config=config)
-        
-        screen_text = result.get("screen_text", "")
-        flashcards = result.get("flashcards", [])
-        mcqs = result.get("mcqs", [])
-        audio_path = result.get("audio_path", "")
-        tokens_used = result.get("tokens_used", 0)
-        chart_image = result.get("chart_image", "")
-        
-        add_user_tokens(username, tokens_used)
-        
-    except Exception as e:
-        print(f"Error in chat: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({
-            "response": f"Sorry, there was an error processing your request.",
-            "thread_id": thread_id,
-            "flashcards": [], "mcqs": []
-        })
+    inputs = {
+        "query": msg, 
+        "username": username,
+        "chat_mode": chat_mode,
+        "enabled_tools": data.get("enabled_tools", []),
+        "voice_style": data.get("voice_style", "female-english"),
+        "user_profile": context["user_profile"],
+        "user_notes": context["user_notes"],
+        "user_files": context["user_files"]
+    }
+    return thread_id, inputs, config
+
+def finish_chat_turn(username, thread_id, result):
+    """Bill tokens, save the AI message and build the response payload from the final graph state."""
+    screen_text = result.get("screen_text", "")
+    flashcards = result.get("flashcards", [])
+    mcqs = result.get("mcqs", [])
+    audio_path = result.get("audio_path", "")
+    tokens_used = result.get("tokens_used", 0)
+    chart_image = result.get("chart_image", "")
+    
+    add_user_tokens(username, tokens_used)
     
     message_type = "text"
     if flashcards:
@@ -336,7 +339,8 @@ def chat():
         message_type = "chart"
     
     all_cards = flashcards + mcqs
-    save_message(thread_id, "ai", screen_text, message_type, all_cards if all_cards else None, audio_path, tokens_used)
+    save_message(thread_id, "ai", screen_text, message_type, all_cards if all_cards else None, audio_path, tokens_used,
+                 chart_image or None)
     
     response_data = {
         "response": screen_text,
@@ -346,30 +350,202 @@ def chat():
         "tokens_used": tokens_used
     }
     
-    if audio_path and os.path.exists(audio_path):
+    if audio_path and (os.path.exists(audio_path) or is_pending(audio_path)):
         response_data["audio_url"] = f"/api/audio/{os.path.basename(audio_path)}"
     
     if chart_image:
         response_data["chart_image"] = chart_image
     
-    return jsonify(response_data)
+    return response_data
+
+@app.route('/api/chat', methods=['POST'])
+def chat():
+    data = request.json
+    username = data.get("username")
+    thread_id = data.get("thread_id")
+    
+    if not os.environ.get("GROQ_API_KEY"):
+        return jsonify({
+            "response": "Error: GROQ_API_KEY is not set. Please add your Groq API key in the Secrets tab.",
+            "thread_id": thread_id or str(uuid.uuid4()),
+            "flashcards": [], "mcqs": []
+        })
+    
+    thread_id, inputs, config = start_chat_turn(data)
+    
+    try:
+        with admission.context(username, admission.INTERACTIVE):
+            result = graph.invoke(inputs, config=config)
+    except AdmissionRejected as e:
+        return too_busy(e)
+    except Exception as e:
+        print(f"Error in chat: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({
+            "response": f"Sorry, there was an error processing your request.",
+            "thread_id": thread_id,
+            "flashcards": [], "mcqs": []
+        })
+    
+    return jsonify(finish_chat_turn(username, thread_id, result))
+
+def sse(payload):
+    return f"data: {json.dumps(payload)}\n\n"
+
+def stream_frames(mode, chunk, pending_tools):
+    """Translate one graph.stream()/astream() item into the SSE payloads the client understands."""
+    if mode == "messages":
+        message, metadata = chunk
+        # Tokens from models called inside tools (e.g. PDF summaries) are not shown
+        if metadata.get("langgraph_node") == "agent" and isinstance(message.content, str) and message.content:
+            yield {'type': 'token', 'content': message.content}
+        return
+    
+    for node, update in chunk.items():
+        if node == "agent" and update:
+            last = (update.get("messages") or [None])[-1]
+            for call in getattr(last, "tool_calls", None) or []:
+                pending_tools[call.get("id")] = call.get("name")
+                yield {'type': 'tool_start', 'id': call.get("id"), 'name': call.get("name")}
+        elif node == "tools" and update:
+            for tool_msg in update.get("messages") or []:
+                tool_id = getattr(tool_msg, "tool_call_id", None)
+                if tool_id in pending_tools:
+                    yield {'type': 'tool_end', 'id': tool_id, 'name': pending_tools.pop(tool_id),
+                           'content': tool_msg.content}
+
+@app.route('/api/chat/agent-stream', methods=['POST'])
+def chat_agent_stream():
+    """Same turn as /api/chat (history, profile, tools), streamed as SSE frames.
+
+    Frames: token (model output from the agent node), tool_start / tool_end,
+    then done with the same payload /api/chat returns, or error.
+    """
+    data = request.json
+    username = data.get("username")
+    
+    if not os.environ.get("GROQ_API_KEY"):
+        def error_gen():
+            yield sse({'type': 'error', 'content': 'GROQ_API_KEY not set'})
+        return Response(error_gen(), mimetype='text/event-stream')
+    
+    thread_id, inputs, config = start_chat_turn(data)
+    
+    def generate():
+        yield sse({'type': 'start', 'thread_id': thread_id})
+        try:
+            pending_tools = {}
+            with admission.context(username, admission.INTERACTIVE):
+                for mode, chunk in graph.stream(inputs, config=config, stream_mode=["messages", "updates"]):
+                    for frame in stream_frames(mode, chunk, pending_tools):
+                        yield sse(frame)
+            
+            result = graph.get_state(config).values
+            yield sse(dict(finish_chat_turn(username, thread_id, result), type='done'))
+        except AdmissionRejected as e:
+            yield sse({'type': 'error', 'content': str(e), 'retry_after': e.retry_after, 'thread_id': thread_id})
+        except Exception as e:
+            print(f"Error in agent stream: {e}")
+            yield sse({'type': 'error', 'content': str(e), 'thread_id': thread_id})
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'Connection': 'keep-alive',
+        'X-Accel-Buffering': 'no'
+    })
 
 @app.route('/api/audio/<filename>')
 def serve_audio(filename):
-    if os.path.exists(filename):
-        return send_file(filename, mimetype='audio/mpeg')
+    filename = secure_filename(filename)
+    path = os.path.join(AUDIO_DIR, filename)
+    if filename and is_pending(path):
+        # Still being synthesized: forward chunks as they are produced
+        return Response(stream_audio(path), mimetype='audio/mpeg', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+    error = synthesis_error(path) if filename else None
+    if error:
+        return jsonify({"error": f"Audio synthesis failed: {error}"}), 502
+    # send_file resolves relative paths against app.root_path, while clips are written relative to the working directory
+    file_path = os.path.abspath(path)
+    if filename and os.path.exists(file_path):
+        # Clips are named by content digest, so they never change once written
+        response = send_file(file_path, mimetype='audio/mpeg', conditional=True, etag=True)
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+    legacy_path = os.path.abspath(filename)
+    if filename and os.path.exists(legacy_path):
+        # Clips generated before the media directory existed live in the working directory
+        return send_file(legacy_path, mimetype='audio/mpeg', conditional=True, etag=True)
     return jsonify({"error": "Audio not found"}), 404
 
+@app.route('/api/chart/<digest>')
+def serve_chart(digest):
+    digest = secure_filename(digest)
+    path = chart_path(digest)
+    if digest and os.path.exists(path):
+        # Charts are addressed by a hash of their Mermaid source, so a URL always maps to the same image
+        response = send_file(path, mimetype='image/png', conditional=True, etag=True)
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+    return jsonify({"error": "Chart not found"}), 404
+
+def parse_limit(default):
+    """The request's "limit" clamped to 1..MAX_PAGE_SIZE, or None when it is not an integer."""
+    value = request.json.get("limit")
+    if not value:
+        return default
+    try:
+        return max(1, min(int(value), MAX_PAGE_SIZE))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+def parse_row_id(value):
+    """A message or card id from the request; raises ValueError unless it fits an SQLite rowid."""
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"Invalid id: {value!r}")
+    value = int(value)
+    if not 0 <= value < 2**63:
+        raise ValueError(f"Invalid id: {value!r}")
+    return value
+
+def decode_thread_cursor(cursor):
+    """Decode a next_cursor from get_threads back to (created_at, id); raises ValueError if malformed."""
+    if not isinstance(cursor, str):
+        raise ValueError("cursor must be a string")
+    value = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if not (isinstance(value, list) and len(value) == 2
+            and isinstance(value[0], (str, type(None))) and isinstance(value[1], str)):
+        raise ValueError("cursor must decode to [created_at, id]")
+    return value
+
 @app.route('/api/threads', methods=['POST'])
 def get_threads():
     username = request.json.get("username")
-    threads = get_user_threads(username)
-    return jsonify(threads)
+    if "limit" not in request.json:
+        return jsonify(get_user_threads(username))
+    
+    # Paginated: {"threads": [...], "next_cursor": <opaque string or null>}
+    limit = parse_limit(30)
+    if limit is None:
+        return jsonify({"error": "Invalid limit"}), 400
+    cursor = request.json.get("cursor")
+    try:
+        cursor = decode_thread_cursor(cursor) if cursor else None
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+    threads, next_cursor = get_user_threads_page(username, cursor, limit)
+    if next_cursor:
+        next_cursor = base64.urlsafe_b64encode(json.dumps(next_cursor).encode()).decode()
+    return jsonify({"threads": threads, "next_cursor": next_cursor})
 
 @app.route('/api/threads/delete', methods=['POST'])
 def delete_thread():
     tid = request.json.get("thread_id")
     delete_thread_entry(tid)
+    memory.delete_thread(tid)
     return jsonify({"status": "deleted"})
 
 @app.route('/api/threads/rename', methods=['POST'])
@@ -378,21 +554,77 @@ def rename_thread():
     update_thread_title(data['thread_id'], data['new_title'])
     return jsonify({"status": "updated"})
 
+@app.route('/api/search', methods=['POST'])
+def search():
+    username = request.json.get("username")
+    query = request.json.get("query", "")
+    limit = parse_limit(20)
+    if limit is None:
+        return jsonify({"error": "Invalid limit"}), 400
+    return jsonify({"results": search_user_content(username, query, limit)})
+
+@app.route('/api/review/next', methods=['POST'])
+def review_next():
+    username = request.json.get("username")
+    limit = parse_limit(REVIEW_BATCH_SIZE)
+    if limit is None:
+        return jsonify({"error": "Invalid limit"}), 400
+    return jsonify(next_cards(username, limit))
+
+@app.route('/api/review/answer', methods=['POST'])
+def review_answer():
+    data = request.json
+    quality = data.get("quality")
+    try:
+        card_id = parse_row_id(data.get("card_id"))
+        quality = int(quality) if quality is not None else None
+        card = answer_card(data.get("username"), card_id, quality, data.get("user_answer"))
+    except (TypeError, ValueError, OverflowError) as e:
+        return jsonify({"error": str(e)}), 400
+    if card is None:
+        return jsonify({"error": "Card not found"}), 404
+    return jsonify(card)
+
+def format_history_entry(msg):
+    entry = {"role": msg["role"], "content": msg["content"], "type": msg.get("type", "text")}
+    if msg.get("flashcards"):
+        entry["flashcards"] = msg["flashcards"]
+    if msg.get("audio_path") and os.path.exists(msg["audio_path"]):
+        entry["audio_url"] = f"/api/audio/{os.path.basename(msg['audio_path'])}"
+    if msg.get("chart_image"):
+        entry["chart_image"] = msg["chart_image"]
+    return entry
+
 @app.route('/api/history', methods=['POST'])
 def get_history():
     thread_id = request.json.get("thread_id")
-    messages = get_thread_messages(thread_id)
+    if "limit" not in request.json:
+        return jsonify([format_history_entry(msg) for msg in get_thread_messages(thread_id)])
+    
+    # Paginated: pass "before" to page back from the oldest message shown, "after" to fetch newer ones
+    limit = parse_limit(50)
+    if limit is None:
+        return jsonify({"error": "Invalid limit"}), 400
+    before = request.json.get("before")
+    after = request.json.get("after")
+    try:
+        before = parse_row_id(before) if before else None
+        after = parse_row_id(after) if after else None
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
     
+    messages, has_more = get_thread_messages_page(thread_id, before, after, limit)
     formatted = []
     for msg in messages:
-        entry = {"role": msg["role"], "content": msg["content"], "type": msg.get("type", "text")}
-        if msg.get("flashcards"):
-            entry["flashcards"] = msg["flashcards"]
-        if msg.get("audio_path") and os.path.exists(msg["audio_path"]):
-            entry["audio_url"] = f"/api/audio/{os.path.basename(msg['audio_path'])}"
+        entry = format_history_entry(msg)
+        entry["id"] = msg["id"]
         formatted.append(entry)
-    
-    return jsonify(formatted)
+    return jsonify({
+        "messages": formatted,
+        "has_more": has_more,
+        "before": str(messages[0]["id"]) if messages else before,
+        "after": str(messages[-1]["id"]) if messages else after
+    })
 
 if __name__ == '__main__':
     import socket
@@ -406,4 +638,6 @@ if __name__ == '__main__':
     except:
         pass
     
+    resume_pending()
+    start_compaction_scheduler(memory.conn, memory.lock)
     app.run(debug=True, host='0.0.0.0', port=5000, use_reloader=False)
@@ -0,0 +1,148 @@
+import os
+import asyncio
+import hashlib
+import threading
+import time
+from concurrent.futures import Future
+
+import edge_tts
+
+from metrics import timed
+
+MEDIA_DIR = os.environ.get("MEDIA_DIR", "media")
+AUDIO_DIR = os.path.join(MEDIA_DIR, "audio")
+TTS_TIMEOUT = int(os.environ.get("TTS_TIMEOUT", "120"))
+# When on, chat responses return the audio URL right away and the clip streams while it is synthesized
+TTS_STREAMING = os.environ.get("TTS_STREAMING", "1") == "1"
+STREAM_CHUNK = 16 * 1024
+
+_loop = None
+_loop_lock = threading.Lock()
+# digest -> concurrent Future of the synthesis currently running for it
+_inflight = {}
+_inflight_lock = threading.RLock()
+# path -> error of its last failed synthesis, so /api/audio can report it instead of a bare 404
+_failed = {}
+MAX_FAILED = 1024
+
+def get_loop():
+    """Return the shared event loop that runs TTS work, starting its thread on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="tts-loop", daemon=True).start()
+        return _loop
+
+def audio_digest(text: str, voice: str) -> str:
+    return hashlib.sha256(f"{voice}\0{text}".encode("utf-8")).hexdigest()[:32]
+
+def audio_path_for(text: str, voice: str) -> str:
+    return os.path.join(AUDIO_DIR, f"{audio_digest(text, voice)}.mp3")
+
+@timed("tts", "synthesize")
+async def _synthesize(text: str, voice: str, path: str) -> str:
+    os.makedirs(AUDIO_DIR, exist_ok=True)
+    # Chunks are flushed to the .part file as edge_tts produces them so
+    # stream_audio() can forward them before the clip is finished.
+    tmp = f"{path}.part"
+    size = 0
+    try:
+        communicate = edge_tts.Communicate(text, voice)
+        with open(tmp, "wb") as f:
+            async for chunk in communicate.stream():
+                if chunk["type"] == "audio":
+                    f.write(chunk["data"])
+                    f.flush()
+                    size += len(chunk["data"])
+        if not size:
+            raise RuntimeError("edge_tts returned no audio")
+        os.replace(tmp, path)
+    except BaseException:
+        # Never cache an empty or partial clip; readers following the .part stop once the future is done
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+    return path
+
+def submit_audio(text: str, voice: str):
+    """Start (or join) synthesis of text in voice and return a concurrent Future of its file path.
+
+    Identical (voice, text) pairs share one file on disk and one in-flight job.
+    """
+    path = audio_path_for(text, voice)
+    with _inflight_lock:
+        future = _inflight.get(path)
+        if future is None:
+            if os.path.exists(path):
+                done = Future()
+                done.set_result(path)
+                return done
+            _failed.pop(path, None)
+            future = asyncio.run_coroutine_threadsafe(_synthesize(text, voice, path), get_loop())
+            _inflight[path] = future
+            future.add_done_callback(lambda f: _forget(path, f))
+    return future
+
+def _forget(path, future):
+    error = "cancelled" if future.cancelled() else future.exception()
+    with _inflight_lock:
+        _inflight.pop(path, None)
+        if error:
+            if len(_failed) >= MAX_FAILED:
+                _failed.pop(next(iter(_failed)))
+            _failed[path] = str(error) or type(error).__name__
+
+def synthesis_error(path: str):
+    """The error of the last failed synthesis of path, or None."""
+    with _inflight_lock:
+        return _failed.get(path)
+
+def is_pending(path: str) -> bool:
+    with _inflight_lock:
+        return path in _inflight
+
+def stream_audio(path: str, poll: float = 0.05):
+    """Yield the bytes of a clip, following its .part file while synthesis is still running."""
+    with _inflight_lock:
+        future = _inflight.get(path)
+    if future is None:
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                yield from iter(lambda: f.read(STREAM_CHUNK), b"")
+        return
+    
+    tmp = f"{path}.part"
+    deadline = time.monotonic() + TTS_TIMEOUT
+    while not os.path.exists(tmp) and not future.done():
+        if time.monotonic() > deadline:
+            return
+        time.sleep(poll)
+    
+    try:
+        # Opening the .part file keeps it readable even after it is renamed into place
+        f = open(tmp if os.path.exists(tmp) else path, "rb")
+    except FileNotFoundError:
+        f = open(path, "rb") if os.path.exists(path) else None
+    if f is None:
+        return
+    with f:
+        while True:
+            data = f.read(STREAM_CHUNK)
+            if data:
+                yield data
+            elif future.done() or time.monotonic() > deadline:
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    yield from iter(lambda: f.read(STREAM_CHUNK), b"")
+                return
+            else:
+                time.sleep(poll)
+
+def get_audio(text: str, voice: str) -> str:
+    """Blocking wrapper around submit_audio for synchronous callers."""
+    path = audio_path_for(text, voice)
+    if os.path.exists(path):
+        return path
+    return submit_audio(text, voice).result(timeout=TTS_TIMEOUT)
@@ -0,0 +1,47 @@
+import os
+import datetime
+import threading
+from collections import OrderedDict
+
+from database import get_chat_context
+from llm import extract_pdf_content
+
+CONTEXT_CACHE_ENTRIES = int(os.environ.get("CONTEXT_CACHE_ENTRIES", "1024"))
+
+# (username, thread_id, date) -> snapshot; the date in the key rolls "upcoming notes" over at midnight
+_snapshots = OrderedDict()
+# Bumped on every invalidation so a load that raced with an update is not cached
+_generations = {}
+_lock = threading.Lock()
+
+def get_context(username, thread_id):
+    """Return the profile, upcoming notes and thread files (with previews) for a chat turn."""
+    today = datetime.date.today().strftime("%Y-%m-%d")
+    key = (username, thread_id, today)
+    with _lock:
+        snapshot = _snapshots.get(key)
+        if snapshot is not None:
+            _snapshots.move_to_end(key)
+            return snapshot
+        generation = _generations.get(username, 0)
+    
+    snapshot = get_chat_context(username, thread_id, today)
+    for f in snapshot["user_files"][:3]:
+        filepath = f.get("filepath")
+        f["preview"] = extract_pdf_content(filepath) if filepath and os.path.exists(filepath) else ""
+    
+    with _lock:
+        if _generations.get(username, 0) == generation:
+            _snapshots[key] = snapshot
+            while len(_snapshots) > CONTEXT_CACHE_ENTRIES:
+                _snapshots.popitem(last=False)
+    return snapshot
+
+def invalidate(username):
+    """Drop every cached snapshot for username; call after profile, note or file changes."""
+    if not username:
+        return
+    with _lock:
+        _generations[username] = _generations.get(username, 0) + 1
+        for key in [k for k in _snapshots if k[0] == username]:
+            del _snapshots[key]